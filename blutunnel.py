@@ -8,10 +8,24 @@ import asyncio
 import socket
 import struct
 import resource
+import fcntl
 import hashlib
+import hmac
+import zlib
 import json
+import urllib.parse
 import secrets
+import signal
 import logging
+import logging.handlers
+import queue
+import atexit
+import math
+import argparse
+import bisect
+import collections
+import multiprocessing
+import multiprocessing.connection
 from typing import Set, Dict, Optional, Tuple
 import ipaddress
 import time
@@ -70,12 +84,19 @@ class DependencyManager:
         print("\n\033[92m✅ All dependencies satisfied!\033[0m")
         print("\033[94m" + "="*50 + "\033[0m\n")
 
-DependencyManager.ensure_dependencies()
-
-import aiohttp
-
 CONFIG_FILE = "blutunnel_config.json"
 LOG_FILE = "blutunnel.log"
+LOG_LEVEL = "info"
+LOG_LEVELS = ("debug", "info", "warning", "error")
+# Console and file output happen on a writer thread, off the event loop. At
+# most LOG_QUEUE_RECORDS records wait for it; past that new ones are dropped
+# and counted. The file rotates past LOG_MAX_BYTES (0: never) and, with
+# LOG_ROTATE "hourly" or "daily", when a new period starts, keeping LOG_BACKUPS.
+LOG_QUEUE_RECORDS = 10000
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_ROTATE = "off"
+LOG_ROTATE_PERIODS = {"off": None, "hourly": "%Y%m%d%H", "daily": "%Y%m%d"}
 BUFFER_SIZE = 65536
 SOCK_BUFFER = 2 * 1024 * 1024
 MAX_POOL = 300
@@ -84,8 +105,232 @@ PIPE_IDLE_TIMEOUT = 300
 BRIDGE_ASSIGN_TIMEOUT = 180
 BRIDGE_PICK_TIMEOUT = 12
 BRIDGE_SEND_TIMEOUT = 2
+# Idle pooled bridges get a port-0 header as heartbeat; an unacknowledged
+# heartbeat makes the kernel drop the bridge after BRIDGE_USER_TIMEOUT.
+BRIDGE_HEARTBEAT_PORT = 0
+BRIDGE_HEARTBEAT_INTERVAL = 15
+BRIDGE_USER_TIMEOUT = 20
+BRIDGE_KEEPALIVE_IDLE = 30
+BRIDGE_KEEPALIVE_INTERVAL = 10
+BRIDGE_KEEPALIVE_COUNT = 3
 CHECK_HOST_API = "https://check-host.net"
 LOG_THROTTLE_SEC = 30
+# Without a terminal (systemd, nohup) the live stats line becomes a log line this often.
+STATS_LOG_INTERVAL = 60
+SYNC_INTERVAL = 3
+SYNC_REFRESH_INTERVAL = 30
+XRAY_PROCESS = "xray"
+XRAY_SCAN_INTERVAL = 1
+# Scans back off up to this while the listener set stays the same.
+XRAY_SCAN_MAX_INTERVAL = 8
+
+# Persistent port sync channel: versioned full/delta port-range frames, acked by Iran.
+# Each range names its protocol, so UDP inbounds ride along as port keys with
+# UDP_PORT_KEY set.
+SYNC_MAGIC = b"BTSY\x04"
+SYNC_HEADER = struct.Struct("!BIHH")
+SYNC_RANGE = struct.Struct("!BHH")
+SYNC_FULL = 1
+SYNC_DELTA = 2
+SYNC_POLL = 3
+SYNC_ACK = 4
+SYNC_IDLE_TIMEOUT = 3 * SYNC_REFRESH_INTERVAL
+# Bridge and sync connections open with a challenge from Iran; Europe answers
+# with HMAC-SHA256 keyed by the shared KEY before any other byte is read.
+AUTH_NONCE = 16
+AUTH_TOKEN = 32
+AUTH_TIMEOUT = 5
+AUTH_BRIDGE = b"bridge"
+AUTH_SYNC = b"sync"
+PORT_APPLY_CONCURRENCY = 128
+PORT_APPLY_DETAIL = 16
+LOOP_ENGINE = "auto"
+LOOP_ENGINES = ("auto", "asyncio", "uvloop")
+
+# Elastic reverse-worker pool (Europe side), steered by Iran's pool status.
+POOL_MIN_WORKERS = 16
+POOL_MAX_WORKERS = MAX_POOL
+POOL_MIN_IDLE = 8
+POOL_HEADROOM_SEC = 2
+POOL_SHRINK_FACTOR = 2
+POOL_SHRINK_ROUNDS = 3
+POOL_STATUS = struct.Struct("!IIII")
+# Europe may serve several Iran relays (a comma-separated iran_ip). Each relay
+# has its own pool, all sharing the POOL_MAX_WORKERS budget. A failed bridge
+# connect marks the relay down for RELAY_BACKOFF_MIN seconds, doubling up to
+# RELAY_BACKOFF_MAX. Meanwhile its workers retire and the links go to the relays
+# that are up.
+RELAY_BACKOFF_MIN = 1
+RELAY_BACKOFF_MAX = 10
+
+# Iran tracks each Europe node (by the NODE_ID it sends after bridge and sync
+# auth) as an upstream with its own idle bridges, port set, RTT and throughput.
+# Users go to the healthy upstream with the lowest (active + 1) * RTT
+# ("least_time") or the fewest active streams ("least_conn"). A node is down
+# when nothing arrived from it for UPSTREAM_STALE seconds, or for
+# UPSTREAM_COOLDOWN seconds after UPSTREAM_FAIL_LIMIT failed handoffs in a row.
+NODE_ID_SIZE = 8
+UPSTREAM_BALANCE = "least_time"
+UPSTREAM_BALANCES = ("least_time", "least_conn")
+UPSTREAM_STALE = 3 * SYNC_INTERVAL
+UPSTREAM_FAIL_LIMIT = 3
+UPSTREAM_COOLDOWN = 10
+UPSTREAM_FORGET = 120
+UPSTREAM_TICK = 1
+UPSTREAM_EWMA = 0.2
+UPSTREAM_RTT_FLOOR = 0.0005
+# Pool-mode bridge classes from the Iran profile: "port_reserve" keeps that
+# many idle bridges back for a port while it holds fewer in use, and
+# "port_priority" queues a port's waiting users in the "high", "normal" or
+# "low" class. Bridges beyond the reservations stay shared by every port.
+PORT_PRIORITIES = ("high", "normal", "low")
+PORT_PRIORITY = "normal"
+
+# Zero-copy relay: socket -> pipe -> socket with splice(2) on Linux.
+SPLICE_ENABLED = sys.platform.startswith("linux") and hasattr(os, "splice")
+SPLICE_PIPE_SIZE = 1024 * 1024
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if SPLICE_ENABLED else 0
+
+# Relay engines: splice(2), BufferedProtocol with pooled slabs, StreamReader pipe().
+RELAY_ENGINE = "auto"
+RELAY_ENGINES = ("auto", "splice", "protocol", "stream")
+BUFFER_POOL_MAX = 256
+
+# Opt-in bridge compression (pool mode): Iran picks a codec per user port from
+# the ones Europe advertises. A chunk that does not shrink switches its
+# direction to raw frames for a growing number of chunks before the next probe.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+CODEC_FRAME = struct.Struct("!I")
+CODEC_COMPRESSED = 0x80000000
+# Encoders take at most BUFFER_SIZE raw bytes per frame; the wire bound leaves
+# room for incompressible data growing a little in the compressor.
+CODEC_FRAME_MAX = BUFFER_SIZE + BUFFER_SIZE // 8
+COMPRESS_ZLIB_LEVEL = 1
+COMPRESS_ZSTD_LEVEL = 1
+COMPRESS_MIN_CHUNK = 256
+COMPRESS_MIN_GAIN = 0.9
+COMPRESS_SKIP_MIN = 4
+COMPRESS_SKIP_MAX = 1024
+BRIDGE_HEADER = struct.Struct("!HB")
+# Set in the header's codec byte (or a third MUX_OPEN byte) for a UDP session.
+BRIDGE_UDP = 0x80
+# Pool mode sends the bridge header together with the user's first bytes when
+# they arrive within BRIDGE_FIRST_BYTES_WAIT (server-first protocols go alone).
+BRIDGE_FIRST_BYTES_WAIT = 0.005
+
+# Adaptive write coalescing on the bridge side of a relay: a small write that
+# follows another within COALESCE_BURST_GAP corks the socket (TCP_CORK) for up
+# to COALESCE_DEADLINE. Isolated small writes still go out at once (TCP_NODELAY).
+COALESCE = True
+COALESCE_SMALL_WRITE = 1200
+COALESCE_BURST_GAP = 0.002
+COALESCE_DEADLINE = 0.002
+TCP_INFO_SIZE = 160
+TCP_INFO_BYTES_ACKED = struct.Struct("=Q")
+TCP_INFO_BYTES_ACKED_OFFSET = 120
+TCP_INFO_DATA_SEGS_OUT = struct.Struct("=I")
+TCP_INFO_DATA_SEGS_OUT_OFFSET = 156
+TCP_INFO_BYTES_RECEIVED = struct.Struct("=Q")
+TCP_INFO_BYTES_RECEIVED_OFFSET = 128
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+TCP_INFO_LAST_DATA = struct.Struct("=I")
+TCP_INFO_LAST_DATA_SENT_OFFSET = 44
+TCP_INFO_LAST_DATA_RECV_OFFSET = 52
+
+# Opt-in bandwidth shaping (Iran side): token buckets per user port, per client
+# IP and for the whole bridge link, each direction on its own. A stream spends
+# grants of SHAPE_QUANTUM bytes times its port's weight; once a bucket runs dry
+# its streams queue and are granted in turn from one loop timer, so the rate is
+# shared in weighted round robin. A bucket holds up to SHAPE_BURST seconds of rate.
+SHAPE_QUANTUM = 16384
+SHAPE_BURST = 0.1
+SHAPE_RATE_EWMA = 0.5
+SHAPE_UNITS = {"": 1, "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3}
+
+# Memory budget mode (opt-in): sockets start with MEM_SOCK_MIN buffers instead
+# of SOCK_BUFFER and streams lease them from a global budget. About every
+# MEM_TICK a stream that moved at least its buffer size per second doubles it
+# up to SOCK_BUFFER while the budget allows; after MEM_IDLE_TICKS quiet samples
+# it drops back. Leases are sampled MEM_SLICE per loop callback, spread over
+# the tick. Once RSS plus the leased buffers leaves no room for one more
+# stream, new user connections are refused.
+MEMORY_BUDGET = 0
+MEM_SOCK_MIN = 64 * 1024
+MEM_PIPE_SIZE = 256 * 1024
+MEM_STREAM_OVERHEAD = 32 * 1024
+MEM_TICK = 1
+MEM_SLICE = 1000
+MEM_IDLE_TICKS = 5
+MEM_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+# Optional Prometheus text endpoint; worker N of --workers listens on METRICS_PORT + N.
+METRICS_PORT = 0
+METRICS_BIND = "127.0.0.1"
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Live stream registry behind the metrics listener's /streams and the `top`
+# command. Records are only written when a stream starts and ends: bytes and
+# idle time come from the stream's socket (TCP_INFO) when asked, and rates from
+# two such readings STREAMS_RATE_WINDOW seconds apart.
+STREAMS_RATE_WINDOW = 1
+STREAMS_TOP = 10
+STREAMS_SORTS = ("rate", "bytes", "age", "idle")
+
+# Hot reload and binary upgrade: SIGHUP re-reads the config; SIGUSR2 starts a
+# new process on the same listening sockets (HANDOFF_ENV lists the passed fds)
+# and drains this one for up to DRAIN_TIMEOUT. Systemd's LISTEN_FDS also works.
+PID_FILE = "blutunnel.pid"
+HANDOFF_ENV = "BLUTUNNEL_LISTEN_FDS"
+HANDOFF_READY_ENV = "BLUTUNNEL_READY_FD"
+HANDOFF_READY_TIMEOUT = 30
+DRAIN_TIMEOUT = 600
+DRAIN_POLL = 1
+
+# Loopback benchmark: Iran listens on BENCH_HOST, the echo backend on BENCH_BACKEND.
+BENCH_WORKLOADS = ("connect", "bulk", "rr")
+BENCH_HOST = "127.0.0.2"
+BENCH_BACKEND = "127.0.0.1"
+BENCH_MESSAGE = 64
+BENCH_RR_SIZE = 256
+BENCH_CHUNK = 65536
+BENCH_READY_TIMEOUT = 30
+BENCH_SETTLE = 2
+BENCH_OUTPUT = "blutunnel_bench.json"
+
+# UDP relay: Iran gives each client address of a UDP port its own session,
+# carried over one bridge (or mux stream) as UDP_FRAME-prefixed datagrams.
+# Sessions expire after UDP_IDLE_TIMEOUT; past UDP_MAX_SESSIONS per port the
+# least recently active one is evicted, and past UDP_QUEUE_BYTES of backlog a
+# session drops datagrams as a congested path would.
+UDP_PORT_KEY = 1 << 16
+UDP_FRAME = struct.Struct("!H")
+UDP_IDLE_TIMEOUT = 60
+UDP_SWEEP_INTERVAL = 5
+UDP_MAX_SESSIONS = 1024
+UDP_QUEUE_BYTES = 256 * 1024
+
+# Multiplexed bridge mode: a few persistent bridges carry many user streams.
+MUX_MAGIC = b"BTMX\x01"
+MUX_BRIDGES = 32
+MUX_MAX_STREAMS = 4096
+MUX_WINDOW = 256 * 1024
+MUX_CREDIT_BATCH = MUX_WINDOW // 4
+MUX_FRAME_MAX = 32768
+MUX_PING_INTERVAL = 15
+MUX_DEAD_TIMEOUT = 45
+MUX_HEADER = struct.Struct("!BIH")
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_CLOSE = 3
+MUX_WINDOW_UPDATE = 4
+MUX_PING = 5
+MUX_PONG = 6
+# Sent by a side that is shutting down: Iran stops opening streams on the
+# session and closes it once its streams finish; Europe links a replacement.
+MUX_GOAWAY = 7
 
 class Colors:
     HEADER = '\033[95m'
@@ -126,20 +371,439 @@ class ColoredFormatter(logging.Formatter):
         formatter = logging.Formatter(log_fmt, datefmt="%H:%M:%S")
         return formatter.format(record)
 
+class LogFile(logging.handlers.RotatingFileHandler):
+    """The log file, rotated by size or period and shared by worker processes.
+
+    The process that rotates holds an flock on the old file while renaming;
+    the others see the path point at a new inode on their next write and
+    reopen it, as WatchedFileHandler does.
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8", delay=True)
+        self.period = LOG_ROTATE_PERIODS[LOG_ROTATE]
+        self.inode = None
+        self.opened_at = 0.0
+
+    def _open(self):
+        stream = super()._open()
+        st = os.fstat(stream.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        # A file left by an earlier run belongs to the period it was last written in.
+        self.opened_at = st.st_mtime if st.st_size else time.time()
+        return stream
+
+    def _moved(self):
+        try:
+            st = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        return (st.st_dev, st.st_ino) != self.inode
+
+    def emit(self, record):
+        if self.stream is not None and self._moved():
+            self.stream.close()
+            self.stream = None
+        super().emit(record)
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.period and time.strftime(self.period, time.localtime(self.opened_at)) != time.strftime(self.period):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        fcntl.flock(self.stream.fileno(), fcntl.LOCK_EX)
+        try:
+            # Another process may have rotated while this one waited for the lock.
+            if not self._moved():
+                for i in range(self.backupCount - 1, 0, -1):
+                    source = f"{self.baseFilename}.{i}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.baseFilename}.{i + 1}")
+                os.replace(self.baseFilename, f"{self.baseFilename}.1")
+        finally:
+            self.stream.close()
+        self.stream = self._open()
+
+class LogQueue(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without blocking the caller."""
+
+    def __init__(self):
+        super().__init__(queue.Queue(LOG_QUEUE_RECORDS))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records stay in this process, so the writer thread formats them.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter(logging.handlers.QueueListener):
+    """The writer thread behind LogQueue; notes drops in the log itself."""
+
+    def __init__(self, source, *handlers):
+        super().__init__(source.queue, *handlers, respect_handler_level=True)
+        self.source = source
+        self.reported = 0
+
+    def handle(self, record):
+        dropped = self.source.dropped
+        if dropped != self.reported:
+            super().handle(logger.makeRecord(
+                logger.name, logging.WARNING, __file__, 0,
+                f"Log writer fell behind: {dropped - self.reported} records dropped", None, None,
+            ))
+            self.reported = dropped
+        super().handle(record)
+
+    def enqueue_sentinel(self):
+        # Wait for room so that stop() never loses the records already queued.
+        self.queue.put(self._sentinel)
+
 logger = logging.getLogger("BluTunnel")
 handler = logging.StreamHandler()
 handler.setFormatter(ColoredFormatter())
-logger.addHandler(handler)
 
 # Persistent logs for troubleshooting and CheckTunnel menu.
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+file_handler = LogFile(LOG_FILE)
 file_handler.setFormatter(logging.Formatter(
     "%(asctime)s %(levelname)s %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 ))
-logger.addHandler(file_handler)
 
+log_queue = LogQueue()
+logger.addHandler(log_queue)
 logger.setLevel(logging.INFO)
+log_writer = None
+
+def start_logging():
+    """Start the log writer thread; forked children run this for their own."""
+    global log_writer
+    log_queue.queue = queue.Queue(LOG_QUEUE_RECORDS)
+    log_queue.dropped = 0
+    log_writer = LogWriter(log_queue, handler, file_handler)
+    log_writer.start()
+
+def stop_logging():
+    """Write out the queued records and stop the writer thread."""
+    global log_writer
+    if log_writer is not None:
+        writer, log_writer = log_writer, None
+        writer.stop()
+
+start_logging()
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=start_logging)
+
+loop_engine_name = "asyncio"
+_loop_factory = None
+
+def select_loop_engine(name=LOOP_ENGINE):
+    """Pick the event loop used by every entry point.
+
+    ``auto`` uses uvloop when it is installed, ``uvloop`` asks for it
+    explicitly, and both fall back to the default asyncio loop otherwise.
+    """
+    global loop_engine_name, _loop_factory
+    loop_engine_name = "asyncio"
+    _loop_factory = None
+    if name not in LOOP_ENGINES:
+        logger.warning(f"Unknown loop engine '{name}', using asyncio")
+        return loop_engine_name
+    if name in ("auto", "uvloop"):
+        try:
+            import uvloop
+        except ImportError:
+            if name == "uvloop":
+                logger.warning("uvloop is not installed, falling back to asyncio")
+            return loop_engine_name
+        loop_engine_name = "uvloop"
+        if hasattr(asyncio, "Runner"):
+            _loop_factory = uvloop.new_event_loop
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return loop_engine_name
+
+relay_engine_name = RELAY_ENGINE
+
+def select_relay_engine(name=RELAY_ENGINE):
+    """Pin the relay engine used for user connections; ``auto`` picks the fastest available."""
+    global relay_engine_name
+    if name not in RELAY_ENGINES:
+        logger.warning(f"Unknown relay engine '{name}', using auto")
+        name = "auto"
+    relay_engine_name = name
+    return relay_engine_name
+
+compress_ports = {}
+coalesce_enabled = COALESCE
+# Random per launch and shared by --workers processes, so Iran sees one box as one upstream.
+NODE_ID = secrets.token_bytes(NODE_ID_SIZE)
+
+def codec_available(codec):
+    if codec == CODEC_ZSTD:
+        return importlib.util.find_spec("zstandard") is not None
+    return codec == CODEC_ZLIB
+
+def codec_caps():
+    """Bitmask of the codecs this node can decode, sent to Iran after bridge auth."""
+    return sum(1 << codec for codec in CODEC_NAMES.values() if codec_available(codec))
+
+def select_compression(spec):
+    """Parse ``{"443": "zstd", "*": "zlib"}`` or ``"443=zstd,*=zlib"`` into ``compress_ports``."""
+    global compress_ports
+    if isinstance(spec, str):
+        spec = dict(item.split("=", 1) for item in spec.split(",") if "=" in item)
+    mapping = {}
+    for port, name in (spec or {}).items():
+        port = str(port).strip()
+        codec = CODEC_NAMES.get(str(name).strip().lower())
+        if codec is None or not (port == "*" or port.isdigit()):
+            logger.warning(f"Ignoring compression setting {port}={name}")
+            continue
+        if not codec_available(codec):
+            logger.warning(f"{name} is not installed, using zlib for port {port}")
+            codec = CODEC_ZLIB
+        mapping[port if port == "*" else int(port)] = codec
+    compress_ports = mapping
+    return compress_ports
+
+def port_codec(port, caps):
+    """Codec for a user port: the configured one if Europe can decode it, else zlib or none."""
+    codec = compress_ports.get(port, compress_ports.get("*", CODEC_NONE))
+    if codec and not caps & (1 << codec):
+        codec = CODEC_ZLIB if caps & (1 << CODEC_ZLIB) else CODEC_NONE
+    return codec
+
+def select_coalescing(enabled=COALESCE):
+    global coalesce_enabled
+    coalesce_enabled = bool(enabled) and hasattr(socket, "TCP_CORK")
+    return coalesce_enabled
+
+def parse_size(value):
+    """Bytes from ``1073741824`` or ``512m`` / ``2g`` (binary units); None if invalid."""
+    text = str(value).strip().lower()
+    if text.endswith("ib"):
+        text = text[:-2]
+    elif text.endswith("b"):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in MEM_UNITS else ""
+    try:
+        size = float(text[:len(text) - len(unit)]) * MEM_UNITS[unit]
+    except ValueError:
+        return None
+    if size < 0 or math.isinf(size) or math.isnan(size):
+        return None
+    return int(size)
+
+def select_memory_budget(value=MEMORY_BUDGET):
+    budget = parse_size(value) if value else 0
+    if budget is None:
+        logger.warning(f"Ignoring memory budget {value}")
+        budget = 0
+    memory.budget = budget
+    return budget
+
+def select_logging(level=LOG_LEVEL, max_size=LOG_MAX_BYTES, backups=LOG_BACKUPS, rotate=LOG_ROTATE):
+    """Log level and file rotation; sizes take the same suffixes as the memory budget."""
+    if level not in LOG_LEVELS:
+        logger.warning(f"Ignoring log level {level}")
+        level = LOG_LEVEL
+    size = parse_size(max_size) if max_size else 0
+    if size is None:
+        logger.warning(f"Ignoring log size {max_size}")
+        size = LOG_MAX_BYTES
+    if rotate not in LOG_ROTATE_PERIODS:
+        logger.warning(f"Ignoring log rotation {rotate}")
+        rotate = LOG_ROTATE
+    logger.setLevel(getattr(logging, level.upper()))
+    file_handler.maxBytes = size
+    file_handler.backupCount = max(1, int(backups))
+    file_handler.period = LOG_ROTATE_PERIODS[rotate]
+    return level
+
+def parse_rate(value):
+    """Bytes per second from ``1250000``, ``500k`` / ``2m`` (bytes) or ``10mbit`` (bits); None if invalid."""
+    text = str(value).strip().lower()
+    bits = text.endswith("bit")
+    if bits:
+        text = text[:-3]
+    elif text.endswith("b"):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in SHAPE_UNITS else ""
+    try:
+        rate = float(text[:len(text) - len(unit)]) * SHAPE_UNITS[unit]
+    except ValueError:
+        return None
+    if rate < 0 or math.isinf(rate) or math.isnan(rate):
+        return None
+    return int(rate / 8 if bits else rate)
+
+def select_shaping(ports=None, client=None, link=None, weights=None):
+    """Load the shaping rules into ``shaper``.
+
+    ``ports`` maps a user port (or ``*`` for every other port) to a rate, as
+    ``{"443": "10mbit"}`` or ``"443=10mbit,*=50mbit"``; ``client`` limits each
+    client IP and ``link`` the whole bridge link. ``weights`` (``{"22": 4}``)
+    gives ports a bigger share when streams queue. Rates go through ``parse_rate``.
+    """
+    if isinstance(ports, str):
+        ports = dict(item.split("=", 1) for item in ports.split(",") if "=" in item)
+    port_rates = {}
+    for port, rate in (ports or {}).items():
+        port = str(port).strip()
+        parsed = parse_rate(rate)
+        if parsed is None or not (port == "*" or port.isdigit()):
+            logger.warning(f"Ignoring shaping setting {port}={rate}")
+            continue
+        port_rates[port if port == "*" else int(port)] = parsed
+    limits = []
+    for name, rate in (("client", client), ("link", link)):
+        parsed = parse_rate(rate) if rate else 0
+        if parsed is None:
+            logger.warning(f"Ignoring {name} shaping rate {rate}")
+            parsed = 0
+        limits.append(parsed)
+    port_weights = {}
+    for port, weight in (weights or {}).items():
+        try:
+            port_weights[int(port)] = max(1, int(weight))
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring shaping weight {port}={weight}")
+    shaper.configure(port_rates, *limits, port_weights)
+    return shaper
+
+def run_async(main):
+    """asyncio.run() on the selected loop engine."""
+    if _loop_factory is None:
+        return asyncio.run(main)
+    with asyncio.Runner(loop_factory=_loop_factory) as runner:
+        return runner.run(main)
+
+cli_args = None
+inherited_listeners = {}
+handoff_ready_fd = None
+handed_over = False
+
+def adopt_listeners():
+    """Take over listening sockets from systemd (LISTEN_FDS) or an upgrading parent.
+
+    Sockets are keyed by port (UDP ones by ``udp_key(port)``) and claimed by
+    ``listen()`` or ``listen_datagram()``; whatever is still unclaimed after
+    startup is closed by ``release_listeners()``.
+    """
+    global handoff_ready_fd
+    fds = []
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        fds = range(3, 3 + int(os.environ.get("LISTEN_FDS", "0")))
+    elif os.environ.get(HANDOFF_ENV):
+        fds = [int(fd) for fd in os.environ[HANDOFF_ENV].split(",")]
+    if os.environ.get(HANDOFF_READY_ENV):
+        handoff_ready_fd = int(os.environ[HANDOFF_READY_ENV])
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", HANDOFF_ENV, HANDOFF_READY_ENV):
+        os.environ.pop(name, None)
+    for fd in fds:
+        try:
+            sock = socket.socket(fileno=fd)
+        except OSError as e:
+            logger.warning(f"Ignoring inherited fd {fd}: {e}")
+            continue
+        if sock.type not in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+            logger.warning(f"Ignoring inherited fd {fd}: not a TCP or UDP socket")
+            sock.close()
+            continue
+        sock.setblocking(False)
+        port = sock.getsockname()[1]
+        inherited_listeners[udp_key(port) if sock.type == socket.SOCK_DGRAM else port] = sock
+    if inherited_listeners:
+        logger.info(f"Inherited listeners on ports {', '.join(map(port_label, sorted(inherited_listeners)))}")
+    return inherited_listeners
+
+async def listen(handler, host, port, **kwargs):
+    """``asyncio.start_server`` on the inherited listener for ``port`` when there is one."""
+    sock = inherited_listeners.pop(port, None)
+    if sock is not None:
+        bound = sock.getsockname()[0]
+        if bound == host or {bound, host} <= {"0.0.0.0", "::"}:
+            kwargs.pop("reuse_port", None)
+            return await asyncio.start_server(handler, sock=sock, **kwargs)
+        sock.close()
+    return await asyncio.start_server(handler, host, port, **kwargs)
+
+async def listen_datagram(protocol, host, port, reuse_port=False):
+    """Serve UDP ``port`` with ``protocol``, on the inherited socket when there is one."""
+    loop = asyncio.get_running_loop()
+    sock = inherited_listeners.pop(udp_key(port), None)
+    if sock is not None:
+        bound = sock.getsockname()[0]
+        if bound == host or {bound, host} <= {"0.0.0.0", "::"}:
+            await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+            return protocol
+        sock.close()
+    await loop.create_datagram_endpoint(lambda: protocol, local_addr=(host, port), reuse_port=reuse_port)
+    return protocol
+
+async def bind_all(ports, bind, limit=PORT_APPLY_CONCURRENCY):
+    """Run ``bind(port)`` for ``ports``, ``limit`` at a time; results (or exceptions) in order.
+
+    If the caller is cancelled, listeners that were already bound are closed
+    before the cancellation propagates, so nothing is left half-applied.
+    """
+    gate = asyncio.Semaphore(limit)
+
+    async def bind_one(port):
+        async with gate:
+            return await bind(port)
+
+    binds = [asyncio.ensure_future(bind_one(p)) for p in ports]
+    try:
+        return await asyncio.gather(*binds, return_exceptions=True)
+    except asyncio.CancelledError:
+        for task in binds:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                task.result().close()
+        raise
+
+def release_listeners():
+    """Close inherited listeners the current profile does not use."""
+    for port, sock in inherited_listeners.items():
+        logger.info(f"Closing unused inherited listener on port {port_label(port)}")
+        sock.close()
+    inherited_listeners.clear()
+
+def sd_notify(state):
+    """Send ``state`` to systemd's notify socket (``Type=notify`` units); a no-op elsewhere."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as e:
+        logger.debug("sd_notify failed: %s", e)
+
+def handoff_ready(notify=True):
+    """Tell systemd and an upgrading parent that this process serves now, so the parent can drain."""
+    global handoff_ready_fd
+    if notify:
+        sd_notify("READY=1")
+    if handoff_ready_fd is None:
+        return
+    try:
+        if notify:
+            os.write(handoff_ready_fd, b"1")
+    except OSError:
+        pass
+    os.close(handoff_ready_fd)
+    handoff_ready_fd = None
 
 class BeautifulUI:
     @staticmethod
@@ -271,6 +935,8 @@ class ServerDetector:
         
     async def ensure_session(self):
         if not self.session:
+            # Imported here so tunnel startup never pays for aiohttp.
+            import aiohttp
             self.session = aiohttp.ClientSession(headers={"Accept": "application/json"})
     
     async def close(self):
@@ -624,25 +1290,712 @@ def optimize():
 async def tune(writer):
     sock = writer.get_extra_info("socket")
     if sock:
+        size = memory.sock_size()
         try:
             sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUFFER)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except Exception as e:
+            logger.debug("Tune failed: %s", e)
+
+async def tune_bridge(writer):
+    """Keepalive and user-timeout settings for Europe <-> Iran bridge sockets."""
+    await tune(writer)
+    sock = writer.get_extra_info("socket")
+    if not sock:
+        return
+    options = [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        (socket.IPPROTO_TCP, getattr(socket, "TCP_KEEPIDLE", None), BRIDGE_KEEPALIVE_IDLE),
+        (socket.IPPROTO_TCP, getattr(socket, "TCP_KEEPINTVL", None), BRIDGE_KEEPALIVE_INTERVAL),
+        (socket.IPPROTO_TCP, getattr(socket, "TCP_KEEPCNT", None), BRIDGE_KEEPALIVE_COUNT),
+        (socket.IPPROTO_TCP, getattr(socket, "TCP_USER_TIMEOUT", None), BRIDGE_USER_TIMEOUT * 1000),
+    ]
+    for level, option, value in options:
+        if option is None:
+            continue
+        try:
+            sock.setsockopt(level, option, value)
+        except Exception as e:
+            logger.debug("Bridge tune failed: %s", e)
+
+def auth_token(key_hash, channel, nonce):
+    return hmac.new(key_hash, channel + nonce, hashlib.sha256).digest()
+
+async def auth_challenge(reader, writer, key_hash, channel):
+    """Iran side: send a fresh nonce and check Europe's answer.
+
+    Returns None when the peer closed without sending anything (a port probe).
+    A probe that closes with our nonce unread resets instead, and counts the same.
+    """
+    nonce = secrets.token_bytes(AUTH_NONCE)
+    writer.write(nonce)
+    try:
+        token = await asyncio.wait_for(reader.readexactly(AUTH_TOKEN), timeout=AUTH_TIMEOUT)
+    except asyncio.IncompleteReadError as e:
+        return False if e.partial else None
+    except ConnectionResetError:
+        # Whatever arrived before the reset is still buffered.
+        return False if reader._buffer else None
+    except (asyncio.TimeoutError, OSError):
+        return False
+    return hmac.compare_digest(token, auth_token(key_hash, channel, nonce))
+
+async def auth_answer(reader, writer, key_hash, channel):
+    """Europe side: answer Iran's challenge on a fresh connection."""
+    nonce = await asyncio.wait_for(reader.readexactly(AUTH_NONCE), timeout=CONN_TIMEOUT)
+    writer.write(auth_token(key_hash, channel, nonce))
+
+class PortStats:
+    """Per-port stream and byte counters; ``bytes`` is [in, out] seen from the client."""
+
+    __slots__ = ("active", "total", "bytes", "codec", "segments", "throttled", "rate", "sampled")
+
+    def __init__(self):
+        self.active = 0
+        self.total = 0
+        self.bytes = [0, 0]
+        # Compressed streams only: [payload bytes, bridge bytes, codec seconds].
+        self.codec = [0, 0, 0.0]
+        # Bridge socket TCP_INFO deltas: [data segments sent, bytes acked].
+        self.segments = [0, 0]
+        # Shaping: seconds streams waited for a grant, and the smoothed
+        # bytes/second per direction as of the last ``Metrics.sample_rates``.
+        self.throttled = [0.0, 0.0]
+        self.rate = [0.0, 0.0]
+        self.sampled = [0, 0]
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=METRICS_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Process-wide counters, rendered in the Prometheus text format.
+
+    Everything runs on the event loop thread, so the hot path only bumps
+    plain ints; gauges are callables sampled at scrape time.
+    """
+
+    def __init__(self):
+        self.listen_port = METRICS_PORT
+        self.bind = METRICS_BIND
+        self.started = time.time()
+        self.ports = {}
+        self.counters = {}
+        self.gauges = {}
+        self.families = {}
+        self.histograms = {}
+        self.sampled_at = time.monotonic()
+
+    def port(self, p):
+        stats = self.ports.get(p)
+        if stats is None:
+            stats = self.ports[p] = PortStats()
+        return stats
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def sample_rates(self):
+        """Fold the bytes moved since the last call into each port's rate."""
+        now = time.monotonic()
+        elapsed = now - self.sampled_at
+        self.sampled_at = now
+        if elapsed <= 0:
+            return
+        for stats in self.ports.values():
+            for direction in (0, 1):
+                moved = stats.bytes[direction] - stats.sampled[direction]
+                stats.sampled[direction] = stats.bytes[direction]
+                stats.rate[direction] += SHAPE_RATE_EWMA * (moved / elapsed - stats.rate[direction])
+
+    def observe(self, name, value):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        hist.observe(value)
+
+    def gauge(self, name, fn, kind="gauge"):
+        self.gauges[name] = (fn, kind)
+
+    def family(self, name, fn, kind="gauge"):
+        """Labelled gauge: ``fn`` returns (label text, value) pairs at scrape time."""
+        self.families[name] = (fn, kind)
+
+    def render(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        for name, (fn, kind) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        for name, (fn, kind) in sorted(self.families.items()):
+            try:
+                samples = list(fn())
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [f"{name}{{{labels}}} {value}" for labels, value in samples]
+        for name, hist in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(hist.bounds, hist.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [
+                f'{name}_bucket{{le="+Inf"}} {hist.count}',
+                f"{name}_sum {hist.sum:.6f}",
+                f"{name}_count {hist.count}",
+            ]
+        # UDP ports carry their own series, labelled like "443/udp".
+        ports = [(port_label(p), st) for p, st in sorted(self.ports.items())]
+        if ports:
+            lines.append("# TYPE blutunnel_port_streams_active gauge")
+            lines += [f'blutunnel_port_streams_active{{port="{p}"}} {st.active}' for p, st in ports]
+            lines.append("# TYPE blutunnel_port_streams_total counter")
+            lines += [f'blutunnel_port_streams_total{{port="{p}"}} {st.total}' for p, st in ports]
+            lines.append("# TYPE blutunnel_port_bytes_total counter")
+            for p, st in ports:
+                lines.append(f'blutunnel_port_bytes_total{{port="{p}",direction="in"}} {st.bytes[0]}')
+                lines.append(f'blutunnel_port_bytes_total{{port="{p}",direction="out"}} {st.bytes[1]}')
+            lines.append("# TYPE blutunnel_port_rate_bytes_per_second gauge")
+            for p, st in ports:
+                lines.append(f'blutunnel_port_rate_bytes_per_second{{port="{p}",direction="in"}} {int(st.rate[0])}')
+                lines.append(f'blutunnel_port_rate_bytes_per_second{{port="{p}",direction="out"}} {int(st.rate[1])}')
+            shaped = [(p, st) for p, st in ports if st.throttled[0] or st.throttled[1]]
+            if shaped:
+                lines.append("# TYPE blutunnel_port_throttled_seconds_total counter")
+                for p, st in shaped:
+                    lines.append(f'blutunnel_port_throttled_seconds_total{{port="{p}",direction="in"}} {st.throttled[0]:.6f}')
+                    lines.append(f'blutunnel_port_throttled_seconds_total{{port="{p}",direction="out"}} {st.throttled[1]:.6f}')
+            coded = [(p, st) for p, st in ports if st.codec[0]]
+            if coded:
+                lines.append("# TYPE blutunnel_port_codec_raw_bytes_total counter")
+                lines += [f'blutunnel_port_codec_raw_bytes_total{{port="{p}"}} {st.codec[0]}' for p, st in coded]
+                lines.append("# TYPE blutunnel_port_codec_wire_bytes_total counter")
+                lines += [f'blutunnel_port_codec_wire_bytes_total{{port="{p}"}} {st.codec[1]}' for p, st in coded]
+                lines.append("# TYPE blutunnel_port_codec_seconds_total counter")
+                lines += [f'blutunnel_port_codec_seconds_total{{port="{p}"}} {st.codec[2]:.6f}' for p, st in coded]
+            sent = [(p, st) for p, st in ports if st.segments[0]]
+            if sent:
+                lines.append("# TYPE blutunnel_port_bridge_segments_total counter")
+                lines += [f'blutunnel_port_bridge_segments_total{{port="{p}"}} {st.segments[0]}' for p, st in sent]
+                lines.append("# TYPE blutunnel_port_bridge_segment_bytes_total counter")
+                lines += [f'blutunnel_port_bridge_segment_bytes_total{{port="{p}"}} {st.segments[1]}' for p, st in sent]
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=CONN_TIMEOUT)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            path, _, query = path.partition(b"?")
+            ctype = "text/plain; version=0.0.4; charset=utf-8"
+            if path in (b"/", b"/metrics"):
+                status, body = "200 OK", self.render().encode()
+            elif path == b"/streams":
+                # ?sort=rate|bytes|age|idle&n=N, as JSON for the `top` command.
+                args = urllib.parse.parse_qs(query.decode(errors="replace"))
+                sort = args.get("sort", ["rate"])[0]
+                n = args.get("n", [""])[0]
+                if sort not in STREAMS_SORTS or not n.isdigit() and n:
+                    status, body = "400 Bad Request", b"bad query\n"
+                else:
+                    rows = await registry.top(int(n or STREAMS_TOP), sort)
+                    status, body = "200 OK", (json.dumps(rows) + "\n").encode()
+                    ctype = "application/json"
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {ctype}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
         except Exception as e:
-            logger.debug(f"Tune failed: {e}")
+            logger.debug("Metrics request failed: %s", e)
+        finally:
+            writer.close()
 
-async def pipe(reader, writer, timeout=PIPE_IDLE_TIMEOUT):
+    async def serve(self, worker=None):
+        """Start the metrics listener if a port is configured; returns the server or None."""
+        if not self.listen_port:
+            return None
+        port = self.listen_port + (worker.index if worker is not None else 0)
+        registry.worker = worker.index if worker is not None else None
+        try:
+            # Worker processes share the port with an upgrade's new workers.
+            server = await listen(self._handle, self.bind, port, reuse_port=worker is not None)
+        except OSError as e:
+            logger.error(f"Metrics listener on {self.bind}:{port} failed: {e}")
+            return None
+        logger.info(f"Metrics on http://{self.bind}:{port}/metrics")
+        return server
+
+metrics = Metrics()
+metrics.gauge("blutunnel_start_time_seconds", lambda: int(metrics.started))
+
+def tcp_info(sock):
+    """Raw TCP_INFO of ``sock``, or None where the kernel does not provide it."""
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+    except (OSError, ValueError):
+        # ValueError: uvloop's socket wrapper once its transport has closed the fd.
+        return None
+    return info if len(info) >= TCP_INFO_SIZE else None
+
+def tcp_rtt(writer):
+    """Smoothed RTT of a stream's socket in seconds, or None."""
+    info = tcp_info(writer.get_extra_info("socket"))
+    if info is None:
+        return None
+    rtt = TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0]
+    return rtt / 1e6 if rtt else None
+
+def tcp_moved(writer):
+    """Bytes acked plus bytes received on a stream's socket so far, or None."""
+    info = tcp_info(writer.get_extra_info("socket"))
+    if info is None:
+        return None
+    return (
+        TCP_INFO_BYTES_ACKED.unpack_from(info, TCP_INFO_BYTES_ACKED_OFFSET)[0]
+        + TCP_INFO_BYTES_RECEIVED.unpack_from(info, TCP_INFO_BYTES_RECEIVED_OFFSET)[0]
+    )
+
+class StreamRecord:
+    """One live user stream in ``registry``.
+
+    Nothing here changes while the stream runs: ``local`` is the stream's
+    socket on this host (the user's on Iran, the target's on Europe) and
+    ``read`` tells whether its received bytes are the stream's "in"
+    direction, as in PortStats.bytes.
+    """
+
+    __slots__ = ("sid", "port", "client", "bridge", "started", "local", "read")
+
+    def __init__(self, sid, port, client, bridge, local, read):
+        self.sid = sid
+        self.port = port
+        self.client = client
+        self.bridge = bridge
+        self.started = time.time()
+        self.local = local
+        self.read = read
+
+    def counters(self):
+        """(bytes in, bytes out, seconds idle) as of now; None once the socket is gone."""
+        local = self.local
+        if isinstance(local, DatagramStream):
+            received, sent = local.received, local.sent
+            idle = time.monotonic() - local.last_active
+        else:
+            info = tcp_info(local.get_extra_info("socket"))
+            if info is None:
+                return None
+            received = TCP_INFO_BYTES_RECEIVED.unpack_from(info, TCP_INFO_BYTES_RECEIVED_OFFSET)[0]
+            sent = TCP_INFO_BYTES_ACKED.unpack_from(info, TCP_INFO_BYTES_ACKED_OFFSET)[0]
+            if self.read:
+                # Target sockets are ours to connect, and bytes_acked counts the SYN.
+                sent = max(0, sent - 1)
+            idle = min(
+                TCP_INFO_LAST_DATA.unpack_from(info, TCP_INFO_LAST_DATA_RECV_OFFSET)[0],
+                TCP_INFO_LAST_DATA.unpack_from(info, TCP_INFO_LAST_DATA_SENT_OFFSET)[0],
+            ) / 1000
+        return (received, sent, idle) if self.read == 0 else (sent, received, idle)
+
+class StreamRegistry:
+    """Live user streams, for ``top``; costs one dict insert and pop per stream."""
+
+    def __init__(self):
+        self.records = {}
+        self.next_sid = 1
+        self.worker = None
+
+    def add(self, port, local, bridge, read=0):
+        """Register a stream by its port key and local writer; returns the record for ``remove``.
+
+        ``read`` is 0 where ``local`` faces the client (Iran) and 1 where it
+        faces the target (Europe, which has no client address).
+        """
+        peer = local.get_extra_info("peername") if read == 0 else None
+        record = StreamRecord(self.next_sid, port, peer[0] if peer else None, bridge, local, read)
+        self.next_sid += 1
+        self.records[record.sid] = record
+        return record
+
+    def remove(self, record):
+        if record is not None:
+            self.records.pop(record.sid, None)
+
+    async def top(self, n=STREAMS_TOP, sort="rate"):
+        """The ``n`` heaviest streams as dicts, sorted by ``sort`` (one of STREAMS_SORTS)."""
+        now = time.time()
+        first = {sid: r.counters() for sid, r in list(self.records.items())}
+        elapsed = 0
+        if sort == "rate":
+            started = time.monotonic()
+            await asyncio.sleep(STREAMS_RATE_WINDOW)
+            elapsed = time.monotonic() - started
+        rows = []
+        for sid, before in first.items():
+            record = self.records.get(sid)
+            if record is None or before is None:
+                continue
+            after = record.counters() if elapsed else before
+            if after is None:
+                continue
+            rows.append({
+                "id": sid if self.worker is None else f"{self.worker}.{sid}",
+                "port": port_label(record.port),
+                "client": record.client,
+                "bridge": record.bridge,
+                "age": round(now - record.started, 1),
+                "in": after[0],
+                "out": after[1],
+                "rate": round((after[0] + after[1] - before[0] - before[1]) / elapsed) if elapsed else 0,
+                "idle": round(after[2], 1),
+            })
+        return sort_streams(rows, sort)[:n]
+
+def sort_streams(rows, sort):
+    """Heaviest first: highest rate or byte count, oldest, or longest idle."""
+    if sort == "bytes":
+        return sorted(rows, key=lambda row: row["in"] + row["out"], reverse=True)
+    return sorted(rows, key=lambda row: row[sort], reverse=True)
+
+registry = StreamRegistry()
+metrics.gauge("blutunnel_streams_registered", lambda: len(registry.records))
+
+class Coalescer:
+    """Adaptive TCP_CORK on the bridge socket of one relay.
+
+    Engines call ``before_write`` for bytes headed into the bridge and
+    ``reply.before_write`` for bytes headed back to the other side, so
+    request/response traffic never counts as a burst. Works on a dup of the
+    socket, so it also reads the socket's TCP_INFO (segments sent, bytes
+    acked) when the relay ends, after the transport has let go of its fd.
+    """
+
+    __slots__ = ("loop", "sock", "enabled", "last_small", "corked_at", "timer", "start", "reply")
+
+    def __init__(self, loop, sock, enabled=True):
+        self.loop = loop
+        self.sock = socket.socket(fileno=os.dup(sock.fileno()))
+        # Disabled coalescers only collect the TCP_INFO counters.
+        self.enabled = enabled
+        self.last_small = float("-inf")
+        self.corked_at = 0.0
+        self.timer = None
+        self.start = self._tcp_info()
+        self.reply = _CoalescerReply(self)
+
+    def _tcp_info(self):
+        info = tcp_info(self.sock)
+        if info is None:
+            return None
+        return (
+            TCP_INFO_DATA_SEGS_OUT.unpack_from(info, TCP_INFO_DATA_SEGS_OUT_OFFSET)[0],
+            TCP_INFO_BYTES_ACKED.unpack_from(info, TCP_INFO_BYTES_ACKED_OFFSET)[0],
+            TCP_INFO_BYTES_RECEIVED.unpack_from(info, TCP_INFO_BYTES_RECEIVED_OFFSET)[0],
+        )
+
+    def before_write(self, n):
+        if not self.enabled or n >= COALESCE_SMALL_WRITE or self.timer is not None:
+            return
+        now = self.loop.time()
+        if now - self.last_small <= COALESCE_BURST_GAP:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            except OSError:
+                return
+            self.corked_at = now
+            self.timer = self.loop.call_later(COALESCE_DEADLINE, self.flush)
+            metrics.inc("blutunnel_coalesce_bursts_total")
+        self.last_small = now
+
+    def flush(self):
+        self.timer = None
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        except OSError:
+            return
+        metrics.observe("blutunnel_coalesce_flush_seconds", self.loop.time() - self.corked_at)
+
+    def close(self, stats):
+        """Stop corking and count the segments; returns the bytes the bridge moved both ways."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.flush()
+        end = self._tcp_info()
+        self.sock.close()
+        if self.start is None or end is None:
+            return 0
+        stats.segments[0] += end[0] - self.start[0]
+        stats.segments[1] += end[1] - self.start[1]
+        return end[1] - self.start[1] + end[2] - self.start[2]
+
+class _CoalescerReply:
+    __slots__ = ("cork",)
+
+    def __init__(self, cork):
+        self.cork = cork
+
+    def before_write(self, n):
+        self.cork.last_small = float("-inf")
+
+class TokenBucket:
+    """Byte budget refilled at ``rate`` per second, shared by the lanes of one port, client or link.
+
+    Tokens may run one grant into debt. A lane that asks while the bucket is in
+    debt, or while others already queue, waits its turn; a single loop timer
+    grants the queue in order as tokens come back. A rate of 0 grants at once.
+    """
+
+    __slots__ = ("loop", "key", "rate", "tokens", "stamp", "waiters", "timer", "users")
+
+    def __init__(self, loop, key, rate):
+        self.loop = loop
+        self.key = key
+        self.rate = rate
+        self.tokens = self.burst
+        self.stamp = loop.time()
+        self.waiters = collections.deque()
+        self.timer = None
+        self.users = 0
+
+    @property
+    def burst(self):
+        return max(self.rate * SHAPE_BURST, SHAPE_QUANTUM)
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def request(self, lane):
+        """Charge one grant of ``lane.quantum`` and return True, or queue the lane."""
+        if not self.waiters:
+            self._refill()
+            if self.tokens >= 0 or not self.rate:
+                self.tokens -= lane.quantum
+                return True
+        self.waiters.append(lane)
+        self._arm()
+        return False
+
+    def _arm(self):
+        if self.timer is None and self.waiters:
+            delay = -self.tokens / self.rate if self.rate and self.tokens < 0 else 0
+            self.timer = self.loop.call_later(delay, self._grant)
+
+    def _grant(self):
+        self.timer = None
+        self._refill()
+        while self.waiters and (self.tokens >= 0 or not self.rate):
+            lane = self.waiters.popleft()
+            self.tokens -= lane.quantum
+            lane.granted()
+        self._arm()
+
+    def cancel(self, lane):
+        try:
+            self.waiters.remove(lane)
+        except ValueError:
+            pass
+
+    def refund(self, n):
+        self.tokens = min(self.burst, self.tokens + n)
+
+class ShapedLane:
+    """One direction of a shaped stream.
+
+    Engines ``consume`` the bytes they move and ask ``ready()`` before the
+    next read. The lane's credit comes in grants taken from each of its
+    buckets in turn (port, client, link), so a stream only reads once every
+    limit allows it; ``throttled`` time lands in the port's stats.
+    """
+
+    __slots__ = ("shaper", "buckets", "quantum", "credit", "stage", "since", "on_ready", "future", "stats", "direction")
+
+    def __init__(self, shaper, buckets, weight, stats, direction):
+        self.shaper = shaper
+        self.buckets = buckets
+        self.quantum = SHAPE_QUANTUM * weight
+        self.credit = 0
+        # Buckets before ``stage`` already charged the grant being assembled.
+        self.stage = 0
+        self.since = None
+        self.on_ready = None
+        self.future = None
+        self.stats = stats
+        self.direction = direction
+
+    def consume(self, n):
+        self.credit -= n
+
+    def _acquire(self):
+        while self.credit <= 0:
+            if self.stage == len(self.buckets):
+                self.stage = 0
+                self.credit += self.quantum
+            elif self.buckets[self.stage].request(self):
+                self.stage += 1
+            else:
+                return False
+        return True
+
+    def ready(self, on_ready):
+        """True if the lane may read now; otherwise ``on_ready()`` runs once it may."""
+        if self.credit > 0 or self._acquire():
+            return True
+        self.on_ready = on_ready
+        if self.since is None:
+            self.since = self.buckets[0].loop.time()
+        return False
+
+    async def wait(self):
+        """Coroutine form of ``ready()``; also returns once the lane is cancelled."""
+        if self.credit > 0:
+            return
+        self.future = asyncio.get_running_loop().create_future()
+        try:
+            if not self.ready(self._wake):
+                await self.future
+        finally:
+            self.future = None
+
+    def _wake(self):
+        if self.future is not None and not self.future.done():
+            self.future.set_result(None)
+
+    def granted(self):
+        self.stage += 1
+        if not self._acquire():
+            return
+        self.stats.throttled[self.direction] += self.buckets[0].loop.time() - self.since
+        self.since = None
+        on_ready, self.on_ready = self.on_ready, None
+        if on_ready is not None:
+            on_ready()
+
+    def cancel(self):
+        """Leave the bucket queue; the lane stays usable for accounting."""
+        self.on_ready = None
+        if self.since is not None and self.stage < len(self.buckets):
+            self.buckets[self.stage].cancel(self)
+        self.since = None
+        self._wake()
+
+    def close(self):
+        self.cancel()
+        for index, bucket in enumerate(self.buckets):
+            # Hand back unspent credit and any half-assembled grant.
+            bucket.refund(max(self.credit, 0) + (self.quantum if index < self.stage else 0))
+        self.shaper.release(self.buckets)
+        self.buckets = ()
+
+class Shaper:
+    """Shaping rules and their live buckets; ``flow()`` hands each stream its lanes.
+
+    Rates are bytes per second and 0 means unlimited. ``configure`` updates the
+    buckets in place, so a reload re-paces streams that are already running.
+    """
+
+    def __init__(self):
+        self.ports = {}
+        self.client = 0
+        self.link = 0
+        self.weights = {}
+        self.buckets = {}
+
+    @property
+    def enabled(self):
+        return bool(self.ports or self.client or self.link)
+
+    def configure(self, ports, client, link, weights):
+        self.ports = ports
+        self.client = client
+        self.link = link
+        self.weights = weights
+        for key, bucket in self.buckets.items():
+            bucket.rate = self._rate(key)
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+            if bucket.timer is not None:
+                bucket.timer.cancel()
+                bucket.timer = None
+            bucket._arm()
+
+    def _rate(self, key):
+        kind, name, _direction = key
+        if kind == "port":
+            return self.ports.get(name, self.ports.get("*", 0))
+        return self.client if kind == "client" else self.link
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(asyncio.get_running_loop(), key, self._rate(key))
+        bucket.users += 1
+        return bucket
+
+    def release(self, buckets):
+        for bucket in buckets:
+            bucket.users -= 1
+            if not bucket.users and self.buckets.get(bucket.key) is bucket:
+                del self.buckets[bucket.key]
+
+    def flow(self, port, client, stats):
+        """The (in, out) lanes for a stream of ``port`` from ``client``, or None if unlimited."""
+        if not self.enabled:
+            return None
+        weight = self.weights.get(port, 1)
+        lanes = []
+        for direction in (0, 1):
+            keys = (("port", port, direction), ("client", client, direction), ("link", None, direction))
+            buckets = [self._bucket(key) for key in keys if self._rate(key)]
+            lanes.append(ShapedLane(self, buckets, weight, stats, direction) if buckets else None)
+        return tuple(lanes) if any(lanes) else None
+
+shaper = Shaper()
+
+async def pipe(reader, writer, timeout=PIPE_IDLE_TIMEOUT, stats=None, direction=0, coder=None, cork=None, lane=None):
     try:
         while True:
-            data = await asyncio.wait_for(reader.read(BUFFER_SIZE), timeout=timeout)
+            size = BUFFER_SIZE
+            if lane is not None:
+                await lane.wait()
+                size = min(size, lane.credit)
+            chunk = coder.read(reader, size) if coder is not None else reader.read(size)
+            data = await asyncio.wait_for(chunk, timeout=timeout)
             if not data:
                 break
+            if cork is not None:
+                cork.before_write(len(data))
             writer.write(data)
+            if stats is not None:
+                stats.bytes[direction] += len(data)
+            if lane is not None:
+                lane.consume(len(data))
             await asyncio.wait_for(writer.drain(), timeout=timeout)
     except asyncio.TimeoutError:
         logger.debug("Pipe timeout")
     except Exception as e:
-        logger.debug(f"Pipe error: {e}")
+        logger.debug("Pipe error: %s", e)
     finally:
         if not writer.is_closing():
             writer.close()
@@ -651,164 +2004,2506 @@ async def pipe(reader, writer, timeout=PIPE_IDLE_TIMEOUT):
             except:
                 pass
 
-async def get_xray_ports_safe():
-    ports = set()
-    try:
-        process = await asyncio.create_subprocess_exec(
-            'ss', '-tlnp',
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, _ = await process.communicate()
-        import re
-        for line in stdout.decode().splitlines():
-            if 'xray' in line:
-                found = re.findall(r":(\d+)", line)
-                for p in found:
-                    p = int(p)
-                    if 1 <= p <= 65535:
-                        ports.add(p)
-    except Exception as e:
-        logger.error(f"Error getting ports: {e}")
-    return ports
+class _SpliceFlow:
+    """One direction of a splice relay, driven by loop reader/writer callbacks.
 
-async def start_europe(key):
-    BeautifulUI.print_banner()
-    BeautifulUI.print_section("Europe Mode", "E")
-    iran_ip = BeautifulUI.input_with_style("Iran IP", "I")
-    if not validate_ip(iran_ip):
-        BeautifulUI.print_error("Invalid IP address")
-        input(f"{Colors.GRAY}Press Enter...{Colors.END}")
-        return
-    try:
-        bridge_p = int(BeautifulUI.input_with_style("Tunnel Bridge Port", "B"))
-        sync_p = int(BeautifulUI.input_with_style("Port Sync Port", "S"))
-        if not (validate_port(bridge_p) and validate_port(sync_p)):
-            BeautifulUI.print_error("Invalid port number")
-            input(f"{Colors.GRAY}Press Enter...{Colors.END}")
+    At EOF the flow half-closes its destination and reports ``on_done(None)``;
+    the relay keeps the other direction running until it ends as well.
+    """
+
+    __slots__ = (
+        "loop", "src", "dst", "pipe_r", "pipe_w", "in_pipe", "prefix",
+        "reading", "writing", "last_active", "on_done", "stats", "direction", "cork", "lane", "eof",
+    )
+
+    def __init__(self, loop, src, dst, prefix, on_done, stats, direction, cork=None, lane=None):
+        self.loop = loop
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, memory.pipe_size())
+        except (AttributeError, OSError):
+            pass
+        self.in_pipe = 0
+        self.prefix = memoryview(prefix) if prefix else None
+        self.reading = False
+        self.writing = False
+        self.last_active = loop.time()
+        self.on_done = on_done
+        self.stats = stats
+        self.direction = direction
+        self.cork = cork
+        self.lane = lane
+        self.eof = False
+        stats.bytes[direction] += len(prefix)
+        if cork is not None and prefix:
+            cork.before_write(len(prefix))
+        if lane is not None:
+            lane.consume(len(prefix))
+
+    def start(self):
+        if self.prefix is not None:
+            self._flush()
+        else:
+            self._want_read()
+
+    def _want_read(self):
+        if self.writing:
+            self.loop.remove_writer(self.dst)
+            self.writing = False
+        if self.lane is not None and not self.lane.ready(self._want_read):
+            # Throttled: the lane calls back once its buckets grant it.
+            if self.reading:
+                self.loop.remove_reader(self.src)
+                self.reading = False
             return
-    except ValueError:
-        BeautifulUI.print_error("Port must be a number")
-        input(f"{Colors.GRAY}Press Enter...{Colors.END}")
-        return
-    save_tunnel_profile("europe", {
-        "iran_ip": iran_ip,
-        "bridge_port": bridge_p,
-        "sync_port": sync_p,
-    })
-    running = True
-    start_time = time.time()
-    connection_count = 0
-    last_sync_error_log = 0.0
-    def get_xray_ports():
-        ports = set()
+        if not self.reading:
+            self.loop.add_reader(self.src, self._on_readable)
+            self.reading = True
+
+    def _want_write(self):
+        if self.reading:
+            self.loop.remove_reader(self.src)
+            self.reading = False
+        if not self.writing:
+            self.loop.add_writer(self.dst, self._flush)
+            self.writing = True
+
+    def _on_readable(self):
+        size = SPLICE_PIPE_SIZE if self.lane is None else min(SPLICE_PIPE_SIZE, self.lane.credit)
         try:
-            import re
-            output = subprocess.check_output("ss -tlnp", shell=True, stderr=subprocess.DEVNULL).decode(errors="ignore")
-            for line in output.splitlines():
-                if "xray" not in line.lower():
+            n = os.splice(self.src, self.pipe_w, size, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.on_done(e)
+            return
+        if n == 0:
+            # Reads only resume once the pipe is flushed, so nothing is left to send.
+            self.eof = True
+            self.stop()
+            shutdown_write(self.dst)
+            self.on_done(None)
+            return
+        self.in_pipe += n
+        self.stats.bytes[self.direction] += n
+        if self.lane is not None:
+            self.lane.consume(n)
+        self.last_active = self.loop.time()
+        if self.cork is not None:
+            self.cork.before_write(n)
+        self._flush()
+
+    def _flush(self):
+        try:
+            while self.prefix is not None:
+                n = os.write(self.dst, self.prefix)
+                self.prefix = self.prefix[n:] if n < len(self.prefix) else None
+            while self.in_pipe:
+                self.in_pipe -= os.splice(self.pipe_r, self.dst, self.in_pipe, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            self._want_write()
+            return
+        except OSError as e:
+            self.on_done(e)
+            return
+        self._want_read()
+
+    def stop(self):
+        if self.lane is not None:
+            self.lane.cancel()
+        if self.reading:
+            self.loop.remove_reader(self.src)
+            self.reading = False
+        if self.writing:
+            self.loop.remove_writer(self.dst)
+            self.writing = False
+
+    def close(self):
+        self.stop()
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+def shutdown_write(fd):
+    """Send FIN on a raw socket fd the caller keeps owning."""
+    sock = socket.socket(fileno=fd)
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        sock.detach()
+
+def splice_capable(writer):
+    if not SPLICE_ENABLED:
+        return False
+    sock = writer.get_extra_info("socket")
+    transport = writer.transport
+    return (
+        sock is not None
+        and sock.family in (socket.AF_INET, socket.AF_INET6)
+        and sock.type == socket.SOCK_STREAM
+        and writer.get_extra_info("sslcontext") is None
+        and hasattr(transport, "pause_reading")
+        and transport.get_write_buffer_size() == 0
+    )
+
+async def splice_relay(reader_a, writer_a, reader_b, writer_b, timeout=PIPE_IDLE_TIMEOUT, stats=None, corks=(None, None), lanes=(None, None)):
+    loop = asyncio.get_running_loop()
+    if stats is None:
+        stats = PortStats()
+    writer_a.transport.pause_reading()
+    writer_b.transport.pause_reading()
+    # Let any read callback already queued this iteration land in the readers.
+    await asyncio.sleep(0)
+    # Bytes the StreamReaders buffered before the handoff go out first.
+    prefix_a = bytes(reader_a._buffer)
+    reader_a._buffer.clear()
+    prefix_b = bytes(reader_b._buffer)
+    reader_b._buffer.clear()
+    # The transports keep ownership of their fds, so the relay works on dups.
+    fd_a = os.dup(writer_a.get_extra_info("socket").fileno())
+    fd_b = os.dup(writer_b.get_extra_info("socket").fileno())
+    done = loop.create_future()
+    def finish(exc):
+        # A clean EOF only ends the relay once both directions have drained.
+        if exc is None and not all(flow.eof for flow in flows):
+            return
+        if not done.done():
+            done.set_result(exc)
+        # Unregister right away: with uvloop a reset socket's poll handle is
+        # closed in place, and a later callback must not re-arm it.
+        for flow in flows:
+            flow.stop()
+    flows = []
+    # The dups keep the sockets open, so a transport aborted elsewhere (drain,
+    # shutdown) only shows up as its close waiter finishing.
+    closing = [asyncio.ensure_future(writer.wait_closed()) for writer in (writer_a, writer_b)]
+    try:
+        flows.append(_SpliceFlow(loop, fd_a, fd_b, prefix_a, finish, stats, 0, corks[1], lanes[0]))
+        flows.append(_SpliceFlow(loop, fd_b, fd_a, prefix_b, finish, stats, 1, corks[0], lanes[1]))
+        for flow in flows:
+            flow.start()
+        while not done.done():
+            remaining = max(f.last_active for f in flows) + timeout - loop.time()
+            if remaining <= 0:
+                logger.debug("Splice timeout")
+                break
+            await asyncio.wait([done, *closing], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if any(c.done() for c in closing):
+                logger.debug("Splice transport closed")
+                break
+        if done.done() and done.result() is not None:
+            logger.debug("Splice error: %s", done.result())
+    except Exception as e:
+        logger.debug("Splice error: %s", e)
+    finally:
+        # No cancel for ``closing``: that would cancel the transports' shared
+        # close waiters; they finish once the writers below are closed.
+        for flow in flows:
+            flow.close()
+        os.close(fd_a)
+        os.close(fd_b)
+        for writer in (writer_a, writer_b):
+            if not writer.is_closing():
+                writer.close()
+        for writer in (writer_a, writer_b):
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+class BufferPool:
+    """Free list of reusable ``BUFFER_SIZE`` slabs handed out as memoryviews."""
+
+    def __init__(self, slab_size=BUFFER_SIZE, max_free=BUFFER_POOL_MAX):
+        self.slab_size = slab_size
+        self.max_free = max_free
+        self.free = []
+        self.allocated = 0
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self):
+        if self.free:
+            self.hits += 1
+            return self.free.pop()
+        self.misses += 1
+        self.allocated += 1
+        return memoryview(bytearray(self.slab_size))
+
+    def release(self, slab):
+        if len(self.free) < self.max_free:
+            self.free.append(slab)
+        else:
+            self.allocated -= 1
+
+    def lend(self, slab):
+        # The slab now backs data queued in a transport and is left to the GC.
+        self.allocated -= 1
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+buffer_pool = BufferPool()
+metrics.gauge("blutunnel_relay_buffers", lambda: buffer_pool.allocated)
+metrics.gauge("blutunnel_relay_buffer_hits_total", lambda: buffer_pool.hits, "counter")
+metrics.gauge("blutunnel_relay_buffer_misses_total", lambda: buffer_pool.misses, "counter")
+
+def process_rss():
+    """Resident set size of this process in bytes (0 where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def active_streams():
+    return sum(stats.active for stats in metrics.ports.values())
+
+def memory_label(rss, streams):
+    """``"412M (8K/stream)"`` for the stats lines."""
+    per_stream = f" ({rss // streams // 1024}K/stream)" if streams else ""
+    return f"{rss // 1048576}M{per_stream}"
+
+class StatsLine:
+    """The once-a-second stats: a live ``\\r`` line on a terminal, else a plain log line.
+
+    Fields are ``(icon, label, value)``; off a terminal they are logged every
+    STATS_LOG_INTERVAL seconds, so a journal gets no control codes.
+    """
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.live = sys.stdout.isatty()
+        self.logged = time.time()
+
+    def show(self, fields):
+        uptime = int(time.time() - self.start_time)
+        clock = f"{uptime // 3600:02d}:{uptime % 3600 // 60:02d}:{uptime % 60:02d}"
+        if self.live:
+            print(
+                f"\r  {Colors.CYAN}Uptime: {Colors.GREEN}{clock}{Colors.END} "
+                + " ".join(f"{icon} {label}: {Colors.YELLOW}{value}{Colors.END}" for icon, label, value in fields),
+                end="",
+            )
+            return
+        now = time.time()
+        if now - self.logged >= STATS_LOG_INTERVAL:
+            self.logged = now
+            logger.info("Stats: uptime %s, %s", clock, ", ".join(f"{label.lower()} {value}" for _, label, value in fields))
+
+class MemoryLease:
+    """The socket buffers one stream holds against the memory budget."""
+
+    __slots__ = ("socks", "writer", "size", "moved", "sampled", "idle_ticks")
+
+    def __init__(self, socks, writer):
+        self.socks = socks
+        self.writer = writer
+        self.size = MEM_SOCK_MIN
+        self.moved = tcp_moved(writer) or 0
+        self.sampled = time.monotonic()
+        self.idle_ticks = 0
+
+    @property
+    def cost(self):
+        # Send and receive buffer on every socket.
+        return 2 * self.size * len(self.socks)
+
+class MemoryBudget:
+    """Global memory budget for user streams; off while ``budget`` is 0.
+
+    Usage is the process RSS (sampled at most every MEM_TICK) plus the socket
+    buffers leased to live streams, plus MEM_STREAM_OVERHEAD for each stream
+    admitted since the last sample. One loop timer walks the leases in slices
+    of MEM_SLICE, so a pass over 50k streams never stalls the loop in one go.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.leases = set()
+        self.leased = 0
+        self.rss = 0
+        self.rss_at = float("-inf")
+        self.admitted = 0
+        self.refused = 0
+        self.last_refused_log = 0.0
+        self.timer = None
+        # Leases still to sample in the current pass, and the delay between slices.
+        self.pass_queue = collections.deque()
+        self.pass_delay = MEM_TICK
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def sock_size(self):
+        return MEM_SOCK_MIN if self.enabled else SOCK_BUFFER
+
+    def pipe_size(self):
+        return MEM_PIPE_SIZE if self.enabled else SPLICE_PIPE_SIZE
+
+    def sample(self):
+        now = time.monotonic()
+        if now - self.rss_at >= MEM_TICK:
+            self.rss = process_rss()
+            self.rss_at = now
+            self.admitted = 0
+        return self.rss
+
+    def usage(self):
+        return self.sample() + self.leased + self.admitted * MEM_STREAM_OVERHEAD
+
+    def admit(self):
+        """Count a new user stream in, or refuse it (False) when the budget is used up."""
+        if not self.enabled:
+            return True
+        if self.usage() + MEM_STREAM_OVERHEAD + 4 * MEM_SOCK_MIN > self.budget:
+            self.refused += 1
+            metrics.inc("blutunnel_memory_refused_total")
+            now = time.time()
+            if now - self.last_refused_log >= LOG_THROTTLE_SEC:
+                logger.warning(f"Memory budget used up: refusing new connections ({self.refused} so far)")
+                self.last_refused_log = now
+            return False
+        self.admitted += 1
+        return True
+
+    def lease(self, *writers):
+        """Track the TCP sockets of one stream; the first writer's TCP_INFO paces resizing."""
+        if not self.enabled:
+            return None
+        socks = []
+        for writer in writers:
+            sock = writer.get_extra_info("socket")
+            if sock is not None and sock.type == socket.SOCK_STREAM:
+                socks.append(sock)
+        if not socks:
+            return None
+        lease = MemoryLease(socks, writers[0])
+        self.leases.add(lease)
+        self.leased += lease.cost
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(MEM_TICK, self._tick)
+        return lease
+
+    def release(self, lease):
+        if lease is not None and lease in self.leases:
+            self.leases.discard(lease)
+            self.leased -= lease.cost
+
+    def _resize(self, lease, size):
+        grow = 2 * (size - lease.size) * len(lease.socks)
+        if grow > 0 and self.usage() + grow > self.budget:
+            return
+        for sock in lease.socks:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+            except OSError:
+                pass
+        self.leased += grow
+        lease.size = size
+
+    def _sample(self, lease, now):
+        total = tcp_moved(lease.writer)
+        if total is None:
+            return
+        moved = total - lease.moved
+        elapsed = now - lease.sampled
+        lease.moved = total
+        lease.sampled = now
+        if moved >= lease.size * elapsed:
+            lease.idle_ticks = 0
+            if lease.size < SOCK_BUFFER:
+                self._resize(lease, min(lease.size * 2, SOCK_BUFFER))
+        elif moved < MEM_SOCK_MIN * elapsed:
+            lease.idle_ticks += 1
+            if lease.idle_ticks >= MEM_IDLE_TICKS and lease.size > MEM_SOCK_MIN:
+                self._resize(lease, MEM_SOCK_MIN)
+        else:
+            lease.idle_ticks = 0
+
+    def _tick(self):
+        self.timer = None
+        if not self.leases:
+            self.pass_queue.clear()
+            return
+        if not self.pass_queue:
+            # A new pass: its slices are spread evenly over MEM_TICK.
+            self.pass_queue.extend(self.leases)
+            self.pass_delay = MEM_TICK / math.ceil(len(self.pass_queue) / MEM_SLICE)
+        now = time.monotonic()
+        for _ in range(min(MEM_SLICE, len(self.pass_queue))):
+            lease = self.pass_queue.popleft()
+            if lease in self.leases:
+                self._sample(lease, now)
+        self.timer = asyncio.get_running_loop().call_later(self.pass_delay, self._tick)
+
+    def per_stream(self):
+        """RSS divided by the live user streams (0 with none)."""
+        streams = active_streams()
+        return self.sample() // streams if streams else 0
+
+memory = MemoryBudget()
+metrics.gauge("blutunnel_memory_budget_bytes", lambda: memory.budget)
+metrics.gauge("blutunnel_memory_rss_bytes", memory.sample)
+metrics.gauge("blutunnel_memory_leased_bytes", lambda: memory.leased)
+metrics.gauge("blutunnel_memory_rss_per_stream_bytes", memory.per_stream)
+
+class _RelayProtocol(asyncio.BufferedProtocol):
+    """One side of a protocol relay: reads into pooled slabs, writes to the peer.
+
+    ``source`` is the transport this side reads from. It pauses while the
+    peer's write buffer is full (``partner.write_paused``) or while the
+    shaping ``lane`` waits for a grant, and resumes once neither holds.
+    EOF half-closes the peer; the relay closes once both sides reached it.
+    """
+
+    __slots__ = (
+        "relay", "source", "peer", "partner", "slab", "stats", "direction", "cork",
+        "lane", "write_paused", "throttled", "eof",
+    )
+
+    def __init__(self, relay, source, peer, stats, direction, cork=None, lane=None):
+        self.relay = relay
+        self.source = source
+        self.peer = peer
+        self.partner = None
+        self.slab = None
+        self.stats = stats
+        self.direction = direction
+        self.cork = cork
+        self.lane = lane
+        self.write_paused = False
+        self.throttled = False
+        self.eof = False
+
+    def get_buffer(self, sizehint):
+        if self.slab is None:
+            self.slab = buffer_pool.acquire()
+        if self.lane is not None and 0 < self.lane.credit < len(self.slab):
+            return self.slab[:self.lane.credit]
+        return self.slab
+
+    def buffer_updated(self, nbytes):
+        slab = self.slab
+        self.slab = None
+        peer = self.peer
+        if self.cork is not None:
+            self.cork.before_write(nbytes)
+        peer.write(slab[:nbytes])
+        self.stats.bytes[self.direction] += nbytes
+        # Transports may keep a view of unsent bytes instead of copying them,
+        # so only a slab that went out in full goes back to the pool.
+        if peer.get_write_buffer_size():
+            buffer_pool.lend(slab)
+        else:
+            buffer_pool.release(slab)
+        self.relay.last_active = self.relay.loop.time()
+        lane = self.lane
+        if lane is not None:
+            lane.consume(nbytes)
+            if not self.throttled and not lane.ready(self._unthrottle):
+                self.throttled = True
+                self.source.pause_reading()
+
+    def _unthrottle(self):
+        self.throttled = False
+        if not self.partner.write_paused and not self.source.is_closing():
+            self.source.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        peer = self.peer
+        if self.partner.eof or peer.is_closing() or not peer.can_write_eof():
+            self.relay.close()
+            return False
+        # Pass the half-close on and keep relaying the other direction.
+        peer.write_eof()
+        return True
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.peer.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if not self.partner.throttled:
+            self.peer.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.lane is not None:
+            self.lane.cancel()
+        if self.slab is not None:
+            buffer_pool.release(self.slab)
+            self.slab = None
+        if exc is not None:
+            logger.debug("Relay error: %s", exc)
+        self.relay.side_lost()
+
+class ProtocolRelay:
+    """Relays two transports through BufferedProtocols with pooled buffers."""
+
+    def __init__(self, loop, transport_a, transport_b, timeout=PIPE_IDLE_TIMEOUT):
+        self.loop = loop
+        self.transports = (transport_a, transport_b)
+        self.timeout = timeout
+        self.last_active = loop.time()
+        self.open_sides = 2
+        self.done = loop.create_future()
+        self.timer = loop.call_later(timeout, self._check_idle)
+
+    def _check_idle(self):
+        remaining = self.last_active + self.timeout - self.loop.time()
+        if remaining <= 0:
+            logger.debug("Relay timeout")
+            self.close()
+            return
+        self.timer = self.loop.call_later(remaining, self._check_idle)
+
+    def close(self):
+        for transport in self.transports:
+            if not transport.is_closing():
+                transport.close()
+
+    def side_lost(self):
+        self.close()
+        self.open_sides -= 1
+        if self.open_sides == 0 and not self.done.done():
+            self.timer.cancel()
+            self.done.set_result(None)
+
+def protocol_capable(writer):
+    transport = writer.transport
+    return (
+        hasattr(transport, "set_protocol")
+        and hasattr(transport, "pause_reading")
+        and not transport.is_closing()
+    )
+
+async def protocol_relay(reader_a, writer_a, reader_b, writer_b, timeout=PIPE_IDLE_TIMEOUT, stats=None, corks=(None, None), lanes=(None, None)):
+    loop = asyncio.get_running_loop()
+    if stats is None:
+        stats = PortStats()
+    transport_a = writer_a.transport
+    transport_b = writer_b.transport
+    link = ProtocolRelay(loop, transport_a, transport_b, timeout)
+    side_a = _RelayProtocol(link, transport_a, transport_b, stats, 0, corks[1], lanes[0])
+    side_b = _RelayProtocol(link, transport_b, transport_a, stats, 1, corks[0], lanes[1])
+    side_a.partner, side_b.partner = side_b, side_a
+    transport_a.set_protocol(side_a)
+    transport_b.set_protocol(side_b)
+    try:
+        # Bytes the StreamReaders buffered before the handoff go out first.
+        for direction, (reader, peer) in enumerate(((reader_a, transport_b), (reader_b, transport_a))):
+            if reader._buffer:
+                stats.bytes[direction] += len(reader._buffer)
+                if lanes[direction] is not None:
+                    lanes[direction].consume(len(reader._buffer))
+                peer.write(bytes(reader._buffer))
+                reader._buffer.clear()
+        for reader, transport, side in ((reader_a, transport_a, side_a), (reader_b, transport_b, side_b)):
+            if reader.exception() is not None:
+                link.close()
+            elif reader.at_eof():
+                # The stream already saw EOF, so its transport stopped reading.
+                if not side.eof_received():
+                    break
+            elif not transport.is_reading():
+                transport.resume_reading()
+        await link.done
+    except asyncio.CancelledError:
+        link.close()
+        raise
+    except Exception as e:
+        logger.debug("Relay error: %s", e)
+        link.close()
+
+async def relay(reader_a, writer_a, reader_b, writer_b, stats=None, codec=CODEC_NONE, wire="b", shape=None):
+    """Pipe two connections into each other until either side closes.
+
+    Uses the splice(2) engine when both ends are plain TCP sockets, then the
+    BufferedProtocol engine, and falls back to the StreamReader ``pipe()``
+    pair otherwise. ``relay_engine_name`` can pin one of them. ``a`` is the
+    client-facing side for ``stats``; ``wire`` names the bridge side, which
+    gets adaptive coalescing and, with a ``codec``, compressed frames (the
+    ``pipe()`` pair is then always used). ``shape`` is the (a -> b, b -> a)
+    lane pair from ``Shaper.flow``, closed when the relay ends. Returns the
+    bytes the bridge socket moved in both directions according to TCP_INFO
+    (0 where unavailable).
+    """
+    if stats is None:
+        stats = PortStats()
+    stats.active += 1
+    stats.total += 1
+    cork = None
+    corks = (None, None)
+    if hasattr(socket, "TCP_INFO"):
+        sock = (writer_a if wire == "a" else writer_b).get_extra_info("socket")
+        if sock is not None and sock.type == socket.SOCK_STREAM:
+            try:
+                cork = Coalescer(asyncio.get_running_loop(), sock, coalesce_enabled)
+                corks = (cork, cork.reply) if wire == "a" else (cork.reply, cork)
+            except OSError:
+                pass
+    moved = 0
+    engine = relay_engine_name
+    lanes = shape or (None, None)
+    lease = memory.lease(writer_a, writer_b)
+    try:
+        if codec:
+            if wire == "a":
+                a_to_b, b_to_a = _CodecDecoder(codec, stats, 0), _CodecEncoder(codec, stats, 1)
+            else:
+                a_to_b, b_to_a = _CodecEncoder(codec, stats, 0), _CodecDecoder(codec, stats, 1)
+            await asyncio.gather(
+                pipe(reader_a, writer_b, coder=a_to_b, cork=corks[1], lane=lanes[0]),
+                pipe(reader_b, writer_a, coder=b_to_a, cork=corks[0], lane=lanes[1]),
+                return_exceptions=True,
+            )
+        elif engine in ("auto", "splice") and splice_capable(writer_a) and splice_capable(writer_b):
+            await splice_relay(reader_a, writer_a, reader_b, writer_b, stats=stats, corks=corks, lanes=lanes)
+        elif engine != "stream" and protocol_capable(writer_a) and protocol_capable(writer_b):
+            await protocol_relay(reader_a, writer_a, reader_b, writer_b, stats=stats, corks=corks, lanes=lanes)
+        else:
+            await asyncio.gather(
+                pipe(reader_a, writer_b, stats=stats, direction=0, cork=corks[1], lane=lanes[0]),
+                pipe(reader_b, writer_a, stats=stats, direction=1, cork=corks[0], lane=lanes[1]),
+                return_exceptions=True,
+            )
+    finally:
+        stats.active -= 1
+        if cork is not None:
+            moved = cork.close(stats)
+        for lane in lanes:
+            if lane is not None:
+                lane.close()
+        memory.release(lease)
+    return moved
+
+class _CodecEncoder:
+    """Reads raw chunks and returns ``CODEC_FRAME`` frames, compressing adaptively."""
+
+    __slots__ = ("compress", "stats", "direction", "skip", "backoff")
+
+    def __init__(self, codec, stats, direction):
+        if codec == CODEC_ZSTD:
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+            flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            compressor = zlib.compressobj(COMPRESS_ZLIB_LEVEL)
+            flush = zlib.Z_SYNC_FLUSH
+        self.compress = lambda data: compressor.compress(data) + compressor.flush(flush)
+        self.stats = stats
+        self.direction = direction
+        self.skip = 0
+        self.backoff = COMPRESS_SKIP_MIN
+
+    async def read(self, reader, size=BUFFER_SIZE):
+        data = await reader.read(size)
+        if not data:
+            return data
+        stats = self.stats
+        stats.bytes[self.direction] += len(data)
+        stats.codec[0] += len(data)
+        if self.skip or len(data) < COMPRESS_MIN_CHUNK:
+            # Raw frames never touch the compressor, so both ends stay in step.
+            self.skip = max(0, self.skip - 1)
+            stats.codec[1] += CODEC_FRAME.size + len(data)
+            return CODEC_FRAME.pack(len(data)) + data
+        started = time.perf_counter()
+        out = self.compress(data)
+        stats.codec[2] += time.perf_counter() - started
+        stats.codec[1] += CODEC_FRAME.size + len(out)
+        if len(out) > len(data) * COMPRESS_MIN_GAIN:
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, COMPRESS_SKIP_MAX)
+        else:
+            self.backoff = COMPRESS_SKIP_MIN
+        return CODEC_FRAME.pack(CODEC_COMPRESSED | len(out)) + out
+
+class _CodecSink:
+    """Collects one frame's zstd output and gives up past BUFFER_SIZE."""
+
+    __slots__ = ("chunks", "size")
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > BUFFER_SIZE:
+            raise ValueError("codec frame inflates past BUFFER_SIZE")
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+class _CodecDecoder:
+    """Reads ``CODEC_FRAME`` frames and returns the raw payload.
+
+    Frames longer than CODEC_FRAME_MAX or inflating past BUFFER_SIZE (more
+    than any encoder sends) are protocol errors, so a peer cannot make one
+    frame cost more memory than that.
+    """
+
+    __slots__ = ("decompress", "stats", "direction")
+
+    def __init__(self, codec, stats, direction):
+        if codec == CODEC_ZSTD:
+            import zstandard
+            # The stream writer hands output to the sink as it is produced.
+            sink = _CodecSink()
+            writer = zstandard.ZstdDecompressor().stream_writer(sink, write_size=BUFFER_SIZE)
+            def decompress(data):
+                try:
+                    writer.write(data)
+                finally:
+                    data = sink.take()
+                return data
+        else:
+            decompressor = zlib.decompressobj()
+            def decompress(data):
+                out = decompressor.decompress(data, BUFFER_SIZE + 1)
+                if len(out) > BUFFER_SIZE:
+                    raise ValueError("codec frame inflates past BUFFER_SIZE")
+                return out
+        self.decompress = decompress
+        self.stats = stats
+        self.direction = direction
+
+    async def read(self, reader, size=BUFFER_SIZE):
+        # Whole frames only: a shaping lane's debt absorbs the overshoot past ``size``.
+        stats = self.stats
+        while True:
+            try:
+                header = await reader.readexactly(CODEC_FRAME.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                return b""
+            word = CODEC_FRAME.unpack(header)[0]
+            if word & ~CODEC_COMPRESSED > CODEC_FRAME_MAX:
+                raise ValueError(f"codec frame of {word & ~CODEC_COMPRESSED} bytes")
+            payload = await reader.readexactly(word & ~CODEC_COMPRESSED)
+            stats.codec[1] += CODEC_FRAME.size + len(payload)
+            if word & CODEC_COMPRESSED:
+                started = time.perf_counter()
+                payload = self.decompress(payload)
+                stats.codec[2] += time.perf_counter() - started
+            if payload:
+                stats.codec[0] += len(payload)
+                stats.bytes[self.direction] += len(payload)
+                return payload
+
+class ElasticPool:
+    """Keeps the Europe reverse-worker pool sized to Iran's demand.
+
+    Workers report themselves idle (connected, waiting for a user) or busy
+    (piping). A taken bridge is replaced immediately while spare workers are
+    below the target headroom, and Iran's status reports (idle depth, waiting
+    users, recent picks) grow the pool on bursts. The pool only shrinks after
+    ``POOL_SHRINK_ROUNDS`` reports in a row show a large surplus.
+    """
+
+    def __init__(self, spawn, min_workers=POOL_MIN_WORKERS, max_workers=POOL_MAX_WORKERS, group=None):
+        self.spawn = spawn
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        # Pools in one group (one per Iran relay) share max_workers.
+        self.group = group if group is not None else [self]
+        self.workers = {}
+        self.idle = set()
+        self.busy = set()
+        self.next_id = 0
+        self.pick_rate = 0.0
+        self.surplus_rounds = 0
+        self.draining = False
+
+    @property
+    def target_idle(self):
+        return max(POOL_MIN_IDLE, math.ceil(self.pick_rate * POOL_HEADROOM_SEC))
+
+    @property
+    def spare(self):
+        return len(self.workers) - len(self.busy)
+
+    def grow(self, count):
+        if self.draining:
+            return
+        count = min(count, self.max_workers - sum(len(pool.workers) for pool in self.group))
+        for _ in range(max(0, count)):
+            worker_id = self.next_id
+            self.next_id += 1
+            task = asyncio.create_task(self.spawn(worker_id))
+            self.workers[worker_id] = task
+            task.add_done_callback(lambda _t, w=worker_id: self._forget(w))
+
+    def shrink(self, count):
+        count = min(count, len(self.workers) - self.min_workers)
+        for worker_id in list(self.idle)[:max(0, count)]:
+            self.idle.discard(worker_id)
+            self.workers[worker_id].cancel()
+
+    def _forget(self, worker_id):
+        self.workers.pop(worker_id, None)
+        self.idle.discard(worker_id)
+        self.busy.discard(worker_id)
+
+    def start(self):
+        self.grow(max(self.min_workers, self.target_idle))
+
+    def refill(self):
+        """Grow back to min_workers, e.g. once a relay that was down can be retried."""
+        self.grow(self.min_workers - len(self.workers))
+
+    def recycle(self):
+        """Replace the idle workers, e.g. after the Iran target changed."""
+        idle = list(self.idle)
+        for worker_id in idle:
+            self.idle.discard(worker_id)
+            self.workers[worker_id].cancel()
+        self.grow(len(idle))
+
+    def drain(self):
+        """Stop growing and cancel every worker that is not carrying a tunnel."""
+        self.draining = True
+        for worker_id, task in self.workers.items():
+            if worker_id not in self.busy:
+                task.cancel()
+
+    def stop(self):
+        tasks = list(self.workers.values())
+        for task in tasks:
+            task.cancel()
+        return tasks
+
+    def mark_idle(self, worker_id):
+        self.busy.discard(worker_id)
+        self.idle.add(worker_id)
+
+    def mark_busy(self, worker_id):
+        self.idle.discard(worker_id)
+        self.busy.add(worker_id)
+        if self.spare < self.target_idle:
+            self.grow(self.target_idle - self.spare)
+
+    def release(self, worker_id):
+        """Worker finished a tunnel; returns True when it should retire."""
+        self.idle.discard(worker_id)
+        self.busy.discard(worker_id)
+        if self.draining:
+            return True
+        if len(self.workers) <= self.min_workers:
+            return False
+        return self.spare > self.target_idle * POOL_SHRINK_FACTOR
+
+    def on_status(self, idle, waiting, picks, elapsed_ms):
+        rate = picks * 1000.0 / max(elapsed_ms, 1)
+        self.pick_rate = (self.pick_rate + rate) / 2
+        deficit = self.target_idle + waiting - idle
+        if deficit > 0:
+            self.surplus_rounds = 0
+            self.grow(deficit)
+        elif idle > self.target_idle * POOL_SHRINK_FACTOR:
+            self.surplus_rounds += 1
+            if self.surplus_rounds >= POOL_SHRINK_ROUNDS:
+                self.surplus_rounds = 0
+                self.shrink((idle - self.target_idle) // 2)
+        else:
+            self.surplus_rounds = 0
+
+class IranRelay:
+    """One Iran endpoint as seen from Europe: its pool, mux links and health."""
+
+    __slots__ = ("host", "pool", "links", "sessions", "failures", "down_until", "pick_rate", "sync_task")
+
+    def __init__(self, host):
+        self.host = host
+        self.pool = None
+        # Mux links connected or connecting to this relay.
+        self.links = 0
+        self.sessions = set()
+        self.failures = 0
+        self.down_until = 0.0
+        self.pick_rate = 0.0
+        self.sync_task = None
+
+    @property
+    def up(self):
+        """Not backing off: links may be tried."""
+        return time.time() >= self.down_until
+
+    @property
+    def healthy(self):
+        """The last bridge connect succeeded."""
+        return self.failures == 0
+
+    @property
+    def weight(self):
+        return 1 + self.pick_rate
+
+    def fail(self):
+        """A bridge connect failed; returns True when the relay just went down."""
+        now = time.time()
+        if now < self.down_until:
+            return False
+        self.down_until = now + min(RELAY_BACKOFF_MIN * 2 ** self.failures, RELAY_BACKOFF_MAX)
+        self.failures += 1
+        return self.failures == 1
+
+    def recover(self):
+        """A bridge connected; returns True when the relay was down."""
+        was_down = self.failures > 0
+        self.failures = 0
+        self.down_until = 0.0
+        return was_down
+
+    def on_status(self, picks, elapsed_ms):
+        self.pick_rate = (self.pick_rate + picks * 1000.0 / max(elapsed_ms, 1)) / 2
+
+def pick_relay(relays):
+    """The relay that is up with the fewest mux links for its demand, or None."""
+    return min((r for r in relays if r.up), key=lambda r: r.links / r.weight, default=None)
+
+def rebalance_relays(relays, iran, limit=MUX_BRIDGES):
+    """GOAWAY up to ``limit`` links on busier relays so that they reconnect to ``iran``."""
+    load = {r: r.links for r in relays if r.up}
+    load.setdefault(iran, iran.links)
+    for _ in range(limit):
+        donor = max(
+            (r for r in load if r is not iran and r.sessions),
+            key=lambda r: load[r] / r.weight,
+            default=None,
+        )
+        if donor is None or load[donor] / donor.weight <= (load[iran] + 1) / iran.weight:
+            break
+        donor.sessions.pop().go_away()
+        load[donor] -= 1
+        load[iran] += 1
+
+def split_workers(total, share, relays=1):
+    """One worker process's part of ``total`` links to one of ``relays``, rounded up."""
+    return math.ceil(total / share / relays)
+
+class Upstream:
+    """One Europe node as seen from Iran."""
+
+    __slots__ = (
+        "node", "name", "idle", "sessions", "sampled", "ports", "active", "picks",
+        "rtt", "rate", "moved", "counted", "failures", "cooldown_until", "seen",
+        "healthy", "status_at", "status_picks",
+    )
+
+    def __init__(self, node):
+        self.node = node
+        self.name = node.hex()[:8]
+        self.idle = collections.deque()
+        self.sessions = set()
+        # Last TCP_INFO byte count per mux session, for the throughput rate.
+        self.sampled = {}
+        # Port set from this node's sync channel; None until it first syncs.
+        self.ports = None
+        self.active = 0
+        self.picks = 0
+        self.rtt = None
+        self.rate = 0.0
+        self.moved = 0
+        self.counted = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.seen = time.time()
+        self.healthy = True
+        self.status_at = time.time()
+        self.status_picks = 0
+
+    def observe_rtt(self, rtt):
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt + UPSTREAM_EWMA * (rtt - self.rtt)
+
+class UpstreamBalancer:
+    """Iran's bridges grouped by the Europe node that sent them.
+
+    Pool-mode bridges wait in their node's ``idle`` deque and mux sessions in
+    its ``sessions`` set. A pick takes the healthy node with the best score
+    among those serving the port (in auto mode, the ports its sync reported);
+    when every candidate is down, the down ones are tried rather than failing.
+    Users that find no bridge queue as waiters, FIFO within their port's
+    priority class, and are handed the next matching bridge directly.
+
+    A port with a reservation may hold that many bridges before it competes
+    with the others: picks for any other port leave enough parked bridges to
+    cover every reservation that is not in use yet.
+    """
+
+    def __init__(self, capacity, stale, policy=UPSTREAM_BALANCE):
+        self.upstreams = {}
+        self.capacity = capacity
+        self.stale = stale
+        self.policy = UPSTREAM_BALANCE
+        self.set_policy(policy)
+        self.by_port = False
+        self.waiters = [collections.deque() for _ in PORT_PRIORITIES]
+        self.parked = 0
+        self.evicted = 0
+        self.reserve = {}
+        self.priority = {}
+        # Pool-mode bridges in use per port key.
+        self.held = collections.Counter()
+
+    def set_policy(self, name):
+        if name not in UPSTREAM_BALANCES:
+            logger.warning(f"Unknown balance policy '{name}', using {UPSTREAM_BALANCE}")
+            name = UPSTREAM_BALANCE
+        self.policy = name
+
+    def set_classes(self, reserve, priority):
+        self.reserve = reserve
+        self.priority = priority
+        # A smaller reservation may free parked bridges for users already waiting.
+        self._serve_waiters()
+
+    def _serve_waiters(self):
+        for queue in self.waiters:
+            for _ in range(len(queue)):
+                port, fut = queue.popleft()
+                if fut.done():
                     continue
-                if "127.0.0.1" in line or "::1" in line:
+                picked = self._take(port)
+                if picked is None:
+                    queue.append((port, fut))
+                else:
+                    fut.set_result(picked)
+
+    def _deficit(self, port):
+        return max(0, self.reserve.get(port, 0) - self.held[port])
+
+    def reserved(self):
+        """Parked bridges owed to reservations that are not in use yet."""
+        return sum(self._deficit(port) for port in self.reserve)
+
+    def get(self, node):
+        up = self.upstreams.get(node)
+        if up is None:
+            up = self.upstreams[node] = Upstream(node)
+        return up
+
+    def serves(self, up, port):
+        return not self.by_port or up.ports is None or port in up.ports
+
+    def score(self, up):
+        if self.policy == "least_conn":
+            return up.active
+        return (up.active + 1) * max(up.rtt or UPSTREAM_RTT_FLOOR, UPSTREAM_RTT_FLOOR)
+
+    def ports(self):
+        """Union of the port sets every known node reported."""
+        merged = set()
+        for up in self.upstreams.values():
+            if up.ports:
+                merged |= up.ports
+        return merged
+
+    def port_map(self):
+        return {up.node.hex(): sorted(up.ports) for up in self.upstreams.values() if up.ports is not None}
+
+    def set_port_map(self, mapping):
+        for up in self.upstreams.values():
+            if up.ports is not None and up.node.hex() not in mapping:
+                up.ports = set()
+        for node, ports in mapping.items():
+            self.get(bytes.fromhex(node)).ports = set(ports)
+
+    def _candidates(self, port, usable):
+        ups = [up for up in self.upstreams.values() if usable(up) and self.serves(up, port)]
+        return [up for up in ups if up.healthy] or ups
+
+    def _eligible(self, up, port):
+        # As in _candidates: a down node serves a port when no healthy one has a bridge for it.
+        if not self.serves(up, port):
+            return False
+        return up.healthy or not any(
+            other.healthy and other.idle and self.serves(other, port) for other in self.upstreams.values()
+        )
+
+    def add_bridge(self, up, bridge):
+        """Hand a fresh bridge to the first matching waiter or park it; False when full."""
+        up.seen = time.time()
+        for queue in self.waiters:
+            while queue and queue[0][1].done():
+                queue.popleft()
+        if any(self.waiters):
+            reserved = self.reserved()
+            for queue in self.waiters:
+                for i, (port, fut) in enumerate(queue):
+                    # The parked bridges must still cover the other ports' reservations.
+                    if fut.done() or not self._eligible(up, port) or self.parked < reserved - self._deficit(port):
+                        continue
+                    del queue[i]
+                    up.picks += 1
+                    up.active += 1
+                    self.held[port] += 1
+                    fut.set_result((up, bridge))
+                    return True
+        if self.parked >= self.capacity:
+            return False
+        up.idle.append(bridge)
+        self.parked += 1
+        if any(self.waiters):
+            # One more parked bridge may cover a reservation a waiter was held back by.
+            self._serve_waiters()
+        return True
+
+    def _take(self, port):
+        candidates = self._candidates(port, lambda up: up.idle)
+        owed = self.reserved() - self._deficit(port)
+        while candidates:
+            up = min(candidates, key=self.score)
+            while up.idle:
+                if self.parked <= owed:
+                    return None
+                bridge = up.idle.popleft()
+                self.parked -= 1
+                reader, writer = bridge[:2]
+                if writer.is_closing() or reader.at_eof():
+                    self.evicted += 1
+                    writer.close()
+                    continue
+                up.picks += 1
+                up.active += 1
+                self.held[port] += 1
+                return up, bridge
+            candidates.remove(up)
+        return None
+
+    async def pick(self, port, timeout):
+        """(upstream, bridge) for a user on ``port``, or None after ``timeout``.
+
+        Pool mode: the caller hands ``port`` back to ``release()``.
+        """
+        picked = self._take(port)
+        if picked is not None:
+            return picked
+        fut = asyncio.get_running_loop().create_future()
+        waiter = (port, fut)
+        waiting = self.waiters[self.priority.get(port, PORT_PRIORITIES.index(PORT_PRIORITY))]
+        waiting.append(waiter)
+        try:
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            # A hand-off in the same loop tick as the timeout still counts.
+            if fut.done() and not fut.cancelled():
+                return fut.result()
+            return None
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                up, bridge = fut.result()
+                self.release(up, port=port)
+                if not self.add_bridge(up, bridge):
+                    bridge[1].close()
+            raise
+        finally:
+            if waiter in waiting:
+                waiting.remove(waiter)
+
+    def pick_session(self, port):
+        """(upstream, least-loaded open mux session) for ``port``, or None."""
+        def usable(s):
+            return not s.closed and not s.draining and len(s.streams) < MUX_MAX_STREAMS
+        candidates = self._candidates(port, lambda up: any(usable(s) for s in up.sessions))
+        if not candidates:
+            return None
+        up = min(candidates, key=self.score)
+        up.picks += 1
+        up.active += 1
+        return up, min((s for s in up.sessions if usable(s)), key=lambda s: len(s.streams))
+
+    def release(self, up, moved=0, failed=False, port=None):
+        """A picked stream ended; enough failures in a row put the node in cooldown."""
+        up.active -= 1
+        up.moved += moved
+        if port is not None:
+            self.held[port] -= 1
+            if not self.held[port]:
+                del self.held[port]
+        if not failed:
+            up.failures = 0
+            return
+        up.failures += 1
+        if up.failures >= UPSTREAM_FAIL_LIMIT:
+            up.failures = 0
+            up.cooldown_until = time.time() + UPSTREAM_COOLDOWN
+            self.close_idle(up)
+            logger.warning(f"Upstream {up.name}: {UPSTREAM_FAIL_LIMIT} failed handoffs, cooling down {UPSTREAM_COOLDOWN}s")
+
+    def close_idle(self, up=None):
+        for target in ([up] if up is not None else list(self.upstreams.values())):
+            while target.idle:
+                target.idle.popleft()[1].close()
+                self.parked -= 1
+
+    def sweep(self, heartbeat=False):
+        """Evict dead idle bridges; optionally send a heartbeat on live ones."""
+        beat = BRIDGE_HEADER.pack(BRIDGE_HEARTBEAT_PORT, CODEC_NONE)
+        for up in self.upstreams.values():
+            for _ in range(len(up.idle)):
+                bridge = up.idle.popleft()
+                e_reader, e_writer = bridge[:2]
+                if e_writer.is_closing() or e_reader.at_eof():
+                    self.evicted += 1
+                    self.parked -= 1
+                    e_writer.close()
+                    continue
+                if heartbeat:
+                    e_writer.write(beat)
+                up.idle.append(bridge)
+            for session in up.sessions:
+                up.observe_rtt(tcp_rtt(session.writer))
+
+    def tick(self, elapsed):
+        """Refresh rates and health; returns True when a forgotten node took ports with it."""
+        now = time.time()
+        forgot = False
+        for node, up in list(self.upstreams.items()):
+            for session in up.sessions:
+                up.seen = max(up.seen, session.last_rx)
+                total = tcp_moved(session.writer)
+                if total is not None:
+                    up.moved += max(0, total - up.sampled.get(session, total))
+                    up.sampled[session] = total
+            for session in [s for s in up.sampled if s not in up.sessions]:
+                del up.sampled[session]
+            up.rate += UPSTREAM_EWMA * ((up.moved - up.counted) / elapsed - up.rate)
+            up.counted = up.moved
+            healthy = now >= up.cooldown_until and now - up.seen < self.stale
+            if healthy != up.healthy:
+                up.healthy = healthy
+                logger.warning(f"Upstream {up.name} is {'up' if healthy else 'down'}")
+            if not up.idle and not up.sessions and not up.active and now - up.seen > UPSTREAM_FORGET:
+                del self.upstreams[node]
+                forgot = forgot or bool(up.ports)
+        return forgot
+
+    def status(self, up, cluster=None):
+        """POOL_STATUS for ``up``'s sync reply; ``cluster`` holds the per-node sums of --workers."""
+        now = time.time()
+        if cluster is not None:
+            idle, waiting, picks = cluster.get(up.node.hex(), (0, 0, 0))
+        else:
+            idle, waiting, picks = self.report(up)
+        status = POOL_STATUS.pack(
+            idle,
+            waiting,
+            max(0, picks - up.status_picks),
+            int((now - up.status_at) * 1000),
+        )
+        up.status_at = now
+        up.status_picks = picks
+        return status
+
+    def report(self, up):
+        waiting = sum(
+            1 for queue in self.waiters for port, fut in queue if not fut.done() and self.serves(up, port)
+        )
+        # Bridges parked for reservations are not spare: Europe keeps headroom beyond them.
+        idle = len(up.idle)
+        if self.parked:
+            idle -= min(self.reserved(), self.parked) * idle // self.parked
+        return idle, waiting, up.picks
+
+class MuxStream:
+    __slots__ = (
+        "sid", "reader", "writer", "send_window", "window_event",
+        "unacked", "pending", "flushing", "closed", "stats", "lanes", "lease", "record",
+    )
+
+    def __init__(self, sid, stats, lanes=None):
+        self.sid = sid
+        self.reader = None
+        self.writer = None
+        self.send_window = MUX_WINDOW
+        self.window_event = asyncio.Event()
+        self.unacked = 0
+        self.pending = []
+        self.flushing = False
+        self.closed = False
+        self.stats = stats
+        # Shaping lanes indexed like PortStats.bytes (Iran side only).
+        self.lanes = lanes or (None, None)
+        self.lease = None
+        self.record = None
+        stats.active += 1
+        stats.total += 1
+
+class MuxSession:
+    """Carries many user streams over one long-lived bridge connection.
+
+    Frames are ``type(1) stream_id(4) length(2) payload``. Iran opens streams
+    with MUX_OPEN (payload = target port, plus BRIDGE_UDP for a UDP session), both sides exchange MUX_DATA within
+    a per-stream credit window refilled by MUX_WINDOW_UPDATE, and MUX_CLOSE
+    tears a stream down. MUX_GOAWAY from either side retires the session once
+    its streams are done. ``connector`` is only given on the Europe side and
+    opens the local target for incoming MUX_OPEN frames; ``label`` names the
+    peer for the stream registry.
+    """
+
+    def __init__(self, reader, writer, connector=None, label=None):
+        self.reader = reader
+        self.writer = writer
+        self.connector = connector
+        self.label = label
+        self.streams = {}
+        self.next_sid = 1
+        self.closed = False
+        self.last_rx = time.time()
+        self.tasks = set()
+        self._drain_lock = asyncio.Lock()
+        # Index into PortStats.bytes for data this side reads locally.
+        self.up = 0 if connector is None else 1
+        self.loop = asyncio.get_running_loop()
+        self.pending = []
+        self.pending_frames = 0
+        self.draining = False
+        self.going_away = asyncio.Event()
+
+    def send_frame(self, ftype, sid, payload=b""):
+        # uvloop raises on writes to a transport it already closed after a reset.
+        if self.closed or self.writer.is_closing():
+            return
+        # Frames queued during one loop iteration leave in a single write.
+        if not self.pending:
+            self.loop.call_soon(self.flush)
+        self.pending.append(MUX_HEADER.pack(ftype, sid, len(payload)))
+        if payload:
+            self.pending.append(payload)
+        self.pending_frames += 1
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        frames = self.pending_frames
+        self.pending.clear()
+        self.pending_frames = 0
+        if self.closed or self.writer.is_closing():
+            return
+        self.writer.write(data)
+        metrics.inc("blutunnel_mux_flushes_total")
+        metrics.inc("blutunnel_mux_frames_total", frames)
+
+    async def drain(self):
+        async with self._drain_lock:
+            self.flush()
+            await self.writer.drain()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def close_stream(self, stream, notify=True):
+        if stream.closed:
+            return
+        stream.closed = True
+        stream.stats.active -= 1
+        for lane in stream.lanes:
+            if lane is not None:
+                lane.close()
+        memory.release(stream.lease)
+        registry.remove(stream.record)
+        self.streams.pop(stream.sid, None)
+        if notify:
+            self.send_frame(MUX_CLOSE, stream.sid)
+        stream.window_event.set()
+        if stream.writer and not stream.writer.is_closing():
+            stream.writer.close()
+        self._close_if_drained()
+
+    def go_away(self):
+        """Tell the peer this session takes no new streams."""
+        if self.draining or self.closed:
+            return
+        self.send_frame(MUX_GOAWAY, 0)
+        self._on_goaway()
+
+    def _on_goaway(self):
+        self.draining = True
+        self.going_away.set()
+        self._close_if_drained()
+
+    def _close_if_drained(self):
+        # Only the opening side (Iran) knows that no MUX_OPEN is still in flight.
+        if self.draining and self.connector is None and not self.streams:
+            self.loop.call_soon(self.close)
+
+    def close(self):
+        if self.closed:
+            return
+        for stream in list(self.streams.values()):
+            self.close_stream(stream, notify=False)
+        self.flush()
+        self.closed = True
+        if not self.writer.is_closing():
+            self.writer.close()
+
+    def _new_sid(self):
+        # After the counter wraps, skip IDs that long-lived streams still hold.
+        sid = self.next_sid
+        while sid in self.streams:
+            sid = sid % 0xFFFFFFFF + 1
+        self.next_sid = sid % 0xFFFFFFFF + 1
+        return sid
+
+    async def open_stream(self, target_port, reader, writer, udp=False, shape=None):
+        sid = self._new_sid()
+        route = udp_key(target_port) if udp else target_port
+        stream = MuxStream(sid, metrics.port(route), shape)
+        stream.reader = reader
+        stream.writer = writer
+        stream.lease = memory.lease(writer)
+        stream.record = registry.add(route, writer, self.label)
+        self.streams[sid] = stream
+        target = struct.pack("!HB", target_port, BRIDGE_UDP) if udp else struct.pack("!H", target_port)
+        self.send_frame(MUX_OPEN, sid, target)
+        await self._uplink(stream)
+
+    async def _uplink(self, stream):
+        lane = stream.lanes[self.up]
+        try:
+            while not stream.closed:
+                if stream.send_window <= 0:
+                    stream.window_event.clear()
+                    await stream.window_event.wait()
                     continue
-                found = re.findall(r"[:\]](\d+)\b", line)
-                for p in found:
-                    p_num = int(p)
-                    if 100 < p_num <= 65535 and p_num not in (bridge_p, sync_p):
-                        ports.add(p_num)
+                size = min(stream.send_window, MUX_FRAME_MAX)
+                if lane is not None:
+                    await lane.wait()
+                    if stream.closed:
+                        break
+                    size = min(size, lane.credit)
+                data = await asyncio.wait_for(stream.reader.read(size), timeout=PIPE_IDLE_TIMEOUT)
+                if not data or stream.closed:
+                    break
+                stream.send_window -= len(data)
+                stream.stats.bytes[self.up] += len(data)
+                if lane is not None:
+                    lane.consume(len(data))
+                self.send_frame(MUX_DATA, stream.sid, data)
+                await self.drain()
+        except asyncio.TimeoutError:
+            logger.debug("Mux stream timeout")
+        except Exception as e:
+            logger.debug("Mux stream error: %s", e)
+        finally:
+            self.close_stream(stream)
+
+    async def _credit(self, stream):
+        # A shaped stream's downlink is paced by holding back its window credit.
+        lane = stream.lanes[1 - self.up]
+        try:
+            while not stream.closed and stream.unacked >= MUX_CREDIT_BATCH:
+                credit = stream.unacked
+                await stream.writer.drain()
+                if lane is not None:
+                    await lane.wait()
+                    if stream.closed:
+                        break
+                stream.unacked -= credit
+                self.send_frame(MUX_WINDOW_UPDATE, stream.sid, struct.pack("!I", credit))
+        except Exception as e:
+            logger.debug("Mux credit failed: %s", e)
+            self.close_stream(stream)
+        finally:
+            stream.flushing = False
+
+    def _maybe_credit(self, stream):
+        if stream.unacked >= MUX_CREDIT_BATCH and not stream.flushing:
+            stream.flushing = True
+            self._spawn(self._credit(stream))
+
+    def _on_data(self, sid, payload):
+        stream = self.streams.get(sid)
+        if stream is None:
+            return
+        stream.unacked += len(payload)
+        stream.stats.bytes[1 - self.up] += len(payload)
+        if stream.lanes[1 - self.up] is not None:
+            stream.lanes[1 - self.up].consume(len(payload))
+        if stream.unacked > MUX_WINDOW:
+            logger.debug("Mux stream %s exceeded its window", sid)
+            self.close_stream(stream)
+            return
+        if stream.writer is None:
+            stream.pending.append(payload)
+            return
+        stream.writer.write(payload)
+        self._maybe_credit(stream)
+
+    def _on_open(self, sid, payload):
+        if self.connector is None or sid in self.streams or len(payload) not in (2, 3):
+            return
+        if len(self.streams) >= MUX_MAX_STREAMS:
+            self.send_frame(MUX_CLOSE, sid)
+            return
+        target_port = struct.unpack_from("!H", payload)[0]
+        udp = len(payload) == 3 and bool(payload[2] & BRIDGE_UDP)
+        stream = MuxStream(sid, metrics.port(udp_key(target_port) if udp else target_port))
+        self.streams[sid] = stream
+        self._spawn(self._accept_stream(stream, target_port, udp))
+
+    async def _accept_stream(self, stream, target_port, udp):
+        try:
+            reader, writer = await self.connector(target_port, udp)
+        except Exception as e:
+            logger.debug("Mux open to port %s failed: %s", target_port, e)
+            self.close_stream(stream)
+            return
+        if stream.closed:
+            writer.close()
+            return
+        stream.reader = reader
+        stream.writer = writer
+        stream.lease = memory.lease(writer)
+        stream.record = registry.add(udp_key(target_port) if udp else target_port, writer, self.label, read=1)
+        for chunk in stream.pending:
+            writer.write(chunk)
+        stream.pending = []
+        self._maybe_credit(stream)
+        await self._uplink(stream)
+
+    async def _keepalive(self):
+        while not self.closed:
+            await asyncio.sleep(MUX_PING_INTERVAL)
+            if time.time() - self.last_rx > MUX_DEAD_TIMEOUT:
+                logger.debug("Mux bridge silent, closing")
+                self.close()
+                break
+            self.send_frame(MUX_PING, 0)
+
+    async def run(self):
+        pinger = asyncio.create_task(self._keepalive())
+        try:
+            while True:
+                header = await self.reader.readexactly(MUX_HEADER.size)
+                ftype, sid, length = MUX_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length) if length else b""
+                self.last_rx = time.time()
+                if ftype == MUX_DATA:
+                    self._on_data(sid, payload)
+                elif ftype == MUX_WINDOW_UPDATE:
+                    stream = self.streams.get(sid)
+                    if stream is not None and length == 4:
+                        stream.send_window += struct.unpack("!I", payload)[0]
+                        stream.window_event.set()
+                elif ftype == MUX_OPEN:
+                    self._on_open(sid, payload)
+                elif ftype == MUX_CLOSE:
+                    stream = self.streams.get(sid)
+                    if stream is not None:
+                        self.close_stream(stream, notify=False)
+                elif ftype == MUX_PING:
+                    self.send_frame(MUX_PONG, sid, payload)
+                elif ftype == MUX_GOAWAY:
+                    self._on_goaway()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.debug("Mux bridge error: %s", e)
+        finally:
+            pinger.cancel()
+            self.close()
+
+class DatagramStream:
+    """A UDP flow behind the reader/writer interface of ``relay()`` and MuxSession.
+
+    Datagrams from the local socket are queued as UDP_FRAME-prefixed records
+    for ``read()``; ``write()`` takes the same records from the tunnel and
+    sends each complete datagram with ``send``. With no transport, ``relay()``
+    uses its ``pipe()`` pair.
+    """
+
+    transport = None
+
+    def __init__(self, send, on_close=None, peername=None):
+        self.send = send
+        self.on_close = on_close
+        self.peername = peername
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.waiter = None
+        self.closed = False
+        self.last_active = time.monotonic()
+        # Datagram bytes from and to the local socket, for the stream registry.
+        self.received = 0
+        self.sent = 0
+
+    def feed(self, datagram):
+        if self.closed:
+            return
+        self.last_active = time.monotonic()
+        self.received += len(datagram)
+        if len(self.inbound) + len(datagram) > UDP_QUEUE_BYTES:
+            metrics.inc("blutunnel_udp_dropped_total")
+            return
+        self.inbound += UDP_FRAME.pack(len(datagram))
+        self.inbound += datagram
+        self._wake()
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read(self, n=-1):
+        while not self.inbound and not self.closed:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if n < 0:
+            n = len(self.inbound)
+        data = bytes(self.inbound[:n])
+        del self.inbound[:n]
+        return data
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.last_active = time.monotonic()
+        self.outbound += data
+        while len(self.outbound) >= UDP_FRAME.size:
+            end = UDP_FRAME.size + UDP_FRAME.unpack_from(self.outbound)[0]
+            if len(self.outbound) < end:
+                break
+            self.send(bytes(self.outbound[UDP_FRAME.size:end]))
+            self.sent += end - UDP_FRAME.size
+            del self.outbound[:end]
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._wake()
+        if self.on_close is not None:
+            self.on_close()
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername" and self.peername is not None:
+            return self.peername
+        return default
+
+class UdpListener(asyncio.DatagramProtocol):
+    """Iran's UDP user port: one DatagramStream session per client address.
+
+    ``serve(stream)`` carries a new session to Europe. The table keeps the
+    most recently active address last, so eviction and expiry take the front.
+    """
+
+    def __init__(self, serve):
+        self.serve = serve
+        self.transport = None
+        self.sessions = collections.OrderedDict()
+        self.tasks = set()
+        self.timer = None
+
+    @property
+    def sockets(self):
+        sock = self.transport.get_extra_info("socket") if self.transport else None
+        return [sock] if sock is not None else []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.timer = asyncio.get_running_loop().call_later(UDP_SWEEP_INTERVAL, self._sweep)
+
+    def datagram_received(self, data, addr):
+        stream = self.sessions.get(addr)
+        if stream is not None:
+            self.sessions.move_to_end(addr)
+            stream.feed(data)
+            return
+        if len(self.sessions) >= UDP_MAX_SESSIONS:
+            self.sessions.popitem(last=False)[1].close()
+            metrics.inc("blutunnel_udp_evicted_total")
+        stream = DatagramStream(lambda payload: self._reply(addr, payload), peername=addr)
+        stream.on_close = lambda: self._forget(addr, stream)
+        self.sessions[addr] = stream
+        stream.feed(data)
+        task = asyncio.create_task(self.serve(stream))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda _t: stream.close())
+
+    def error_received(self, exc):
+        logger.debug("UDP listener error: %s", exc)
+
+    def _reply(self, addr, payload):
+        # Replies keep a session alive as well, so they move it to the back too.
+        if addr in self.sessions:
+            self.sessions.move_to_end(addr)
+        self.transport.sendto(payload, addr)
+
+    def _forget(self, addr, stream):
+        if self.sessions.get(addr) is stream:
+            del self.sessions[addr]
+
+    def _sweep(self):
+        deadline = time.monotonic() - UDP_IDLE_TIMEOUT
+        while self.sessions:
+            stream = next(iter(self.sessions.values()))
+            if stream.last_active > deadline:
+                break
+            stream.close()
+        self.timer = asyncio.get_running_loop().call_later(UDP_SWEEP_INTERVAL, self._sweep)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        for stream in list(self.sessions.values()):
+            stream.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        pass
+
+class _UdpTarget(asyncio.DatagramProtocol):
+    """Europe's socket to a local UDP inbound, feeding one DatagramStream."""
+
+    def __init__(self):
+        self.stream = None
+
+    def datagram_received(self, data, addr):
+        if self.stream is not None:
+            self.stream.feed(data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable while the inbound restarts; datagrams are lost anyway.
+        logger.debug("UDP target error: %s", exc)
+
+async def open_datagram(port):
+    """A DatagramStream to 127.0.0.1:``port`` for a relayed UDP session."""
+    transport, target = await asyncio.get_running_loop().create_datagram_endpoint(
+        _UdpTarget,
+        remote_addr=("127.0.0.1", port),
+    )
+    target.stream = DatagramStream(transport.sendto, on_close=transport.close)
+    return target.stream
+
+def port_ranges(ports):
+    """Collapse ports into sorted inclusive [start, end] ranges."""
+    ranges = []
+    for p in sorted(ports):
+        if ranges and p == ranges[-1][1] + 1:
+            ranges[-1][1] = p
+        else:
+            ranges.append([p, p])
+    return ranges
+
+def udp_key(port):
+    """The port key a UDP port is synced and listened under."""
+    return port | UDP_PORT_KEY
+
+def port_label(key):
+    return f"{key & 0xFFFF}/udp" if key & UDP_PORT_KEY else str(key)
+
+def parse_port_key(text):
+    """``"443"`` or ``"443/udp"`` as a port key; None when invalid."""
+    port, _, proto = text.strip().lower().partition("/")
+    if not (port.isdigit() and validate_port(int(port))) or proto not in ("", "tcp", "udp"):
+        return None
+    return udp_key(int(port)) if proto == "udp" else int(port)
+
+def manual_port_keys(profile):
+    return set(profile.get("manual_ports", [])) | {udp_key(p) for p in profile.get("manual_udp_ports", [])}
+
+def port_classes(profile):
+    """Reserved bridge counts and priority ranks by port key, from ``port_reserve`` / ``port_priority``."""
+    reserve = {}
+    for name, count in (profile.get("port_reserve") or {}).items():
+        key = parse_port_key(str(name))
+        if key is None or not isinstance(count, int) or count < 0:
+            logger.warning(f"Ignoring bridge reservation {name}={count}")
+            continue
+        if count:
+            reserve[key] = count
+    priority = {}
+    for name, rank in (profile.get("port_priority") or {}).items():
+        key = parse_port_key(str(name))
+        if key is None or rank not in PORT_PRIORITIES:
+            logger.warning(f"Ignoring port priority {name}={rank}")
+            continue
+        priority[key] = PORT_PRIORITIES.index(rank)
+    return reserve, priority
+
+def encode_sync(kind, version, added=(), removed=()):
+    # Port 0 is never synced, so no range runs from TCP into UDP keys.
+    added = port_ranges(added)
+    removed = port_ranges(removed)
+    parts = [SYNC_HEADER.pack(kind, version, len(added), len(removed))]
+    parts.extend(SYNC_RANGE.pack(start >> 16, start & 0xFFFF, end & 0xFFFF) for start, end in added + removed)
+    return b"".join(parts)
+
+async def read_sync(reader, timeout):
+    """Read one sync frame; returns (kind, version, added, removed)."""
+    header = await asyncio.wait_for(reader.readexactly(SYNC_HEADER.size), timeout=timeout)
+    kind, version, n_added, n_removed = SYNC_HEADER.unpack(header)
+    added, removed = set(), set()
+    if n_added or n_removed:
+        body = await asyncio.wait_for(
+            reader.readexactly((n_added + n_removed) * SYNC_RANGE.size),
+            timeout=timeout,
+        )
+        for i, (proto, start, end) in enumerate(SYNC_RANGE.iter_unpack(body)):
+            if proto > 1 or not (validate_port(start) and start <= end):
+                continue
+            base = UDP_PORT_KEY if proto else 0
+            (added if i < n_added else removed).update(range(base + start, base + end + 1))
+    return kind, version, added, removed
+
+class XrayPortScanner:
+    """Finds ports xray listens on from /proc/net/{tcp,udp}{,6}, without forking ss.
+
+    TCP sockets count in LISTEN state, UDP ones when bound but unconnected.
+    UDP ports in the kernel's ephemeral range may be xray's outbound sockets and
+    are skipped (logged at debug level) unless ip_local_reserved_ports holds
+    them, since the kernel never hands a reserved port to an outbound socket.
+    Socket inodes are matched to processes through /proc/<pid>/fd.
+    The inode -> pid index is cached, so the fd walk only runs again when a
+    listener appears that has not been seen before.
+    """
+
+    # (path, family, listening state, port key offset)
+    TABLES = (
+        ("/proc/net/tcp", socket.AF_INET, "0A", 0),
+        ("/proc/net/tcp6", socket.AF_INET6, "0A", 0),
+        ("/proc/net/udp", socket.AF_INET, "07", UDP_PORT_KEY),
+        ("/proc/net/udp6", socket.AF_INET6, "07", UDP_PORT_KEY),
+    )
+    EPHEMERAL = "/proc/sys/net/ipv4/ip_local_port_range"
+    RESERVED = "/proc/sys/net/ipv4/ip_local_reserved_ports"
+
+    def __init__(self, process_name=XRAY_PROCESS):
+        self.process_name = process_name
+        self.inode_pid = {}
+        try:
+            with open(self.EPHEMERAL) as f:
+                low, high = map(int, f.read().split())
+        except (OSError, ValueError):
+            low, high = 32768, 60999
+        self.ephemeral = range(low, high + 1)
+        self.skipped = set()
+
+    def _reserved(self):
+        # "8080,40000-40010"; re-read each scan, so reserving a port needs no restart.
+        reserved = set()
+        try:
+            with open(self.RESERVED) as f:
+                text = f.read().strip()
+        except OSError:
+            return reserved
+        for part in filter(None, text.split(",")):
+            low, _, high = part.partition("-")
+            try:
+                reserved.update(range(int(low), int(high or low) + 1))
+            except ValueError:
+                continue
+        return reserved
+
+    def _listeners(self):
+        listeners = {}
+        reserved = None
+        skipped = set()
+        for path, family, state, key in self.TABLES:
+            try:
+                with open(path) as f:
+                    next(f, None)
+                    for line in f:
+                        # Most lines are established sockets: split only as far as the state.
+                        fields = line.split(None, 4)
+                        if len(fields) < 5 or fields[3] != state:
+                            continue
+                        host, port = fields[1].split(":")
+                        port = int(port, 16)
+                        if key and port in self.ephemeral:
+                            if reserved is None:
+                                reserved = self._reserved()
+                            if port not in reserved:
+                                skipped.add(port)
+                                continue
+                        rest = fields[4].split()
+                        if len(rest) < 6:
+                            continue
+                        raw = bytes.fromhex(host)
+                        # The kernel prints each 32-bit word in host byte order.
+                        raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+                        listeners[int(rest[5])] = (socket.inet_ntop(family, raw), port | key)
+            except OSError:
+                continue
+        for port in sorted(skipped - self.skipped):
+            logger.debug("Skipping UDP port %d: in the ephemeral range and not in ip_local_reserved_ports", port)
+        self.skipped = skipped
+        return listeners
+
+    def _process_pids(self):
+        pids = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/comm") as f:
+                    if self.process_name in f.read().lower():
+                        pids.append(int(entry))
+            except OSError:
+                continue
+        return pids
+
+    def _index(self, wanted):
+        for pid in self._process_pids():
+            fd_dir = f"/proc/{pid}/fd"
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(f"{fd_dir}/{fd}")
+                except OSError:
+                    continue
+                if target.startswith("socket:["):
+                    inode = int(target[8:-1])
+                    if inode in wanted:
+                        self.inode_pid[inode] = pid
+
+    def scan(self):
+        """Return the set of (address, port key) listeners owned by xray."""
+        listeners = self._listeners()
+        unknown = listeners.keys() - self.inode_pid.keys()
+        if unknown:
+            self._index(unknown)
+            # Listeners of other processes stay in the index as pid 0.
+            for inode in unknown:
+                self.inode_pid.setdefault(inode, 0)
+        for inode in self.inode_pid.keys() - listeners.keys():
+            del self.inode_pid[inode]
+        return {
+            addr for inode, addr in listeners.items()
+            if self.inode_pid.get(inode)
+        }
+
+xray_scanner = XrayPortScanner()
+
+async def get_xray_ports_safe():
+    ports = set()
+    try:
+        ports = {port for _, port in xray_scanner.scan()}
+    except Exception as e:
+        logger.error(f"Error getting ports: {e}")
+    return ports
+
+def relay_hosts(iran_ip):
+    """Iran relay addresses from a profile's iran_ip (comma-separated for several)."""
+    return [host.strip() for host in str(iran_ip).split(",") if host.strip()]
+
+def prompt_europe_profile():
+    BeautifulUI.print_banner()
+    BeautifulUI.print_section("Europe Mode", "E")
+    iran_ip = BeautifulUI.input_with_style("Iran IP (comma-separated for several relays)", "I")
+    hosts = relay_hosts(iran_ip)
+    if not hosts or not all(validate_ip(host) for host in hosts):
+        BeautifulUI.print_error("Invalid IP address")
+        input(f"{Colors.GRAY}Press Enter...{Colors.END}")
+        return None
+    try:
+        bridge_p = int(BeautifulUI.input_with_style("Tunnel Bridge Port", "B"))
+        sync_p = int(BeautifulUI.input_with_style("Port Sync Port", "S"))
+        if not (validate_port(bridge_p) and validate_port(sync_p)):
+            BeautifulUI.print_error("Invalid port number")
+            input(f"{Colors.GRAY}Press Enter...{Colors.END}")
+            return None
+    except ValueError:
+        BeautifulUI.print_error("Port must be a number")
+        input(f"{Colors.GRAY}Press Enter...{Colors.END}")
+        return None
+    mux_mode = BeautifulUI.input_with_style("Multiplex bridge? (y/n)", "X", "n").strip().lower() == "y"
+    return {
+        "iran_ip": ",".join(hosts),
+        "bridge_port": bridge_p,
+        "sync_port": sync_p,
+        "mux": mux_mode,
+    }
+
+def start_europe(key, workers=1):
+    profile = prompt_europe_profile()
+    if profile is None:
+        return
+    save_tunnel_profile("europe", profile)
+    launch_mode("europe", key, profile, workers)
+
+async def run_europe(key, profile, worker=None):
+    bridge_p = profile["bridge_port"]
+    sync_p = profile["sync_port"]
+    mux_mode = profile.get("mux", False)
+    key_hash = hash_key(key)
+    caps = bytes([codec_caps()])
+    # Worker processes each run an equal share of the reverse links.
+    share = worker.count if worker is not None else 1
+    is_leader = worker is None or worker.leader
+    running = True
+    upgrading = False
+    mux_sessions = set()
+    relays = []
+    # Every relay's pool, including drained ones still finishing tunnels.
+    pools = []
+    stopped = asyncio.get_running_loop().create_future()
+    start_time = time.time()
+    connection_count = 0
+    last_sync_error_log = 0.0
+    async def get_xray_ports():
+        # /proc/net lists every established socket too, so parse it off the loop.
+        ports = set()
+        try:
+            listeners = await asyncio.get_running_loop().run_in_executor(None, xray_scanner.scan)
+            for host, key in listeners:
+                addr = ipaddress.ip_address(host)
+                if addr.is_loopback or (addr.version == 6 and addr.ipv4_mapped and addr.ipv4_mapped.is_loopback):
+                    continue
+                if 100 < key & 0xFFFF and key not in (bridge_p, sync_p):
+                    ports.add(key)
         except Exception:
             return set()
         return ports
-    async def port_sync_task():
+    xray_ports = await get_xray_ports()
+    async def xray_scan_task():
+        """One scan for every relay's sync loop, backing off while nothing changes."""
+        nonlocal xray_ports
+        interval = XRAY_SCAN_INTERVAL
+        while running:
+            await asyncio.sleep(interval)
+            ports = await get_xray_ports()
+            if ports == xray_ports:
+                interval = min(interval * 2, XRAY_SCAN_MAX_INTERVAL)
+            else:
+                xray_ports = ports
+                interval = XRAY_SCAN_INTERVAL
+    async def sync_exchange(iran, reader, writer, frame):
+        started = time.perf_counter()
+        writer.write(frame)
+        await writer.drain()
+        kind, acked, _, _ = await read_sync(reader, CONN_TIMEOUT)
+        status = await asyncio.wait_for(reader.readexactly(POOL_STATUS.size), timeout=CONN_TIMEOUT)
+        metrics.observe("blutunnel_sync_latency_seconds", time.perf_counter() - started)
+        if kind != SYNC_ACK:
+            raise ConnectionError(f"unexpected sync frame {kind}")
+        idle, waiting, picks, elapsed_ms = POOL_STATUS.unpack(status)
+        iran.on_status(picks, elapsed_ms)
+        if not mux_mode:
+            iran.pool.on_status(
+                math.ceil(idle / share),
+                math.ceil(waiting / share),
+                math.ceil(picks / share),
+                elapsed_ms,
+            )
+        return acked
+    async def port_sync_task(iran):
         nonlocal last_sync_error_log
+        # The pool needs Iran's status every SYNC_INTERVAL; otherwise only a
+        # changed listener set (or the periodic refresh) is pushed.
+        due = SYNC_REFRESH_INTERVAL if mux_mode else SYNC_INTERVAL
         while running:
+            writer = None
             try:
-                _, writer = await asyncio.open_connection(iran_ip, sync_p)
-                current_ports = sorted(get_xray_ports())[:255]
-                payload = struct.pack("!B", len(current_ports))
-                for p in current_ports:
-                    payload += struct.pack("!H", p)
-                writer.write(payload)
-                await writer.drain()
-                writer.close()
-                await writer.wait_closed()
-                logger.info(f"Synced {len(current_ports)} ports")
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(iran.host, sync_p),
+                    timeout=CONN_TIMEOUT,
+                )
+                await tune(writer)
+                await auth_answer(reader, writer, key_hash, AUTH_SYNC)
+                writer.write(SYNC_MAGIC + NODE_ID)
+                version = 0
+                acked = None
+                synced_ports = None
+                last_sync = 0.0
+                while running:
+                    if iran.up and not mux_mode:
+                        # Workers retired while the relay was down; retry it.
+                        iran.pool.refill()
+                    elif iran.up and not iran.links:
+                        # Probe with one link; the rest follow once it connects.
+                        rebalance_relays(relays, iran, 1)
+                    current_ports = xray_ports
+                    if acked != version:
+                        # New channel, or Iran missed a version: send a full snapshot.
+                        version += 1
+                        frame = encode_sync(SYNC_FULL, version, current_ports)
+                    elif current_ports != synced_ports:
+                        version += 1
+                        frame = encode_sync(
+                            SYNC_DELTA,
+                            version,
+                            current_ports - synced_ports,
+                            synced_ports - current_ports,
+                        )
+                    elif time.monotonic() - last_sync >= due:
+                        frame = encode_sync(SYNC_POLL, version)
+                    else:
+                        await asyncio.sleep(XRAY_SCAN_INTERVAL)
+                        continue
+                    acked = await sync_exchange(iran, reader, writer, frame)
+                    last_sync = time.monotonic()
+                    if acked != version:
+                        continue
+                    if current_ports != synced_ports:
+                        logger.info(f"Synced {len(current_ports)} ports to {iran.host} (v{version})")
+                        synced_ports = current_ports
+                    await asyncio.sleep(XRAY_SCAN_INTERVAL)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 now = time.time()
                 if now - last_sync_error_log >= LOG_THROTTLE_SEC:
-                    logger.warning(f"Sync failed: {e}")
+                    logger.warning(f"Sync with {iran.host} failed: {e}")
                     last_sync_error_log = now
-            await asyncio.sleep(3)
-    async def create_reverse_link(worker_id):
+            finally:
+                if writer is not None and not writer.is_closing():
+                    writer.close()
+            await asyncio.sleep(SYNC_INTERVAL)
+    def relay_down(iran, e):
+        if iran.fail():
+            logger.warning(f"Iran relay {iran.host} unreachable: {e}")
+    def relay_linked(iran):
+        if iran.recover():
+            logger.info(f"Iran relay {iran.host} is reachable again")
+            if mux_mode:
+                rebalance_relays(relays, iran)
+    async def create_reverse_link(iran, worker_id):
         nonlocal connection_count
+        pool = iran.pool
         backoff = 1
         while running:
+            if not iran.up:
+                # Leave the shared budget to the relays that are up; the sync
+                # task refills this pool once the relay's backoff ends.
+                break
+            writer = None
+            linked = False
             try:
                 reader, writer = await asyncio.wait_for(
-                    asyncio.open_connection(iran_ip, bridge_p),
+                    asyncio.open_connection(iran.host, bridge_p),
                     timeout=CONN_TIMEOUT,
                 )
-                await tune(writer)
-                header = await asyncio.wait_for(
-                    reader.readexactly(2),
-                    timeout=BRIDGE_ASSIGN_TIMEOUT,
-                )
-                target_port = struct.unpack("!H", header)[0]
-                if not validate_port(target_port):
+                await tune_bridge(writer)
+                await auth_answer(reader, writer, key_hash, AUTH_BRIDGE)
+                writer.write(caps + NODE_ID)
+                linked = True
+                relay_linked(iran)
+                metrics.inc("blutunnel_reverse_connects_total")
+                pool.mark_idle(worker_id)
+                target_port = BRIDGE_HEARTBEAT_PORT
+                while target_port == BRIDGE_HEARTBEAT_PORT:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(BRIDGE_HEADER.size),
+                        timeout=BRIDGE_ASSIGN_TIMEOUT,
+                    )
+                    target_port, codec = BRIDGE_HEADER.unpack(header)
+                pool.mark_busy(worker_id)
+                udp = codec & BRIDGE_UDP
+                codec &= ~BRIDGE_UDP
+                if not validate_port(target_port) or (codec and not caps[0] & (1 << codec)):
                     writer.close()
+                    if pool.release(worker_id):
+                        break
                     continue
-                remote_reader, remote_writer = await asyncio.wait_for(
-                    asyncio.open_connection("127.0.0.1", target_port),
-                    timeout=CONN_TIMEOUT,
-                )
-                await tune(remote_writer)
-                connection_count += 1
-                await asyncio.gather(
-                    pipe(reader, remote_writer),
-                    pipe(remote_reader, writer),
-                    return_exceptions=True,
-                )
+                remote_reader, remote_writer = await open_local_target(target_port, udp)
+                route = udp_key(target_port) if udp else target_port
+                record = registry.add(route, remote_writer, iran.host, read=1)
+                try:
+                    await relay(reader, writer, remote_reader, remote_writer, metrics.port(route), codec, wire="a")
+                finally:
+                    registry.remove(record)
                 backoff = 1
+                if pool.release(worker_id):
+                    break
             except asyncio.CancelledError:
+                if writer is not None:
+                    writer.close()
                 break
             except Exception as e:
-                logger.debug(f"Worker {worker_id} reconnect: {e}")
+                if writer is not None:
+                    writer.close()
+                if pool.release(worker_id):
+                    break
+                logger.debug("Worker %s reconnect: %s", worker_id, e)
+                metrics.inc("blutunnel_reverse_reconnects_total")
+                if not linked:
+                    relay_down(iran, e)
+                    continue
+                metrics.inc("blutunnel_reverse_backoff_seconds_total", backoff)
                 await asyncio.sleep(backoff)
                 backoff = min(backoff * 2, 10)
-    print()
-    BeautifulUI.print_success("BluTunnel Europe Starting")
-    print(f"  {Colors.SERVER} Target: {Colors.CYAN}{iran_ip}:{bridge_p}{Colors.END}")
-    print(f"  {Colors.INFO} Workers: {Colors.YELLOW}{MAX_POOL}{Colors.END}")
-    print()
-    sync_task_obj = asyncio.create_task(port_sync_task())
-    workers = [asyncio.create_task(create_reverse_link(i)) for i in range(MAX_POOL)]
+    async def open_local_target(target_port, udp=False):
+        nonlocal connection_count
+        if not validate_port(target_port):
+            raise ValueError(f"invalid target port {target_port}")
+        if not memory.admit():
+            raise ConnectionRefusedError("memory budget used up")
+        if udp:
+            connection_count += 1
+            stream = await open_datagram(target_port)
+            return stream, stream
+        remote_reader, remote_writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", target_port),
+            timeout=CONN_TIMEOUT,
+        )
+        await tune(remote_writer)
+        connection_count += 1
+        return remote_reader, remote_writer
+    async def create_mux_link(worker_id):
+        backoff = 1
+        while running:
+            iran = pick_relay(relays)
+            if iran is None:
+                # Every relay is backing off; wait for the first to be retried.
+                await asyncio.sleep(max(0.1, min(r.down_until for r in relays) - time.time()))
+                continue
+            iran.links += 1
+            linked = False
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(iran.host, bridge_p),
+                    timeout=CONN_TIMEOUT,
+                )
+                await tune_bridge(writer)
+                await auth_answer(reader, writer, key_hash, AUTH_BRIDGE)
+                writer.write(caps + NODE_ID + MUX_MAGIC)
+                await writer.drain()
+                linked = True
+                relay_linked(iran)
+                metrics.inc("blutunnel_reverse_connects_total")
+                backoff = 1
+                session = MuxSession(reader, writer, connector=open_local_target, label=iran.host)
+                mux_sessions.add(session)
+                iran.sessions.add(session)
+                runner = asyncio.create_task(session.run())
+                runner.add_done_callback(lambda _t, s=session, r=iran: (mux_sessions.discard(s), r.sessions.discard(s)))
+                # After a GOAWAY the session keeps its streams until Iran closes
+                # it, while this link reconnects to carry the new ones.
+                going_away = asyncio.create_task(session.going_away.wait())
+                try:
+                    await asyncio.wait((runner, going_away), return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    going_away.cancel()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.debug("Mux worker %s reconnect: %s", worker_id, e)
+                if not linked:
+                    relay_down(iran, e)
+            finally:
+                iran.links -= 1
+            metrics.inc("blutunnel_reverse_reconnects_total")
+            if not linked:
+                # Straight on to another iran, or wait above for this one.
+                continue
+            metrics.inc("blutunnel_reverse_backoff_seconds_total", backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 10)
+    def size_pools():
+        # The minimum is split across relays; demand grows each pool from there.
+        for r in relays:
+            r.pool.min_workers = split_workers(POOL_MIN_WORKERS, share, len(relays))
+    def add_relay(host):
+        iran = IranRelay(host)
+        pools[:] = [pool for pool in pools if not (pool.draining and not pool.workers)]
+        iran.pool = ElasticPool(
+            lambda worker_id: create_reverse_link(iran, worker_id),
+            max_workers=split_workers(POOL_MAX_WORKERS, share),
+            group=pools,
+        )
+        pools.append(iran.pool)
+        relays.append(iran)
+        size_pools()
+        iran.sync_task = asyncio.create_task(port_sync_task(iran))
+        return iran
+    def remove_relay(iran):
+        """Stop linking ``iran``; its live tunnels finish where they are."""
+        relays.remove(iran)
+        iran.sync_task.cancel()
+        iran.pool.drain()
+        for session in list(iran.sessions):
+            session.go_away()
+    for host in relay_hosts(profile["iran_ip"]):
+        add_relay(host)
+    mux_links = split_workers(MUX_BRIDGES, share)
+    if is_leader:
+        print()
+        BeautifulUI.print_success("BluTunnel Europe Starting")
+        targets = ", ".join(f"{r.host}:{bridge_p}" for r in relays)
+        print(f"  {Colors.SERVER} Target: {Colors.CYAN}{targets}{Colors.END}")
+        if mux_mode:
+            print(f"  {Colors.INFO} Workers: {Colors.YELLOW}{MUX_BRIDGES} (mux){Colors.END}")
+        else:
+            print(f"  {Colors.INFO} Workers: {Colors.YELLOW}{POOL_MIN_WORKERS}-{POOL_MAX_WORKERS} (elastic){Colors.END}")
+        if worker is not None:
+            print(f"  {Colors.INFO} Worker Processes: {Colors.YELLOW}{worker.count}{Colors.END}")
+        print()
+    if mux_mode:
+        workers = [asyncio.create_task(create_mux_link(i)) for i in range(mux_links)]
+    else:
+        workers = []
+        for r in relays:
+            r.pool.start()
+    def worker_count():
+        return len(workers) if mux_mode else sum(len(pool.workers) for pool in pools)
     async def show_stats():
         while running:
-            uptime = time.time() - start_time
-            hours = int(uptime // 3600)
-            minutes = int((uptime % 3600) // 60)
-            seconds = int(uptime % 60)
-            print(
-                f"\r  {Colors.CYAN}Uptime: {Colors.GREEN}{hours:02d}:{minutes:02d}:{seconds:02d}{Colors.END} "
-                f"{Colors.PING} Connections: {Colors.YELLOW}{connection_count}{Colors.END}",
-                end="",
-            )
+            metrics.sample_rates()
+            relays_up = sum(1 for r in relays if r.healthy)
+            if worker is not None:
+                worker.send("stats", {
+                    "connections": connection_count,
+                    "workers": worker_count(),
+                    "relays": relays_up,
+                    "buffers": buffer_pool.allocated,
+                    "buffer_hits": buffer_pool.hits,
+                    "buffer_misses": buffer_pool.misses,
+                    "rss": memory.sample(),
+                    "streams": active_streams(),
+                })
+                await asyncio.sleep(1)
+                continue
+            stats_line.show([
+                (Colors.PING, "Connections", connection_count),
+                (Colors.SERVER, "Workers", worker_count()),
+                (Colors.SERVER, "Relays", f"{relays_up}/{len(relays)}"),
+                (Colors.DATABASE, "Buffers", f"{buffer_pool.allocated} ({buffer_pool.hit_rate:.0%} hit)"),
+                (Colors.DATABASE, "Mem", memory_label(memory.sample(), active_streams())),
+                (Colors.INFO, "Loop", loop_engine_name),
+            ])
             await asyncio.sleep(1)
+    stats_line = StatsLine(start_time)
     stats_task = asyncio.create_task(show_stats())
+    scan_task = asyncio.create_task(xray_scan_task())
+    metrics.gauge("blutunnel_reverse_workers", worker_count)
+    def relay_family(field):
+        return lambda: [(f'relay="{r.host}"', field(r)) for r in relays]
+    metrics.family("blutunnel_relay_healthy", relay_family(lambda r: int(r.healthy)))
+    metrics.family("blutunnel_relay_workers", relay_family(lambda r: r.links if mux_mode else len(r.pool.workers)))
+    metrics_server = await metrics.serve(worker)
+    release_listeners()
+    handoff_ready()
+    def reload():
+        nonlocal bridge_p, sync_p
+        if not running:
+            return
+        new = reload_profile("europe")
+        if new is None:
+            return
+        hosts = relay_hosts(new["iran_ip"])
+        if (new["bridge_port"], new["sync_port"]) != (bridge_p, sync_p):
+            bridge_p, sync_p = new["bridge_port"], new["sync_port"]
+            for iran in list(relays):
+                remove_relay(iran)
+        current = [r.host for r in relays]
+        if current != hosts:
+            for iran in [r for r in relays if r.host not in hosts]:
+                remove_relay(iran)
+            for host in hosts:
+                if host not in current:
+                    iran = add_relay(host)
+                    if mux_mode:
+                        rebalance_relays(relays, iran)
+                    else:
+                        iran.pool.start()
+            size_pools()
+            logger.info(f"Switching to {', '.join(hosts)} (bridge {bridge_p}, sync {sync_p})")
+        logger.info("Configuration reloaded")
+        if is_leader:
+            BeautifulUI.print_success("Configuration reloaded")
+            if new.get("mux", False) != mux_mode:
+                BeautifulUI.print_warning("Bridge mode changed: run an upgrade to apply it")
+    async def drain():
+        """Stop linking new bridges and wait for live tunnels, then end run_europe."""
+        nonlocal running
+        if not running:
+            return
+        running = False
+        for r in relays:
+            r.sync_task.cancel()
+        stats_task.cancel()
+        scan_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        for pool in pools:
+            pool.drain()
+        for session in list(mux_sessions):
+            session.go_away()
+        started = time.time()
+        busy = sum(len(pool.busy) for pool in pools)
+        logger.info(f"Draining {busy} tunnels, {len(mux_sessions)} mux sessions")
+        while (any(pool.workers for pool in pools) or mux_sessions) and time.time() - started < DRAIN_TIMEOUT:
+            await asyncio.sleep(DRAIN_POLL)
+        logger.info(f"Drained in {time.time() - started:.1f}s")
+        if not stopped.done():
+            stopped.set_result(None)
+    async def upgrade():
+        nonlocal upgrading
+        if upgrading or not running:
+            return
+        upgrading = True
+        try:
+            fds = [sock.fileno() for sock in metrics_server.sockets] if metrics_server else []
+            if await handoff("europe", fds):
+                await drain()
+        finally:
+            upgrading = False
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload)
+    if worker is None:
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.create_task(upgrade()))
+        loop.add_signal_handler(signal.SIGTERM, lambda: terminate(stopped))
+    else:
+        worker.on("drain", lambda _: asyncio.create_task(drain()))
     try:
-        await asyncio.Future()
+        await stopped
     except KeyboardInterrupt:
         print("\n")
         BeautifulUI.print_warning("Shutting down gracefully...")
-        running = False
-        sync_task_obj.cancel()
-        stats_task.cancel()
-        for w in workers:
-            w.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
-        BeautifulUI.print_success("Shutdown complete")
-async def start_iran(key):
+    running = False
+    for r in relays:
+        r.sync_task.cancel()
+    stats_task.cancel()
+    scan_task.cancel()
+    if metrics_server:
+        metrics_server.close()
+    for w in workers:
+        w.cancel()
+    for pool in pools:
+        workers += pool.stop()
+    for session in list(mux_sessions):
+        session.close()
+    await asyncio.gather(*workers, return_exceptions=True)
+    BeautifulUI.print_success("Shutdown complete")
+def prompt_iran_profile():
     BeautifulUI.print_banner()
     BeautifulUI.print_section("Iran Mode", "I")
     try:
@@ -817,184 +4512,1294 @@ async def start_iran(key):
         if not (validate_port(bridge_p) and validate_port(sync_p)):
             BeautifulUI.print_error("Invalid port number")
             input(f"{Colors.GRAY}Press Enter...{Colors.END}")
-            return
+            return None
     except ValueError:
         BeautifulUI.print_error("Port must be a number")
         input(f"{Colors.GRAY}Press Enter...{Colors.END}")
-        return
+        return None
     auto_mode = BeautifulUI.input_with_style("Auto-Sync Xray ports? (y/n)", "A", "y").strip().lower() == "y"
-    save_tunnel_profile("iran", {
+    mux_mode = BeautifulUI.input_with_style("Multiplex bridge? (y/n)", "X", "n").strip().lower() == "y"
+    keys = []
+    if not auto_mode:
+        port_text = BeautifulUI.input_with_style(
+            "Enter ports manually (e.g. 80,443,2083,443/udp)",
+            "P",
+        )
+        for p_str in port_text.split(","):
+            key = parse_port_key(p_str)
+            if key is not None:
+                keys.append(key)
+    return {
         "bind_ip": "0.0.0.0",
         "bridge_port": bridge_p,
         "sync_port": sync_p,
         "auto_mode": auto_mode,
-    })
-    connection_pool = asyncio.Queue(maxsize=MAX_POOL * 2)
+        "mux": mux_mode,
+        "manual_ports": [k for k in keys if k < UDP_PORT_KEY],
+        "manual_udp_ports": [k & 0xFFFF for k in keys if k >= UDP_PORT_KEY],
+    }
+
+def start_iran(key, workers=1):
+    profile = prompt_iran_profile()
+    if profile is None:
+        return
+    save_tunnel_profile("iran", profile)
+    launch_mode("iran", key, profile, workers)
+
+async def run_iran(key, profile, worker=None):
+    bridge_p = profile["bridge_port"]
+    sync_p = profile["sync_port"]
+    auto_mode = profile.get("auto_mode", True)
+    bind_ip = profile.get("bind_ip", "0.0.0.0")
+    mux_mode = profile.get("mux", False)
+    key_hash = hash_key(key)
+    # Worker processes share listeners through SO_REUSEPORT; only the leader
+    # serves the sync port and relays the port set to its siblings.
+    reuse_port = worker is not None
+    is_leader = worker is None or worker.leader
+    cluster_status = None
+    balancer = UpstreamBalancer(MAX_POOL * 2, UPSTREAM_STALE, profile.get("balance", UPSTREAM_BALANCE))
+    balancer.by_port = auto_mode
+    balancer.set_classes(*port_classes(profile))
+    mux_sessions = set()
+    mux_ready = asyncio.Event()
     active_servers = {}
+    port_lock = asyncio.Lock()
     running = True
+    upgrading = False
+    stopped = asyncio.get_running_loop().create_future()
+    user_conns = set()
+    sync_writers = set()
     connection_count = 0
     start_time = time.time()
     last_queue_log = 0.0
     dropped_bridge = 0
+    pick_waiters = 0
+    auth_rejected = 0
+    last_reject_log = 0.0
+    def reject(writer, channel, verdict):
+        nonlocal auth_rejected, last_reject_log
+        writer.transport.abort()
+        if verdict is None:
+            return
+        auth_rejected += 1
+        metrics.inc("blutunnel_auth_rejected_total")
+        now = time.time()
+        if now - last_reject_log >= LOG_THROTTLE_SEC:
+            peer = writer.get_extra_info("peername")
+            logger.warning(
+                f"Rejected unauthenticated {channel.decode()} connection from {peer[0] if peer else '?'} "
+                f"({auth_rejected} total)"
+            )
+            last_reject_log = now
+    async def handle_mux_bridge(reader, writer, up):
+        try:
+            magic = await asyncio.wait_for(reader.readexactly(len(MUX_MAGIC)), timeout=CONN_TIMEOUT)
+        except Exception as e:
+            logger.debug("Mux bridge handshake failed: %s", e)
+            writer.close()
+            return
+        if magic != MUX_MAGIC:
+            logger.debug("Mux bridge sent bad magic")
+            writer.close()
+            return
+        session = MuxSession(reader, writer, label=up.name)
+        mux_sessions.add(session)
+        up.sessions.add(session)
+        mux_ready.set()
+        try:
+            await session.run()
+        finally:
+            mux_sessions.discard(session)
+            up.sessions.discard(session)
+            if not mux_sessions:
+                mux_ready.clear()
     async def handle_europe_bridge(reader, writer):
         nonlocal connection_count, last_queue_log, dropped_bridge
-        await tune(writer)
+        # Junk connections are dropped here, before they can take a pool slot.
+        verdict = await auth_challenge(reader, writer, key_hash, AUTH_BRIDGE)
+        if not verdict:
+            reject(writer, AUTH_BRIDGE, verdict)
+            return
         try:
-            await asyncio.wait_for(connection_pool.put((reader, writer)), timeout=5)
-            connection_count += 1
-        except asyncio.TimeoutError:
-            dropped_bridge += 1
-            now = time.time()
-            if now - last_queue_log >= LOG_THROTTLE_SEC:
-                logger.debug(
-                    f"Bridge queue full (pool={connection_pool.qsize()}/{connection_pool.maxsize}, dropped={dropped_bridge})"
-                )
-                last_queue_log = now
-                dropped_bridge = 0
+            hello = await asyncio.wait_for(reader.readexactly(1 + NODE_ID_SIZE), timeout=AUTH_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
             writer.close()
-        except Exception as e:
-            logger.debug(f"Bridge put failed: {e}")
+            return
+        if not running:
             writer.close()
-    async def get_healthy_bridge(deadline_sec=BRIDGE_PICK_TIMEOUT):
+            return
+        caps, up = hello[0], balancer.get(hello[1:])
+        peer = writer.get_extra_info("peername")
+        if peer:
+            up.name = f"{peer[0]}/{up.node.hex()[:8]}"
+        # The auth exchange has given the kernel an RTT sample for this path.
+        up.observe_rtt(tcp_rtt(writer))
+        up.seen = time.time()
+        await tune_bridge(writer)
+        if mux_mode:
+            await handle_mux_bridge(reader, writer, up)
+            return
+        if balancer.add_bridge(up, (reader, writer, caps)):
+            connection_count += 1
+            return
+        dropped_bridge += 1
+        metrics.inc("blutunnel_bridge_dropped_total")
+        now = time.time()
+        if now - last_queue_log >= LOG_THROTTLE_SEC:
+            logger.debug("Bridge pool full (pool=%s/%s, dropped=%s)", balancer.parked, balancer.capacity, dropped_bridge)
+            last_queue_log = now
+            dropped_bridge = 0
+        writer.close()
+    async def get_healthy_bridge(target_p, deadline_sec=BRIDGE_PICK_TIMEOUT):
+        nonlocal pick_waiters
+        pick_waiters += 1
+        try:
+            return await balancer.pick(target_p, deadline_sec)
+        finally:
+            pick_waiters -= 1
+    async def bridge_keepalive_task():
+        while running:
+            await asyncio.sleep(BRIDGE_HEARTBEAT_INTERVAL)
+            balancer.sweep(heartbeat=True)
+    async def upstream_monitor_task():
+        last = time.time()
+        while running:
+            await asyncio.sleep(UPSTREAM_TICK)
+            now = time.time()
+            forgot = balancer.tick(now - last)
+            if is_leader and worker is not None:
+                # Only the leader hears sync frames; the others learn liveness from it.
+                worker.send("seen", {up.node.hex(): up.seen for up in balancer.upstreams.values()})
+            if forgot and auto_mode and is_leader:
+                # A vanished node's ports go once no other node reports them.
+                await apply_port_set(balancer.ports())
+                if worker is not None:
+                    worker.send("ports", balancer.port_map())
+            last = now
+    def pool_status(up):
+        balancer.sweep()
+        return balancer.status(up, cluster_status)
+    async def get_mux_session(target_p, deadline_sec=BRIDGE_PICK_TIMEOUT):
         deadline = time.time() + deadline_sec
         while True:
+            picked = balancer.pick_session(target_p)
+            if picked is not None:
+                return picked
             remaining = deadline - time.time()
             if remaining <= 0:
-                return None, None
+                return None
+            if mux_sessions:
+                await asyncio.sleep(min(remaining, 0.05))
+                continue
             try:
-                e_reader, e_writer = await asyncio.wait_for(connection_pool.get(), timeout=remaining)
+                await asyncio.wait_for(mux_ready.wait(), timeout=remaining)
             except asyncio.TimeoutError:
-                return None, None
-            if e_writer.is_closing() or e_reader.at_eof():
-                try:
-                    e_writer.close()
-                except Exception:
-                    pass
-                continue
-            return e_reader, e_writer
+                return None
     async def handle_user_side(reader, writer, target_p):
+        # A draining process waits for these before it exits.
+        user_conns.add(writer)
+        try:
+            await serve_user(reader, writer, target_p)
+        finally:
+            user_conns.discard(writer)
+    def shape_flow(writer, target_p, route):
+        peer = writer.get_extra_info("peername")
+        return shaper.flow(target_p, peer[0] if peer else None, metrics.port(route))
+    async def serve_user(reader, writer, target_p, udp=False):
+        nonlocal connection_count
+        if not memory.admit():
+            writer.close()
+            return
         await tune(writer)
-        e_reader, e_writer = await get_healthy_bridge()
-        if e_writer is None:
+        started = time.perf_counter()
+        # Upstreams are matched on the port key their sync reported.
+        route = udp_key(target_p) if udp else target_p
+        if mux_mode:
+            picked = await get_mux_session(route)
+            if picked is None:
+                metrics.inc("blutunnel_bridge_pick_timeouts_total")
+                writer.close()
+                return
+            metrics.observe("blutunnel_bridge_pick_wait_seconds", time.perf_counter() - started)
+            connection_count += 1
+            up, session = picked
+            try:
+                await session.open_stream(target_p, reader, writer, udp, shape_flow(writer, target_p, route))
+            finally:
+                balancer.release(up)
+            return
+        picked = await get_healthy_bridge(route)
+        if picked is None:
+            metrics.inc("blutunnel_bridge_pick_timeouts_total")
             writer.close()
             return
+        metrics.observe("blutunnel_bridge_pick_wait_seconds", time.perf_counter() - started)
+        up, (e_reader, e_writer, caps) = picked
+        moved = 0
+        failed = False
+        reused = False
         try:
-            e_writer.write(struct.pack("!H", target_p))
+            codec = CODEC_NONE if udp else port_codec(target_p, caps)
+            stats = metrics.port(route)
+            header = BRIDGE_HEADER.pack(target_p, codec | (BRIDGE_UDP if udp else 0))
+            try:
+                first = await asyncio.wait_for(reader.read(BUFFER_SIZE), timeout=BRIDGE_FIRST_BYTES_WAIT)
+            except asyncio.TimeoutError:
+                first = None
+            if first == b"":
+                # The client left without sending anything; the bridge is still unused.
+                writer.close()
+                balancer.release(up, port=route)
+                reused = True
+                if not balancer.add_bridge(up, (e_reader, e_writer, caps)):
+                    e_writer.close()
+                return
+            if first:
+                # The header rides in the same segment as the client's first bytes;
+                # a compressed stream carries them as one raw frame.
+                stats.bytes[0] += len(first)
+                if codec:
+                    stats.codec[0] += len(first)
+                    stats.codec[1] += CODEC_FRAME.size + len(first)
+                    header += CODEC_FRAME.pack(len(first))
+                e_writer.write(header + first)
+            else:
+                e_writer.write(header)
             await asyncio.wait_for(e_writer.drain(), timeout=BRIDGE_SEND_TIMEOUT)
-            await asyncio.gather(
-                pipe(reader, e_writer),
-                pipe(e_reader, writer),
-                return_exceptions=True,
-            )
+            shape = shape_flow(writer, target_p, route)
+            if shape and shape[0] and first:
+                shape[0].consume(len(first))
+            record = registry.add(route, writer, up.name)
+            try:
+                moved = await relay(reader, writer, e_reader, e_writer, stats, codec, shape=shape)
+            finally:
+                registry.remove(record)
         except Exception as e:
-            logger.debug(f"Bridge handoff failed on port {target_p}: {e}")
+            logger.debug("Bridge handoff failed on port %s via %s: %s", target_p, up.name, e)
+            failed = True
             if not e_writer.is_closing():
                 e_writer.close()
             writer.close()
-    async def open_new_port(p):
-        if p in active_servers:
+        finally:
+            if not reused:
+                balancer.release(up, moved, failed, route)
+    async def bind_port(p):
+        if p & UDP_PORT_KEY:
+            port = p & 0xFFFF
+            listener = UdpListener(lambda stream: serve_user(stream, stream, port, udp=True))
+            return await listen_datagram(listener, bind_ip, port, reuse_port=reuse_port)
+        return await listen(
+            lambda r, w, p=p: handle_user_side(r, w, p),
+            bind_ip,
+            p,
+            backlog=5000,
+            limit=BUFFER_SIZE,
+            reuse_port=reuse_port,
+        )
+    async def apply_port_set(ports):
+        """Move the listeners to ``ports`` as one transaction.
+
+        New ports are bound concurrently first; old ones are closed only once
+        every bind has finished, and an interrupted apply rolls its binds back
+        so the previous set stays intact.
+        """
+        async with port_lock:
+            if not running:
+                return
+            started = time.perf_counter()
+            to_open = sorted(set(ports) - active_servers.keys())
+            to_close = sorted(active_servers.keys() - set(ports))
+            if not to_open and not to_close:
+                return
+            results = await bind_all(to_open, bind_port)
+            failed = []
+            for p, result in zip(to_open, results):
+                if isinstance(result, BaseException):
+                    failed.append(p)
+                    logger.debug("Error opening port %s: %s", port_label(p), result)
+                else:
+                    active_servers[p] = result
+            for p in to_close:
+                active_servers.pop(p).close()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.observe("blutunnel_port_apply_seconds", elapsed_ms / 1000)
+        opened = len(to_open) - len(failed)
+        summary = (
+            f"Ports applied in {elapsed_ms:.1f} ms: {len(active_servers)} active, "
+            f"+{opened} -{len(to_close)}"
+        )
+        if failed:
+            preview = ", ".join(port_label(p) for p in failed[:10])
+            logger.error(f"Error opening {len(failed)} ports: {preview}{', ...' if len(failed) > 10 else ''}")
+            summary += f", {len(failed)} failed"
+        logger.info(summary)
+        if is_leader:
+            if len(to_open) + len(to_close) <= PORT_APPLY_DETAIL:
+                for p in to_open:
+                    if p in active_servers:
+                        BeautifulUI.print_success(f"Port Active: {port_label(p)}")
+                for p in to_close:
+                    BeautifulUI.print_warning(f"Port Closed: {port_label(p)}")
+            BeautifulUI.print_success(summary)
+    async def handle_sync_conn(reader, writer):
+        verdict = await auth_challenge(reader, writer, key_hash, AUTH_SYNC)
+        if not verdict:
+            reject(writer, AUTH_SYNC, verdict)
             return
+        sync_writers.add(writer)
         try:
-            srv = await asyncio.start_server(
-                lambda r, w, p=p: handle_user_side(r, w, p),
-                "0.0.0.0",
-                p,
-                backlog=5000,
-                limit=BUFFER_SIZE,
+            hello = await asyncio.wait_for(
+                reader.readexactly(len(SYNC_MAGIC) + NODE_ID_SIZE),
+                timeout=CONN_TIMEOUT,
             )
-            asyncio.create_task(srv.serve_forever())
-            active_servers[p] = srv
-            BeautifulUI.print_success(f"Port Active: {p}")
-        except Exception as e:
-            logger.error(f"Error opening port {p}: {e}")
-    async def close_missing_ports(new_ports):
-        for p, srv in list(active_servers.items()):
-            if p not in new_ports:
-                srv.close()
-                await srv.wait_closed()
-                del active_servers[p]
-                BeautifulUI.print_warning(f"Port Closed: {p}")
-    async def handle_sync_conn(reader, writer):
-        try:
-            header = await asyncio.wait_for(reader.readexactly(1), timeout=CONN_TIMEOUT)
-            count = struct.unpack("!B", header)[0]
+            if hello[:len(SYNC_MAGIC)] != SYNC_MAGIC:
+                logger.debug("Sync rejected: bad magic")
+                return
+            up = balancer.get(hello[len(SYNC_MAGIC):])
+            await tune(writer)
+            version = 0
             ports = set()
-            for _ in range(count):
-                p_data = await asyncio.wait_for(reader.readexactly(2), timeout=CONN_TIMEOUT)
-                p = struct.unpack("!H", p_data)[0]
-                if validate_port(p):
-                    ports.add(p)
-                    await open_new_port(p)
-            await close_missing_ports(ports)
-            logger.info(f"Synced {len(ports)} ports")
+            while running:
+                kind, frame_version, added, removed = await read_sync(reader, SYNC_IDLE_TIMEOUT)
+                up.seen = time.time()
+                changed = False
+                if kind == SYNC_FULL:
+                    ports = added
+                    version = frame_version
+                    changed = True
+                elif kind == SYNC_DELTA and frame_version == version + 1:
+                    ports = (ports | added) - removed
+                    version = frame_version
+                    changed = True
+                # Polls and out-of-order deltas just ack the version we hold;
+                # Europe answers a stale ack with a full snapshot.
+                if changed:
+                    up.ports = set(ports)
+                if changed and auto_mode:
+                    # Listeners follow the union; picks still go by each node's own set.
+                    merged = balancer.ports()
+                    await apply_port_set(merged)
+                    if worker is not None:
+                        worker.send("ports", balancer.port_map())
+                    logger.info(f"Synced {len(ports)} ports from {up.name} (v{version}), {len(merged)} total")
+                writer.write(SYNC_HEADER.pack(SYNC_ACK, version, 0, 0) + pool_status(up))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
         except Exception as e:
-            logger.debug(f"Sync read failed: {e}")
+            logger.debug("Sync read failed: %s", e)
         finally:
+            sync_writers.discard(writer)
             writer.close()
-    bridge_server = await asyncio.start_server(
+    bridge_server = await listen(
         handle_europe_bridge,
         "0.0.0.0",
         bridge_p,
         backlog=10000,
         limit=BUFFER_SIZE,
+        reuse_port=reuse_port,
     )
-    if auto_mode:
-        sync_server = await asyncio.start_server(
+    # The sync port also reports pool status back to Europe, so it listens in
+    # manual mode too; received port lists are only applied in auto mode.
+    sync_server = None
+    if is_leader:
+        sync_server = await listen(
             handle_sync_conn,
             "0.0.0.0",
             sync_p,
             backlog=200,
             limit=BUFFER_SIZE,
+            reuse_port=reuse_port,
         )
-        BeautifulUI.print_success(f"Auto-Sync Active on port {sync_p}")
+    if worker is not None:
+        def on_cluster(status):
+            nonlocal cluster_status
+            cluster_status = status
+        def on_ports(port_map):
+            balancer.set_port_map(port_map)
+            asyncio.create_task(apply_port_set(balancer.ports()))
+        def on_seen(seen):
+            for node, at in seen.items():
+                up = balancer.get(bytes.fromhex(node))
+                up.seen = max(up.seen, at)
+        worker.on("ports", on_ports)
+        worker.on("seen", on_seen)
+        worker.on("cluster", on_cluster)
+    if auto_mode:
+        if is_leader:
+            BeautifulUI.print_success(f"Auto-Sync Active on port {sync_p}")
     else:
-        sync_server = None
-        manual_ports = BeautifulUI.input_with_style(
-            "Enter ports manually (e.g. 80,443,2083)",
-            "P",
-        )
-        for p_str in manual_ports.split(","):
-            p_str = p_str.strip()
-            if p_str.isdigit():
-                p = int(p_str)
-                if validate_port(p):
-                    await open_new_port(p)
+        await apply_port_set(manual_port_keys(profile))
         BeautifulUI.print_success("Manual ports opened")
     async def show_stats():
         while running:
-            uptime = time.time() - start_time
-            hours = int(uptime // 3600)
-            minutes = int((uptime % 3600) // 60)
-            seconds = int(uptime % 60)
-            print(
-                f"\r  {Colors.CYAN}Uptime: {Colors.GREEN}{hours:02d}:{minutes:02d}:{seconds:02d}{Colors.END} "
-                f"{Colors.PING} Connections: {Colors.YELLOW}{connection_count}{Colors.END} "
-                f"{Colors.SERVER} Ports: {Colors.YELLOW}{len(active_servers)}{Colors.END}",
-                end="",
-            )
+            metrics.sample_rates()
+            if worker is not None:
+                worker.send("stats", {
+                    "connections": connection_count,
+                    "ports": len(active_servers),
+                    "pool": len(mux_sessions) if mux_mode else balancer.parked,
+                    "upstreams": {up.node.hex(): balancer.report(up) for up in balancer.upstreams.values()},
+                    "healthy": sum(up.healthy for up in balancer.upstreams.values()),
+                    "evicted": balancer.evicted,
+                    "buffers": buffer_pool.allocated,
+                    "buffer_hits": buffer_pool.hits,
+                    "buffer_misses": buffer_pool.misses,
+                    "rss": memory.sample(),
+                    "streams": active_streams(),
+                })
+                await asyncio.sleep(1)
+                continue
+            stats_line.show([
+                (Colors.PING, "Connections", connection_count),
+                (Colors.SERVER, "Ports", len(active_servers)),
+                (Colors.DATABASE, "Pool", len(mux_sessions) if mux_mode else balancer.parked),
+                (Colors.SERVER, "Upstreams", f"{sum(up.healthy for up in balancer.upstreams.values())}/{len(balancer.upstreams)}"),
+                (Colors.WARNING, "Evicted", balancer.evicted),
+                (Colors.DATABASE, "Buffers", f"{buffer_pool.allocated} ({buffer_pool.hit_rate:.0%} hit)"),
+                (Colors.DATABASE, "Mem", memory_label(memory.sample(), active_streams())),
+                (Colors.INFO, "Loop", loop_engine_name),
+            ])
             await asyncio.sleep(1)
+    stats_line = StatsLine(start_time)
     stats_task = asyncio.create_task(show_stats())
-    print()
-    BeautifulUI.print_success("BluTunnel Iran Starting")
-    print(f"  {Colors.SERVER} Bridge Port: {Colors.CYAN}{bridge_p}{Colors.END}")
-    print(f"  {Colors.SERVER} Sync Port: {Colors.CYAN}{sync_p}{Colors.END}")
-    print()
+    keepalive_task = asyncio.create_task(bridge_keepalive_task())
+    monitor_task = asyncio.create_task(upstream_monitor_task())
+    metrics.gauge("blutunnel_listening_ports", lambda: len(active_servers))
+    metrics.gauge("blutunnel_bridge_pool_depth", lambda: balancer.parked)
+    metrics.gauge("blutunnel_bridge_pick_waiters", lambda: pick_waiters)
+    metrics.gauge("blutunnel_bridge_reserved", balancer.reserved)
+    metrics.gauge("blutunnel_bridge_evicted_total", lambda: balancer.evicted, "counter")
+    metrics.gauge("blutunnel_mux_sessions", lambda: len(mux_sessions))
+    def upstream_family(field):
+        return lambda: [(f'upstream="{up.name}"', field(up)) for up in balancer.upstreams.values()]
+    metrics.family("blutunnel_upstream_healthy", upstream_family(lambda up: int(up.healthy)))
+    metrics.family("blutunnel_upstream_idle_bridges", upstream_family(lambda up: len(up.idle) + len(up.sessions)))
+    metrics.family("blutunnel_upstream_active_streams", upstream_family(lambda up: up.active))
+    metrics.family("blutunnel_upstream_picks_total", upstream_family(lambda up: up.picks), "counter")
+    metrics.family("blutunnel_upstream_rtt_seconds", upstream_family(lambda up: f"{up.rtt or 0:.6f}"))
+    metrics.family("blutunnel_upstream_throughput_bytes_per_second", upstream_family(lambda up: int(up.rate)))
+    metrics_server = await metrics.serve(worker)
+    if auto_mode and inherited_listeners:
+        # Keep serving the user ports handed over by the previous process
+        # until Europe's first sync arrives.
+        await apply_port_set(set(inherited_listeners))
+    release_listeners()
+    handoff_ready()
+    if is_leader:
+        print()
+        BeautifulUI.print_success("BluTunnel Iran Starting")
+        print(f"  {Colors.SERVER} Bridge Port: {Colors.CYAN}{bridge_p}{Colors.END}")
+        print(f"  {Colors.SERVER} Sync Port: {Colors.CYAN}{sync_p}{Colors.END}")
+        if mux_mode:
+            print(f"  {Colors.INFO} Bridge Mode: {Colors.YELLOW}multiplexed{Colors.END}")
+        if worker is not None:
+            print(f"  {Colors.INFO} Worker Processes: {Colors.YELLOW}{worker.count}{Colors.END}")
+        print()
+    async def reload():
+        nonlocal auto_mode
+        if not running:
+            return
+        new = reload_profile("iran")
+        if new is None:
+            return
+        fixed = {
+            "bind_ip": (bind_ip, new.get("bind_ip", "0.0.0.0")),
+            "bridge_port": (bridge_p, new["bridge_port"]),
+            "sync_port": (sync_p, new["sync_port"]),
+            "mux": (mux_mode, new.get("mux", False)),
+        }
+        was_auto = auto_mode
+        auto_mode = balancer.by_port = new.get("auto_mode", True)
+        balancer.set_policy(new.get("balance", UPSTREAM_BALANCE))
+        balancer.set_classes(*port_classes(new))
+        if not auto_mode:
+            await apply_port_set(manual_port_keys(new))
+        elif not was_auto and is_leader:
+            # Back to auto-sync: serve the port sets the Europe nodes last reported.
+            await apply_port_set(balancer.ports())
+            if worker is not None:
+                worker.send("ports", balancer.port_map())
+        logger.info("Configuration reloaded")
+        if is_leader:
+            BeautifulUI.print_success("Configuration reloaded")
+            changed = [name for name, (old, value) in fixed.items() if old != value]
+            if changed:
+                BeautifulUI.print_warning(f"Changed {', '.join(changed)}: run an upgrade to apply")
+    async def drain():
+        """Stop accepting and wait for live user connections, then end run_iran."""
+        nonlocal running
+        if not running:
+            return
+        running = False
+        stats_task.cancel()
+        for server in (bridge_server, sync_server, metrics_server, *active_servers.values()):
+            if server:
+                server.close()
+        for sync_writer in list(sync_writers):
+            sync_writer.close()
+        balancer.close_idle()
+        for session in list(mux_sessions):
+            session.go_away()
+        started = time.time()
+        logger.info(f"Draining {len(user_conns)} connections")
+        while user_conns and time.time() - started < DRAIN_TIMEOUT:
+            await asyncio.sleep(DRAIN_POLL)
+        if user_conns:
+            logger.warning(f"Drain timeout: closing {len(user_conns)} connections")
+            for user_writer in list(user_conns):
+                user_writer.transport.abort()
+        for session in list(mux_sessions):
+            session.close()
+        logger.info(f"Drained in {time.time() - started:.1f}s")
+        if not stopped.done():
+            stopped.set_result(None)
+    async def upgrade():
+        nonlocal upgrading
+        if upgrading or not running:
+            return
+        upgrading = True
+        try:
+            servers = (bridge_server, sync_server, metrics_server, *active_servers.values())
+            fds = [sock.fileno() for server in servers if server for sock in server.sockets]
+            if await handoff("iran", fds):
+                await drain()
+        finally:
+            upgrading = False
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload()))
+    if worker is None:
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.create_task(upgrade()))
+        loop.add_signal_handler(signal.SIGTERM, lambda: terminate(stopped))
+    else:
+        worker.on("drain", lambda _: asyncio.create_task(drain()))
     try:
         if sync_server:
             async with bridge_server, sync_server:
-                await asyncio.Future()
+                await stopped
         else:
             async with bridge_server:
-                await asyncio.Future()
+                await stopped
     except KeyboardInterrupt:
         print("\n")
         BeautifulUI.print_warning("Shutting down gracefully...")
-        running = False
-        stats_task.cancel()
-        for srv in list(active_servers.values()):
-            srv.close()
-            await srv.wait_closed()
+    running = False
+    stats_task.cancel()
+    keepalive_task.cancel()
+    monitor_task.cancel()
+    if metrics_server:
+        metrics_server.close()
+    for srv in active_servers.values():
+        srv.close()
+    # Reset live users so their relays unwind here instead of being cancelled
+    # when the loop shuts down.
+    for user_writer in list(user_conns):
+        user_writer.transport.abort()
+    for session in list(mux_sessions):
+        session.close()
+    balancer.close_idle()
+    for _ in range(10):
+        if not user_conns:
+            break
+        await asyncio.sleep(DRAIN_POLL / 10)
+    await asyncio.gather(
+        *(srv.wait_closed() for srv in active_servers.values()),
+        return_exceptions=True,
+    )
+    BeautifulUI.print_success("Shutdown complete")
+class WorkerChannel:
+    """Child side of the supervisor link: stats go up, control messages down."""
+
+    def __init__(self, index, count, conn):
+        self.index = index
+        self.count = count
+        self.conn = conn
+        self.handlers = {}
+
+    @property
+    def leader(self):
+        return self.index == 0
+
+    def send(self, kind, payload):
+        try:
+            self.conn.send((kind, payload))
+        except (OSError, EOFError):
+            self._orphaned()
+
+    def on(self, kind, handler):
+        if not self.handlers:
+            asyncio.get_running_loop().add_reader(self.conn.fileno(), self._dispatch)
+        self.handlers[kind] = handler
+
+    def _dispatch(self):
+        try:
+            kind, payload = self.conn.recv()
+        except (OSError, EOFError):
+            self._orphaned()
+            return
+        handler = self.handlers.get(kind)
+        if handler:
+            handler(payload)
+
+    def _orphaned(self):
+        logger.warning(f"Worker {self.index}: supervisor gone, exiting")
+        os._exit(1)
+
+def worker_main(mode, key, profile, index, count, conn):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Reload and upgrade signals reach workers through the supervisor.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    channel = WorkerChannel(index, count, conn)
+    runner = run_iran if mode == "iran" else run_europe
+    try:
+        run_async(runner(key, profile, worker=channel))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Forked children leave through os._exit, which skips atexit.
+        stop_logging()
+
+class WorkerSupervisor:
+    """Runs a mode in N forked worker processes and restarts crashed ones.
+
+    Children report stats once per second; the supervisor prints the
+    aggregate line. On Iran, the leader (worker 0) owns the sync port: the
+    port sets it applies are forwarded to the other workers, and the summed
+    pool numbers are sent back to it for the status replies to Europe.
+    SIGHUP is forwarded to the workers; SIGUSR2 starts the new binary next to
+    them (SO_REUSEPORT) and drains them without restarts.
+    """
+
+    def __init__(self, mode, key, profile, count):
+        self.mode = mode
+        self.key = key
+        self.profile = profile
+        self.count = count
+        self.ctx = multiprocessing.get_context("fork")
+        self.children = {}
+        self.ports = None
+        self.stats_line = StatsLine(time.time())
+        self.last_stats = 0.0
+        self.draining = False
+        self.upgrade_requested = False
+        # (process, ready fd, deadline) of an upgrade waiting for its ready byte.
+        self.successor = None
+
+    def spawn(self, index):
+        parent_conn, child_conn = self.ctx.Pipe()
+        proc = self.ctx.Process(
+            target=worker_main,
+            args=(self.mode, self.key, self.profile, index, self.count, child_conn),
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+        child = self.children.setdefault(index, {"backoff": 1, "restarts": 0})
+        child.update(proc=proc, conn=parent_conn, stats={}, started=time.time(), restart_at=None)
+        if self.ports is not None and index > 0:
+            self._send(child, "ports", self.ports)
+
+    def _send(self, child, kind, payload):
+        if child["conn"] is None:
+            return
+        try:
+            child["conn"].send((kind, payload))
+        except (OSError, EOFError):
+            pass
+
+    def _receive(self, conn):
+        index, child = next((i, c) for i, c in self.children.items() if c["conn"] is conn)
+        try:
+            kind, payload = conn.recv()
+        except (OSError, EOFError):
+            conn.close()
+            child["conn"] = None
+            return
+        if kind == "stats":
+            child["stats"] = payload
+        elif kind in ("ports", "seen"):
+            if kind == "ports":
+                self.ports = payload
+            for other_index, other in self.children.items():
+                if other_index != index:
+                    self._send(other, kind, payload)
+
+    def _reap(self):
+        now = time.time()
+        for index, child in self.children.items():
+            if self.draining:
+                continue
+            if child["restart_at"] is not None:
+                if now >= child["restart_at"]:
+                    child["restarts"] += 1
+                    self.spawn(index)
+                continue
+            if child["proc"].is_alive():
+                continue
+            if now - child["started"] > 30:
+                child["backoff"] = 1
+            logger.warning(
+                f"Worker {index} exited (code {child['proc'].exitcode}), restarting in {child['backoff']}s"
+            )
+            if child["conn"] is not None:
+                child["conn"].close()
+                child["conn"] = None
+            child["stats"] = {}
+            child["restart_at"] = now + child["backoff"]
+            child["backoff"] = min(child["backoff"] * 2, 10)
+
+    def _total(self, field):
+        return sum(c["stats"].get(field, 0) for c in self.children.values())
+
+    def _show_stats(self):
+        if self.mode == "iran" and 0 in self.children:
+            # Per Europe node: [idle, waiting, picks] summed over the workers.
+            cluster = {}
+            for child in self.children.values():
+                for node, counts in child["stats"].get("upstreams", {}).items():
+                    cluster[node] = [a + b for a, b in zip(cluster.get(node, (0, 0, 0)), counts)]
+            self._send(self.children[0], "cluster", cluster)
+        alive = sum(1 for c in self.children.values() if c["proc"].is_alive())
+        fields = [
+            (Colors.SERVER, "Procs", f"{alive}/{self.count}"),
+            (Colors.PING, "Connections", self._total("connections")),
+        ]
+        if self.mode == "iran":
+            ports = max((c["stats"].get("ports", 0) for c in self.children.values()), default=0)
+            healthy = max((c["stats"].get("healthy", 0) for c in self.children.values()), default=0)
+            fields += [
+                (Colors.SERVER, "Ports", ports),
+                (Colors.DATABASE, "Pool", self._total("pool")),
+                (Colors.SERVER, "Upstreams", healthy),
+                (Colors.WARNING, "Evicted", self._total("evicted")),
+            ]
+        else:
+            relays = min((c["stats"].get("relays", 0) for c in self.children.values()), default=0)
+            fields += [
+                (Colors.SERVER, "Workers", self._total("workers")),
+                (Colors.SERVER, "Relays up", relays),
+            ]
+        hits = self._total("buffer_hits")
+        lookups = hits + self._total("buffer_misses")
+        fields += [
+            (Colors.DATABASE, "Buffers", f"{self._total('buffers')} ({hits / lookups if lookups else 0:.0%} hit)"),
+            (Colors.DATABASE, "Mem", memory_label(self._total("rss"), self._total("streams"))),
+            (Colors.INFO, "Loop", loop_engine_name),
+        ]
+        self.stats_line.show(fields)
+
+    def _forward(self, sig):
+        for child in self.children.values():
+            if child["proc"].is_alive():
+                os.kill(child["proc"].pid, sig)
+
+    def _alive(self):
+        return any(c["proc"].is_alive() for c in self.children.values())
+
+    def upgrade(self):
+        """Start the new binary; ``run`` watches its ready fd next to the workers."""
+        self.upgrade_requested = False
+        if self.draining or self.successor is not None:
+            return
+        fds = [sock.fileno() for sock in inherited_listeners.values()]
+        started = start_successor(self.mode, fds)
+        if started is not None:
+            self.successor = (*started, time.time() + HANDOFF_READY_TIMEOUT)
+
+    def _check_successor(self, ready):
+        proc, ready_r, deadline = self.successor
+        if ready:
+            # A successor that died before signalling reads as EOF.
+            byte = os.read(ready_r, 1)
+        elif time.time() < deadline and proc.poll() is None:
+            return
+        else:
+            byte = b""
+        self.successor = None
+        if not finish_successor(proc, ready_r, byte):
+            return
+        self.draining = True
+        for child in self.children.values():
+            self._send(child, "drain", None)
+
+    def stop(self):
+        if self.successor is not None:
+            proc, ready_r, _ = self.successor
+            self.successor = None
+            finish_successor(proc, ready_r, b"")
+        for child in self.children.values():
+            if child["proc"].is_alive():
+                child["proc"].terminate()
+        for child in self.children.values():
+            child["proc"].join(timeout=5)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        signal.signal(signal.SIGHUP, lambda *_: self._forward(signal.SIGHUP))
+        signal.signal(signal.SIGUSR2, lambda *_: setattr(self, "upgrade_requested", True))
+        for index in range(self.count):
+            self.spawn(index)
+        handoff_ready(notify=False)
+        try:
+            while not self.draining or self._alive():
+                conns = [c["conn"] for c in self.children.values() if c["conn"] is not None]
+                if self.successor is not None:
+                    conns.append(self.successor[1])
+                ready = multiprocessing.connection.wait(conns, timeout=1)
+                for conn in ready:
+                    if self.successor is None or conn != self.successor[1]:
+                        self._receive(conn)
+                if self.successor is not None:
+                    self._check_successor(self.successor[1] in ready)
+                if self.upgrade_requested:
+                    self.upgrade()
+                self._reap()
+                now = time.time()
+                if not self.draining and now - self.last_stats >= 1:
+                    self.last_stats = now
+                    self._show_stats()
+        except KeyboardInterrupt:
+            print("\n")
+            BeautifulUI.print_warning("Shutting down workers...")
+        finally:
+            self.stop()
         BeautifulUI.print_success("Shutdown complete")
+
+def terminate(stopped):
+    """SIGTERM in a single-process run: end it through the normal shutdown path."""
+    if not stopped.done():
+        sd_notify("STOPPING=1")
+        print("\n")
+        BeautifulUI.print_warning("Shutting down gracefully...")
+        stopped.set_result(None)
+
+def write_pid_file():
+    try:
+        with open(PID_FILE, "w") as f:
+            f.write(f"{os.getpid()}\n")
+    except OSError as e:
+        logger.warning(f"Cannot write {PID_FILE}: {e}")
+
+def remove_pid_file():
+    """Remove PID_FILE unless an upgrade's new process has taken it over."""
+    try:
+        with open(PID_FILE) as f:
+            if int(f.read().strip() or 0) == os.getpid():
+                os.remove(PID_FILE)
+    except (OSError, ValueError):
+        pass
+
+def signal_running(sig):
+    """Send ``sig`` to the instance recorded in PID_FILE."""
+    try:
+        with open(PID_FILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, sig)
+    except (OSError, ValueError) as e:
+        BeautifulUI.print_error(f"No running tunnel found via {PID_FILE}: {e}")
+        return 1
+    BeautifulUI.print_success(f"Sent {sig.name} to {pid}")
+    return 0
+
+def reload_profile(mode):
+    """Re-read the config on SIGHUP: settings apply at once, the profile is returned."""
+    config = load_config()
+    apply_settings(config, cli_args)
+    return headless_profile(mode, cli_args, config)
+
+def start_successor(mode, fds=()):
+    """Start a new copy of this program on ``fds``; returns (process, ready fd) or None.
+
+    The interactive menu saved the running profile as last_<mode>, so the
+    new process gets the headless subcommand for it when none was given.
+    """
+    argv = [sys.executable] + sys.argv
+    if cli_args is None or cli_args.command != mode:
+        argv.append(mode)
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ)
+    env[HANDOFF_READY_ENV] = str(ready_w)
+    if fds:
+        env[HANDOFF_ENV] = ",".join(str(fd) for fd in fds)
+    try:
+        proc = subprocess.Popen(argv, env=env, pass_fds=(*fds, ready_w))
+    except OSError as e:
+        logger.error(f"Upgrade failed to start {argv[1]}: {e}")
+        os.close(ready_r)
+        return None
+    finally:
+        os.close(ready_w)
+    logger.info(f"Upgrade: started pid {proc.pid} on {len(fds)} listeners")
+    return proc, ready_r
+
+def finish_successor(proc, ready_r, ready):
+    """Hand over to a successor that signalled ``ready``; otherwise stop it and carry on."""
+    global handed_over
+    os.close(ready_r)
+    if ready == b"1":
+        handed_over = True
+        # Under systemd the successor becomes the unit's main process, so this
+        # one exiting after the drain neither stops nor restarts the service.
+        sd_notify(f"MAINPID={proc.pid}")
+        logger.info(f"Upgrade: pid {proc.pid} is serving, draining pid {os.getpid()}")
+        return True
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    logger.error(f"Upgrade aborted: pid {proc.pid} did not come up (exit {proc.returncode})")
+    write_pid_file()
+    return False
+
+async def handoff(mode, fds):
+    """start_successor() and wait for its ready byte without blocking the loop."""
+    started = start_successor(mode, fds)
+    if started is None:
+        return False
+    proc, ready_r = started
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(ready_r, lambda: ready.done() or ready.set_result(os.read(ready_r, 1)))
+    try:
+        byte = await asyncio.wait_for(ready, HANDOFF_READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        byte = b""
+    finally:
+        loop.remove_reader(ready_r)
+    return finish_successor(proc, ready_r, byte)
+
+def launch_mode(mode, key, profile, workers=1):
+    write_pid_file()
+    try:
+        if workers > 1:
+            WorkerSupervisor(mode, key, profile, workers).run()
+            return
+        runner = run_iran if mode == "iran" else run_europe
+        run_async(runner(key, profile))
+    finally:
+        remove_pid_file()
+    if handed_over:
+        # The new process owns this terminal now; do not fall back to the menu.
+        sys.exit(0)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_listening(port, timeout=BENCH_READY_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def process_usage(pid=None):
+    """CPU seconds, RSS and peak RSS (KiB) of a process, read from /proc."""
+    pid = pid or os.getpid()
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        mem = {}
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    mem[name] = int(value.split()[0])
+    except (OSError, IndexError, ValueError):
+        return {"cpu_sec": 0.0, "rss_kb": 0, "peak_rss_kb": 0}
+    return {"cpu_sec": round(cpu, 3), "rss_kb": mem.get("VmRSS", 0), "peak_rss_kb": mem.get("VmHWM", 0)}
+
+def latency_summary(samples):
+    if not samples:
+        return {}
+    samples.sort()
+    def pick(q):
+        index = min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))
+        return round(samples[index] * 1000, 3)
+    return {
+        "p50_ms": pick(0.5),
+        "p99_ms": pick(0.99),
+        "p999_ms": pick(0.999),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+def bench_node(mode, key, profile):
+    """Run one tunnel side for the benchmark with the UI silenced."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.stdout = open(os.devnull, "w")
+    logger.setLevel(logging.WARNING)
+    runner = run_iran if mode == "iran" else run_europe
+    try:
+        run_async(runner(key, profile))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()
+
+async def bench_echo(reader, writer, conns):
+    conns.add(writer)
+    try:
+        while True:
+            data = await reader.read(BENCH_CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except Exception:
+        pass
+    finally:
+        conns.discard(writer)
+        writer.close()
+
+async def bench_ready(port, timeout=BENCH_READY_TIMEOUT):
+    """Wait until an echo round trip through the tunnel succeeds."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(BENCH_HOST, port), timeout=2)
+            writer.write(b"ping")
+            if await asyncio.wait_for(reader.readexactly(4), timeout=2) == b"ping":
+                return True
+        except Exception:
+            pass
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(0.2)
+    return False
+
+async def bench_connect(port, concurrency, duration):
+    """Many short connections: connect, one small echo, close."""
+    latencies = []
+    errors = 0
+    payload = os.urandom(BENCH_MESSAGE)
+    deadline = time.perf_counter() + duration
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(BENCH_HOST, port),
+                    timeout=CONN_TIMEOUT,
+                )
+                writer.write(payload)
+                await asyncio.wait_for(reader.readexactly(len(payload)), timeout=CONN_TIMEOUT)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+                await asyncio.sleep(0.01)
+            finally:
+                if writer is not None:
+                    writer.close()
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "connections": len(latencies),
+        "errors": errors,
+        "conn_per_sec": round(len(latencies) / elapsed, 1),
+        "latency": latency_summary(latencies),
+    }
+
+async def bench_bulk(port, concurrency, duration):
+    """Long transfers: every stream pushes data as fast as the echo returns it."""
+    received = 0
+    errors = 0
+    chunk = os.urandom(BENCH_CHUNK)
+    deadline = time.perf_counter() + duration
+    async def client():
+        nonlocal received, errors
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(BENCH_HOST, port),
+                timeout=CONN_TIMEOUT,
+            )
+        except Exception:
+            errors += 1
+            return
+        async def send():
+            while time.perf_counter() < deadline:
+                writer.write(chunk)
+                await writer.drain()
+        sender = asyncio.create_task(send())
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                data = await asyncio.wait_for(reader.read(BENCH_CHUNK), timeout=remaining)
+                if not data:
+                    break
+                received += len(data)
+        except asyncio.TimeoutError:
+            pass
+        except Exception:
+            errors += 1
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            writer.close()
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "streams": concurrency,
+        "errors": errors,
+        "echoed_bytes": received,
+        "throughput_mbps": round(received * 8 / elapsed / 1e6, 1),
+    }
+
+async def bench_rr(port, concurrency, duration):
+    """Interactive traffic: persistent connections doing request/response."""
+    latencies = []
+    errors = 0
+    request = os.urandom(BENCH_RR_SIZE)
+    deadline = time.perf_counter() + duration
+    async def client():
+        nonlocal errors
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(BENCH_HOST, port),
+                timeout=CONN_TIMEOUT,
+            )
+        except Exception:
+            errors += 1
+            return
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                writer.write(request)
+                await asyncio.wait_for(reader.readexactly(len(request)), timeout=CONN_TIMEOUT)
+                latencies.append(time.perf_counter() - started)
+        except Exception:
+            errors += 1
+        finally:
+            writer.close()
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "latency": latency_summary(latencies),
+    }
+
+BENCH_RUNNERS = {"connect": bench_connect, "bulk": bench_bulk, "rr": bench_rr}
+
+async def run_bench(port, nodes, workloads, concurrency, duration):
+    conns = set()
+    backend = await asyncio.start_server(
+        lambda r, w: bench_echo(r, w, conns),
+        BENCH_BACKEND,
+        port,
+        backlog=10000,
+    )
+    results = {}
+    try:
+        if not await bench_ready(port):
+            raise RuntimeError("tunnel did not come up")
+        for index, name in enumerate(workloads):
+            if index:
+                # Let tunnels from the previous workload drain first.
+                await asyncio.sleep(BENCH_SETTLE)
+            before = {side: process_usage(pid) for side, pid in nodes.items()}
+            result = await BENCH_RUNNERS[name](port, concurrency, duration)
+            after = {side: process_usage(pid) for side, pid in nodes.items()}
+            result["cpu_sec"] = {
+                side: round(after[side]["cpu_sec"] - before[side]["cpu_sec"], 3)
+                for side in nodes
+            }
+            results[name] = result
+            summary = ", ".join(
+                f"{k}={v}" for k, v in result.items() if not isinstance(v, dict)
+            )
+            BeautifulUI.print_success(f"{name}: {summary}")
+    finally:
+        backend.close()
+        # Let the echo handlers finish on their own instead of being cancelled.
+        for writer in list(conns):
+            writer.transport.abort()
+        for _ in range(50):
+            if not conns:
+                break
+            await asyncio.sleep(0.02)
+    return results
+
+def start_bench(options):
+    """Run Iran, Europe and an echo backend on loopback and write a JSON report."""
+    workloads = [w.strip() for w in options.workloads.split(",") if w.strip()]
+    unknown = [w for w in workloads if w not in BENCH_RUNNERS]
+    if unknown:
+        BeautifulUI.print_error(f"Unknown workloads: {', '.join(unknown)}")
+        return 1
+    ports = set()
+    while len(ports) < 3:
+        ports.add(free_port())
+    bridge_p, sync_p, target_p = sorted(ports)
+    mode = "mux" if options.mux else "pool"
+    profiles = {
+        "iran": {
+            "bind_ip": BENCH_HOST,
+            "bridge_port": bridge_p,
+            "sync_port": sync_p,
+            "auto_mode": False,
+            "mux": options.mux,
+            "manual_ports": [target_p],
+        },
+        "europe": {
+            "iran_ip": "127.0.0.1",
+            "bridge_port": bridge_p,
+            "sync_port": sync_p,
+            "mux": options.mux,
+        },
+    }
+    BeautifulUI.print_section(f"Benchmark ({mode}, relay {relay_engine_name}, loop {loop_engine_name})", "B")
+    # Fork the tunnel sides before the driver loop starts.
+    ctx = multiprocessing.get_context("fork")
+    procs = {}
+    for side, profile in profiles.items():
+        procs[side] = ctx.Process(target=bench_node, args=(side, "bench", profile), daemon=True)
+        procs[side].start()
+        if side == "iran":
+            wait_listening(sync_p)
+    nodes = {side: proc.pid for side, proc in procs.items()}
+    nodes["driver"] = os.getpid()
+    try:
+        results = run_async(run_bench(target_p, nodes, workloads, options.concurrency, options.duration))
+        report = {
+            "started_at": int(time.time()),
+            "mode": mode,
+            "relay_engine": relay_engine_name,
+            "loop_engine": loop_engine_name,
+            "python": sys.version.split()[0],
+            "concurrency": options.concurrency,
+            "duration_sec": options.duration,
+            "workloads": results,
+            "processes": {side: process_usage(pid) for side, pid in nodes.items()},
+        }
+    except Exception as e:
+        BeautifulUI.print_error(f"Benchmark failed: {e}")
+        return 1
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            proc.join(timeout=5)
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=2)
+    BeautifulUI.print_success(f"Report saved to {os.path.abspath(options.output)}")
+    return 0
+
 async def server_check():
     BeautifulUI.print_banner()
     BeautifulUI.print_section("Server Check", "🌍")
@@ -1045,16 +5850,20 @@ def handle_show_key(config):
 async def check_tunnel(config):
     BeautifulUI.print_banner()
     BeautifulUI.print_section("CheckTunnel", "T")
+    await report_tunnel(config)
+    print()
+    input(f"{Colors.GRAY}Press Enter...{Colors.END}")
 
+async def report_tunnel(config):
+    """Print the saved profiles and probe them; returns the number of failed checks."""
+    failures = 0
     last_europe = config.get("last_europe")
     last_iran = config.get("last_iran")
 
     if not last_europe and not last_iran:
         BeautifulUI.print_warning("No tunnel profile saved yet.")
         BeautifulUI.print_info("Tip", "Run Europe/Iran mode once to save profile", "i")
-        print()
-        input(f"{Colors.GRAY}Press Enter...{Colors.END}")
-        return
+        return 1
 
     if last_europe:
         print(f"{Colors.BOLD}Europe Profile{Colors.END}")
@@ -1065,20 +5874,24 @@ async def check_tunnel(config):
         BeautifulUI.print_info("Iran IP", iran_ip, ">")
         BeautifulUI.print_info("Bridge Port", bridge_port, ">")
         BeautifulUI.print_info("Sync Port", sync_port, ">")
+        BeautifulUI.print_info("Bridge Mode", "mux" if last_europe.get("mux") else "pool", ">")
         BeautifulUI.print_info("Updated", updated, ">")
 
-        if iran_ip != "N/A" and bridge_port != "N/A":
-            ok, msg = await tcp_probe(iran_ip, bridge_port)
-            if ok:
-                BeautifulUI.print_success(f"Bridge reachable: {iran_ip}:{bridge_port}")
-            else:
-                BeautifulUI.print_warning(f"Bridge unreachable: {iran_ip}:{bridge_port} ({msg})")
-        if iran_ip != "N/A" and sync_port != "N/A":
-            ok, msg = await tcp_probe(iran_ip, sync_port)
-            if ok:
-                BeautifulUI.print_success(f"Sync reachable: {iran_ip}:{sync_port}")
-            else:
-                BeautifulUI.print_warning(f"Sync unreachable: {iran_ip}:{sync_port} ({msg})")
+        for host in relay_hosts(iran_ip) if iran_ip != "N/A" else ():
+            if bridge_port != "N/A":
+                ok, msg = await tcp_probe(host, bridge_port)
+                if ok:
+                    BeautifulUI.print_success(f"Bridge reachable: {host}:{bridge_port}")
+                else:
+                    BeautifulUI.print_warning(f"Bridge unreachable: {host}:{bridge_port} ({msg})")
+                    failures += 1
+            if sync_port != "N/A":
+                ok, msg = await tcp_probe(host, sync_port)
+                if ok:
+                    BeautifulUI.print_success(f"Sync reachable: {host}:{sync_port}")
+                else:
+                    BeautifulUI.print_warning(f"Sync unreachable: {host}:{sync_port} ({msg})")
+                    failures += 1
         print()
 
     if last_iran:
@@ -1090,12 +5903,13 @@ async def check_tunnel(config):
         BeautifulUI.print_info("Bind IP", bind_ip, ">")
         BeautifulUI.print_info("Bridge Port", bridge_port, ">")
         BeautifulUI.print_info("Sync Port", sync_port, ">")
+        BeautifulUI.print_info("Bridge Mode", "mux" if last_iran.get("mux") else "pool", ">")
         BeautifulUI.print_info("Updated", updated, ">")
         print()
 
     xray_ports = await get_xray_ports_safe()
     if xray_ports:
-        preview = ", ".join(str(p) for p in sorted(list(xray_ports))[:10])
+        preview = ", ".join(port_label(p) for p in sorted(list(xray_ports))[:10])
         if len(xray_ports) > 10:
             preview += ", ..."
         BeautifulUI.print_success(f"Detected local xray ports: {len(xray_ports)}")
@@ -1104,8 +5918,7 @@ async def check_tunnel(config):
         BeautifulUI.print_warning("No local xray port detected")
 
     BeautifulUI.print_info("Log File", os.path.abspath(LOG_FILE), ">")
-    print()
-    input(f"{Colors.GRAY}Press Enter...{Colors.END}")
+    return failures
 
 
 def handle_show_logs():
@@ -1204,15 +6017,15 @@ def main():
                         BeautifulUI.print_error("Create KEY first")
                         input(f"{Colors.GRAY}Press Enter...{Colors.END}")
                         continue
-                    asyncio.run(start_europe(config["key"]))
+                    start_europe(config["key"])
                 elif choice == "4":
                     if "key" not in config:
                         BeautifulUI.print_error("Create KEY first")
                         input(f"{Colors.GRAY}Press Enter...{Colors.END}")
                         continue
-                    asyncio.run(start_iran(config["key"]))
+                    start_iran(config["key"])
                 elif choice == "5":
-                    asyncio.run(server_check())
+                    run_async(server_check())
                 elif choice == "6":
                     BeautifulUI.print_banner()
                     BeautifulUI.print_success("Goodbye! 👋")
@@ -1252,7 +6065,285 @@ def _show_menu_override():
 
 BeautifulUI.show_menu = staticmethod(_show_menu_override)
 
+def port_list(text):
+    keys = []
+    for p_str in text.split(","):
+        key = parse_port_key(p_str)
+        if key is None:
+            raise argparse.ArgumentTypeError(f"invalid port: {p_str.strip()!r}")
+        keys.append(key)
+    return keys
+
+def headless_profile(mode, args, config):
+    """The saved last_<mode> profile with command-line flags applied on top."""
+    profile = dict(config.get(f"last_{mode}") or {})
+    profile.pop("updated_at", None)
+    flags = vars(args) if args is not None and args.command == mode else {}
+    overrides = {
+        "bridge_port": flags.get("bridge_port"),
+        "sync_port": flags.get("sync_port"),
+        "mux": flags.get("mux"),
+    }
+    if mode == "iran":
+        overrides["bind_ip"] = flags.get("bind")
+        overrides["auto_mode"] = flags.get("auto_mode")
+        overrides["balance"] = flags.get("balance")
+        if flags.get("ports") is not None:
+            overrides["auto_mode"] = False
+            overrides["manual_ports"] = [k for k in flags["ports"] if k < UDP_PORT_KEY]
+            overrides["manual_udp_ports"] = [k & 0xFFFF for k in flags["ports"] if k >= UDP_PORT_KEY]
+    else:
+        overrides["iran_ip"] = flags.get("iran_ip")
+    profile.update({k: v for k, v in overrides.items() if v is not None})
+    required = ("iran_ip", "bridge_port", "sync_port") if mode == "europe" else ("bridge_port", "sync_port")
+    missing = [name for name in required if name not in profile]
+    if missing:
+        flags = ", ".join("--" + name.replace("_", "-") for name in missing)
+        BeautifulUI.print_error(f"No saved {mode} profile: pass {flags}")
+        return None
+    if not (validate_port(profile["bridge_port"]) and validate_port(profile["sync_port"])):
+        BeautifulUI.print_error("Invalid port number")
+        return None
+    hosts = relay_hosts(profile["iran_ip"]) if mode == "europe" else ()
+    if mode == "europe" and not (hosts and all(validate_ip(host) for host in hosts)):
+        BeautifulUI.print_error("Invalid IP address")
+        return None
+    return profile
+
+async def headless_check(host, config):
+    if not host:
+        return 1 if await report_tunnel(config) else 0
+    if not DependencyManager.check_package("aiohttp"):
+        BeautifulUI.print_error("Server check needs aiohttp: pip3 install aiohttp")
+        return 1
+    detector = ServerDetector()
+    try:
+        await detector.display_server_info(host)
+    finally:
+        await detector.close()
+    return 0
+
+async def fetch_streams(host, port, sort, n):
+    """The running tunnel's /streams rows from one metrics listener."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=CONN_TIMEOUT)
+    try:
+        writer.write(f"GET /streams?sort={sort}&n={n} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        response = await asyncio.wait_for(reader.read(), timeout=CONN_TIMEOUT + STREAMS_RATE_WINDOW)
+    finally:
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    if b" 200 " not in head.split(b"\r\n", 1)[0]:
+        raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors="replace"))
+    return json.loads(body)
+
+def traffic_label(n):
+    for unit in ("B", "K", "M", "G"):
+        if n < 1024 or unit == "G":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+async def headless_top(sort, n, workers):
+    """Print the running tunnel's top streams, merged across its workers."""
+    if not metrics.listen_port:
+        BeautifulUI.print_error("top reads the metrics listener: pass --metrics PORT or set 'metrics_port'")
+        return 1
+    host = "127.0.0.1" if metrics.bind in ("0.0.0.0", "") else "::1" if metrics.bind == "::" else metrics.bind
+    ports = [metrics.listen_port + i for i in range(workers)]
+    results = await asyncio.gather(*(fetch_streams(host, port, sort, n) for port in ports), return_exceptions=True)
+    rows = []
+    for port, result in zip(ports, results):
+        if isinstance(result, Exception):
+            BeautifulUI.print_error(f"No tunnel metrics on {host}:{port}: {result}")
+        else:
+            rows += result
+    if not rows and any(isinstance(result, Exception) for result in results):
+        return 1
+    rows = sort_streams(rows, sort)[:n]
+    if not rows:
+        BeautifulUI.print_info("Streams", "none")
+        return 0
+    BeautifulUI.print_table(
+        [
+            (
+                row["id"], row["port"], row["client"] or "-", row["bridge"] or "-",
+                f"{row['age']:.0f}s", traffic_label(row["in"]), traffic_label(row["out"]),
+                f"{traffic_label(row['rate'])}/s" if sort == "rate" else "-", f"{row['idle']:.1f}s",
+            )
+            for row in rows
+        ],
+        ["ID", "Port", "Client", "Bridge", "Age", "In", "Out", "Rate", "Idle"],
+    )
+    return 0
+
+def start_headless(args, config, workers):
+    """Run a subcommand without dependency checks, banner or prompts."""
+    if args.command == "check":
+        return run_async(headless_check(args.host, config))
+    if args.command == "top":
+        return run_async(headless_top(args.sort, max(1, args.n), workers))
+    if args.command in ("reload", "upgrade"):
+        return signal_running(signal.SIGHUP if args.command == "reload" else signal.SIGUSR2)
+    key = config.get("key")
+    if not key:
+        BeautifulUI.print_error(f"No KEY in {CONFIG_FILE}: create one from the menu first")
+        return 1
+    profile = headless_profile(args.command, args, config)
+    if profile is None:
+        return 2
+    # Until a run's event loop (or the worker supervisor) installs its own
+    # SIGTERM handler, treat SIGTERM like Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda *_: signal.raise_signal(signal.SIGINT))
+    try:
+        launch_mode(args.command, key, profile, workers)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="BluTunnel public reverse tunnel")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes for Europe/Iran mode (listeners shared with SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=LOOP_ENGINES,
+        default=None,
+        help=f"event loop engine (default: config 'loop_engine' or {LOOP_ENGINE})",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=int,
+        default=None,
+        metavar="PORT",
+        help=f"serve Prometheus metrics on {METRICS_BIND}:PORT (default: config 'metrics_port', off)",
+    )
+    parser.add_argument(
+        "--relay",
+        choices=RELAY_ENGINES,
+        default=None,
+        help=f"relay engine for user connections (default: config 'relay_engine' or {RELAY_ENGINE})",
+    )
+    parser.add_argument(
+        "--compress",
+        default=None,
+        metavar="PORT=CODEC,...",
+        help="compress pool-mode bridge streams per port, e.g. 80=zlib,*=zstd (Iran side; default: config 'compress_ports')",
+    )
+    parser.add_argument(
+        "--coalesce",
+        choices=("on", "off"),
+        default=None,
+        help="adaptive TCP_CORK coalescing of small bridge writes (default: config 'coalesce' or on)",
+    )
+    parser.add_argument(
+        "--shape",
+        default=None,
+        metavar="PORT=RATE,...",
+        help="rate limit per user port and direction, e.g. 443=20mbit,*=5mbit (Iran side; default: config 'shape_ports')",
+    )
+    parser.add_argument(
+        "--shape-client",
+        default=None,
+        metavar="RATE",
+        help="rate limit per client IP and direction (Iran side; default: config 'shape_client')",
+    )
+    parser.add_argument(
+        "--shape-link",
+        default=None,
+        metavar="RATE",
+        help="rate limit for the whole bridge link per direction (Iran side; default: config 'shape_link')",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        default=None,
+        metavar="SIZE",
+        help="memory budget for user streams, e.g. 2g; sizes socket buffers adaptively and refuses new streams past it (default: config 'memory_budget', off)",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default=None,
+        help=f"console and {LOG_FILE} log level (default: config 'log_level' or {LOG_LEVEL})",
+    )
+    commands = parser.add_subparsers(dest="command")
+    bench = commands.add_parser("bench", help="run the loopback benchmark and write a JSON report")
+    bench.add_argument("--mux", action="store_true", help="benchmark multiplexed bridge mode")
+    bench.add_argument(
+        "--workloads",
+        default=",".join(BENCH_WORKLOADS),
+        help=f"comma-separated workloads (default: {','.join(BENCH_WORKLOADS)})",
+    )
+    bench.add_argument("--concurrency", type=int, default=50, help="concurrent clients per workload")
+    bench.add_argument("--duration", type=float, default=10, help="seconds per workload")
+    bench.add_argument("--output", default=BENCH_OUTPUT, help=f"report path (default: {BENCH_OUTPUT})")
+    for mode in ("iran", "europe"):
+        sub = commands.add_parser(mode, help=f"run {mode.capitalize()} mode without prompts (flags override the saved profile)")
+        if mode == "europe":
+            sub.add_argument("--iran-ip", help="Iran server IP, or a comma-separated list of relays")
+        else:
+            sub.add_argument("--bind", help="address for the public listeners (default: 0.0.0.0)")
+            ports = sub.add_mutually_exclusive_group()
+            ports.add_argument("--auto", dest="auto_mode", action="store_const", const=True, help="auto-sync xray ports from Europe")
+            ports.add_argument("--ports", type=port_list, help="manual comma-separated port list, 443/udp for UDP (disables auto-sync)")
+            sub.add_argument("--balance", choices=UPSTREAM_BALANCES, help=f"how to pick a Europe upstream (default: {UPSTREAM_BALANCE})")
+        sub.add_argument("--bridge-port", type=int, help="tunnel bridge port")
+        sub.add_argument("--sync-port", type=int, help="port sync port")
+        bridge = sub.add_mutually_exclusive_group()
+        bridge.add_argument("--mux", dest="mux", action="store_const", const=True, help="multiplexed bridge mode")
+        bridge.add_argument("--pool", dest="mux", action="store_const", const=False, help="pooled bridge mode")
+    check = commands.add_parser("check", help="check the saved tunnel profiles, or analyse a server with check-host.net")
+    check.add_argument("host", nargs="?", help="IP or domain to analyse (default: probe the saved profiles)")
+    commands.add_parser("reload", help=f"re-read the config in the running tunnel ({PID_FILE}); live streams keep running")
+    commands.add_parser("upgrade", help="start a new process on the running tunnel's listeners and drain the old one")
+    top = commands.add_parser("top", help="list the running tunnel's heaviest live streams (needs its metrics port)")
+    top.add_argument("-n", type=int, default=STREAMS_TOP, help=f"streams to list (default: {STREAMS_TOP})")
+    top.add_argument(
+        "--sort",
+        choices=STREAMS_SORTS,
+        default="rate",
+        help=f"order by rate over the last {STREAMS_RATE_WINDOW}s, total bytes, age or idle time (default: rate)",
+    )
+    return parser.parse_args(argv)
+
+def apply_settings(config, args):
+    """Engine and relay settings: flags first, then the config. Re-run on reload."""
+    select_relay_engine(args.relay or config.get("relay_engine", RELAY_ENGINE))
+    select_compression(args.compress if args.compress is not None else config.get("compress_ports"))
+    select_coalescing(args.coalesce == "on" if args.coalesce else config.get("coalesce", COALESCE))
+    select_shaping(
+        args.shape if args.shape is not None else config.get("shape_ports"),
+        args.shape_client if args.shape_client is not None else config.get("shape_client"),
+        args.shape_link if args.shape_link is not None else config.get("shape_link"),
+        config.get("shape_weights"),
+    )
+    select_memory_budget(args.memory_budget if args.memory_budget is not None else config.get("memory_budget", MEMORY_BUDGET))
+    select_logging(
+        args.log_level or config.get("log_level", LOG_LEVEL),
+        config.get("log_max_size", LOG_MAX_BYTES),
+        config.get("log_backups", LOG_BACKUPS),
+        config.get("log_rotate", LOG_ROTATE),
+    )
+
 def main():
+    global cli_args
+    args = cli_args = parse_args()
+    workers = max(1, args.workers)
+    config = load_config()
+    select_loop_engine(args.loop or config.get("loop_engine", LOOP_ENGINE))
+    apply_settings(config, args)
+    adopt_listeners()
+    metrics.listen_port = args.metrics if args.metrics is not None else config.get("metrics_port", METRICS_PORT)
+    metrics.bind = config.get("metrics_bind", METRICS_BIND)
+    if args.command == "bench":
+        optimize()
+        sys.exit(start_bench(args))
+    if args.command:
+        optimize()
+        sys.exit(start_headless(args, config, workers))
+    DependencyManager.ensure_dependencies()
     try:
         optimize()
         while True:
@@ -1264,13 +6355,13 @@ def main():
                 elif choice == "2":
                     handle_show_key(config)
                 elif choice == "3":
-                    asyncio.run(start_europe(config.get("key", "")))
+                    start_europe(config.get("key", ""), workers)
                 elif choice == "4":
-                    asyncio.run(start_iran(config.get("key", "")))
+                    start_iran(config.get("key", ""), workers)
                 elif choice == "5":
-                    asyncio.run(server_check())
+                    run_async(server_check())
                 elif choice == "6":
-                    asyncio.run(check_tunnel(config))
+                    run_async(check_tunnel(config))
                 elif choice == "7":
                     handle_show_logs()
                 elif choice == "8":
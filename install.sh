@@ -19,6 +19,7 @@ echo "[BluTunnel] Installing Python dependency: aiohttp..."
 export PIP_ROOT_USER_ACTION=ignore
 python3 -m pip install --upgrade pip >/dev/null
 python3 -m pip install aiohttp >/dev/null
+python3 -m pip install uvloop >/dev/null 2>&1 || echo "[BluTunnel] uvloop not installed, using default asyncio loop"
 
 if [ -d "$INSTALL_DIR/.git" ]; then
   echo "[BluTunnel] Existing install found at $INSTALL_DIR, updating..."
@@ -0,0 +1,24 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def _tcp_pair():
+    """A connected (reader, writer) pair for each end of one loopback TCP connection."""
+    accepted = asyncio.get_running_loop().create_future()
+    server = await asyncio.start_server(lambda r, w: accepted.set_result((r, w)), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = await asyncio.open_connection("127.0.0.1", port)
+    peer = await accepted
+    server.close()
+    return client, peer
+
+
+@pytest.fixture
+def tcp_pair():
+    """Coroutine function returning ``(client, peer)`` stream pairs; await it inside the test's loop."""
+    return _tcp_pair
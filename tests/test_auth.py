@@ -0,0 +1,56 @@
+import asyncio
+import hashlib
+
+import blutunnel
+
+KEY = hashlib.sha256(b"secret").digest()
+
+
+def challenge(tcp_pair, answer_key, answer_channel=blutunnel.AUTH_BRIDGE):
+    async def main():
+        (iran_r, iran_w), (eu_r, eu_w) = await tcp_pair()
+        answer = asyncio.create_task(blutunnel.auth_answer(eu_r, eu_w, answer_key, answer_channel))
+        ok = await blutunnel.auth_challenge(iran_r, iran_w, KEY, blutunnel.AUTH_BRIDGE)
+        await answer
+        iran_w.close()
+        eu_w.close()
+        return ok
+
+    return asyncio.run(main())
+
+
+def test_matching_key_passes(tcp_pair):
+    assert challenge(tcp_pair, KEY) is True
+
+
+def test_wrong_key_fails(tcp_pair):
+    assert challenge(tcp_pair, hashlib.sha256(b"other").digest()) is False
+
+
+def test_token_is_bound_to_the_channel(tcp_pair):
+    assert challenge(tcp_pair, KEY, blutunnel.AUTH_SYNC) is False
+    nonce = bytes(blutunnel.AUTH_NONCE)
+    assert blutunnel.auth_token(KEY, blutunnel.AUTH_BRIDGE, nonce) != blutunnel.auth_token(KEY, blutunnel.AUTH_SYNC, nonce)
+
+
+def test_silent_probe_returns_none(tcp_pair):
+    async def main():
+        (iran_r, iran_w), (eu_r, eu_w) = await tcp_pair()
+        eu_w.close()
+        ok = await blutunnel.auth_challenge(iran_r, iran_w, KEY, blutunnel.AUTH_BRIDGE)
+        iran_w.close()
+        return ok
+
+    assert asyncio.run(main()) is None
+
+
+def test_short_answer_fails(tcp_pair):
+    async def main():
+        (iran_r, iran_w), (eu_r, eu_w) = await tcp_pair()
+        eu_w.write(b"x" * (blutunnel.AUTH_TOKEN - 1))
+        eu_w.close()
+        ok = await blutunnel.auth_challenge(iran_r, iran_w, KEY, blutunnel.AUTH_BRIDGE)
+        iran_w.close()
+        return ok
+
+    assert asyncio.run(main()) is False
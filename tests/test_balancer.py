@@ -0,0 +1,180 @@
+import asyncio
+
+import blutunnel
+
+
+class FakeReader:
+    def __init__(self):
+        self.eof = False
+
+    def at_eof(self):
+        return self.eof
+
+
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def bridge():
+    return FakeReader(), FakeWriter(), b"\0"
+
+
+def balancer():
+    return blutunnel.UpstreamBalancer(capacity=10, stale=60)
+
+
+def test_parked_bridge_is_picked_and_released():
+    async def main():
+        lb = balancer()
+        up = lb.get(b"node0001")
+        assert lb.add_bridge(up, bridge())
+        picked = await lb.pick(443, 1)
+        assert picked[0] is up and lb.parked == 0 and up.active == 1 and lb.held[443] == 1
+        lb.release(up, port=443)
+        assert up.active == 0 and 443 not in lb.held
+
+    asyncio.run(main())
+
+
+def test_waiter_gets_next_bridge_and_timeout_cleans_queue():
+    async def main():
+        lb = balancer()
+        up = lb.get(b"node0001")
+        assert await lb.pick(443, 0.01) is None
+        assert not any(lb.waiters)
+        waiting = asyncio.create_task(lb.pick(443, 1))
+        await asyncio.sleep(0)
+        fresh = bridge()
+        lb.add_bridge(up, fresh)
+        assert (await waiting) == (up, fresh)
+        assert lb.parked == 0 and not any(lb.waiters)
+
+    asyncio.run(main())
+
+
+def test_hand_off_racing_the_timeout_is_kept(monkeypatch):
+    async def main():
+        lb = balancer()
+        up = lb.get(b"node0001")
+        fresh = bridge()
+
+        async def late_wait_for(fut, timeout):
+            # The bridge arrives in the same tick the timeout fires.
+            lb.add_bridge(up, fresh)
+            raise asyncio.TimeoutError
+
+        monkeypatch.setattr(asyncio, "wait_for", late_wait_for)
+        assert (await lb.pick(443, 1)) == (up, fresh)
+        assert up.active == 1 and lb.held[443] == 1 and not any(lb.waiters)
+
+    asyncio.run(main())
+
+
+def test_reservation_keeps_bridges_for_its_port():
+    async def main():
+        lb = balancer()
+        lb.set_classes({8443: 1}, {})
+        up = lb.get(b"node0001")
+        lb.add_bridge(up, bridge())
+        assert await lb.pick(443, 0.01) is None
+        assert (await lb.pick(8443, 0.01))[0] is up
+
+    asyncio.run(main())
+
+
+def test_priority_class_served_first():
+    async def main():
+        lb = balancer()
+        lb.set_classes({}, {22: blutunnel.PORT_PRIORITIES.index("high")})
+        up = lb.get(b"node0001")
+        low = asyncio.create_task(lb.pick(80, 1))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(lb.pick(22, 1))
+        await asyncio.sleep(0)
+        lb.add_bridge(up, bridge())
+        assert (await high)[0] is up
+        assert not low.done()
+        low.cancel()
+
+    asyncio.run(main())
+
+
+def test_waiter_takes_a_bridge_from_a_down_node_when_no_healthy_one_has_any():
+    async def main():
+        lb = balancer()
+        down = lb.get(b"node0001")
+        down.healthy = False
+        waiting = asyncio.create_task(lb.pick(443, 0.5))
+        await asyncio.sleep(0)
+        fresh = bridge()
+        assert lb.add_bridge(down, fresh)
+        assert (await waiting) == (down, fresh)
+        assert lb.parked == 0 and down.active == 1
+
+    asyncio.run(main())
+
+
+def test_down_node_bridge_parks_while_a_healthy_node_has_bridges():
+    async def main():
+        lb = balancer()
+        lb.set_classes({443: 1}, {})
+        healthy = lb.get(b"node0001")
+        down = lb.get(b"node0002")
+        down.healthy = False
+        assert lb.add_bridge(healthy, bridge())
+        # The only parked bridge is owed to 443's reservation, so 80 queues.
+        waiting = asyncio.create_task(lb.pick(80, 0.5))
+        await asyncio.sleep(0)
+        assert lb.add_bridge(down, bridge())
+        # The down node's bridge parks and covers the reservation, freeing the healthy one.
+        assert (await waiting)[0] is healthy
+        assert lb.parked == 1 and list(down.idle)
+
+    asyncio.run(main())
+
+
+def test_sweep_evicts_dead_bridges_and_beats_on_live_ones():
+    async def main():
+        lb = balancer()
+        up = lb.get(b"node0001")
+        live, reset, closed = bridge(), bridge(), bridge()
+        reset[0].eof = True
+        closed[1].closed = True
+        for b in (live, reset, closed):
+            lb.add_bridge(up, b)
+        lb.sweep()
+        assert live[1].data == b""
+        lb.sweep(heartbeat=True)
+        return lb, up, live
+
+    lb, up, live = asyncio.run(main())
+    assert list(up.idle) == [live] and lb.parked == 1 and lb.evicted == 2
+    assert live[1].data == blutunnel.BRIDGE_HEADER.pack(blutunnel.BRIDGE_HEARTBEAT_PORT, blutunnel.CODEC_NONE)
+
+
+def test_bridge_whose_peer_went_away_is_evicted(tcp_pair):
+    async def main():
+        lb = balancer()
+        up = lb.get(b"node0001")
+        (iran_r, iran_w), (eu_r, eu_w) = await tcp_pair()
+        lb.add_bridge(up, (iran_r, iran_w, b"\0"))
+        eu_w.close()
+        await asyncio.sleep(0.05)
+        lb.sweep(heartbeat=True)
+        picked = await lb.pick(443, 0.01)
+        iran_w.close()
+        return lb, picked
+
+    lb, picked = asyncio.run(main())
+    assert picked is None and lb.evicted == 1 and lb.parked == 0
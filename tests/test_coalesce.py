@@ -0,0 +1,131 @@
+import asyncio
+import socket
+
+import pytest
+
+import blutunnel
+
+
+class FakeTimer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Manual clock; call_later only records the deadline."""
+
+    def __init__(self):
+        self.now = 100.0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+
+@pytest.fixture
+def bridge_sock():
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    peer, _ = server.accept()
+    yield client, peer
+    for s in (client, peer, server):
+        s.close()
+
+
+def corked(sock):
+    return sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_CORK) == 1
+
+
+def test_isolated_small_writes_are_not_corked(bridge_sock):
+    loop = FakeLoop()
+    cork = blutunnel.Coalescer(loop, bridge_sock[0])
+    cork.before_write(10)
+    loop.now += blutunnel.COALESCE_BURST_GAP * 2
+    cork.before_write(10)
+    assert not corked(cork.sock) and not loop.timers
+    cork.close(blutunnel.PortStats())
+
+
+def test_burst_corks_until_the_deadline(bridge_sock):
+    loop = FakeLoop()
+    cork = blutunnel.Coalescer(loop, bridge_sock[0])
+    cork.before_write(10)
+    loop.now += blutunnel.COALESCE_BURST_GAP / 2
+    cork.before_write(10)
+    assert corked(cork.sock)
+    [timer] = loop.timers
+    assert timer.when == pytest.approx(loop.now + blutunnel.COALESCE_DEADLINE)
+    # Writes during the cork do not push the deadline out.
+    cork.before_write(10)
+    assert len(loop.timers) == 1
+    timer.callback()
+    assert not corked(cork.sock) and cork.timer is None
+    cork.close(blutunnel.PortStats())
+
+
+def test_large_writes_and_replies_break_a_burst(bridge_sock):
+    loop = FakeLoop()
+    cork = blutunnel.Coalescer(loop, bridge_sock[0])
+    cork.before_write(blutunnel.COALESCE_SMALL_WRITE)
+    cork.before_write(blutunnel.COALESCE_SMALL_WRITE)
+    cork.before_write(10)
+    cork.reply.before_write(10)
+    cork.before_write(10)
+    assert not corked(cork.sock) and not loop.timers
+    cork.close(blutunnel.PortStats())
+
+
+def test_disabled_coalescer_never_corks(bridge_sock):
+    loop = FakeLoop()
+    cork = blutunnel.Coalescer(loop, bridge_sock[0], enabled=False)
+    cork.before_write(10)
+    cork.before_write(10)
+    assert not corked(cork.sock) and not loop.timers
+    cork.close(blutunnel.PortStats())
+
+
+def test_close_flushes_a_pending_cork_and_counts_the_bytes(bridge_sock):
+    client, peer = bridge_sock
+    loop = FakeLoop()
+    cork = blutunnel.Coalescer(loop, client)
+    cork.before_write(5)
+    cork.before_write(5)
+    client.sendall(b"hello")
+    [timer] = loop.timers
+    stats = blutunnel.PortStats()
+    moved = cork.close(stats)
+    assert timer.cancelled and not corked(client)
+    peer.settimeout(1)
+    assert peer.recv(16) == b"hello"
+    if cork.start is not None:
+        assert moved == 5 and stats.segments[0] >= 1
+
+
+def test_corked_bytes_leave_by_the_deadline(bridge_sock):
+    client, peer = bridge_sock
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        cork = blutunnel.Coalescer(loop, client)
+        cork.before_write(5)
+        cork.before_write(5)
+        client.sendall(b"abc")
+        peer.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            peer.recv(16)
+        await asyncio.sleep(blutunnel.COALESCE_DEADLINE + 0.05)
+        data = peer.recv(16)
+        cork.close(blutunnel.PortStats())
+        return data
+
+    assert asyncio.run(main()) == b"abc"
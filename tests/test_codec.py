@@ -0,0 +1,81 @@
+import asyncio
+import os
+import zlib
+
+import pytest
+
+import blutunnel
+
+
+def feed(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def encode(chunks, codec=blutunnel.CODEC_ZLIB):
+    encoder = blutunnel._CodecEncoder(codec, blutunnel.PortStats(), 0)
+    reader = feed(b"".join(chunks))
+    wire = b""
+    while frame := await encoder.read(reader):
+        wire += frame
+    return wire
+
+
+async def decode(wire, codec=blutunnel.CODEC_ZLIB):
+    decoder = blutunnel._CodecDecoder(codec, blutunnel.PortStats(), 0)
+    reader = feed(wire)
+    out = b""
+    while data := await decoder.read(reader):
+        out += data
+    return out
+
+
+def test_round_trip_mixed_payloads():
+    data = b"compressible " * 20000 + os.urandom(200000) + b"tail"
+    wire = asyncio.run(encode([data]))
+    assert len(wire) < len(data)
+    assert asyncio.run(decode(wire)) == data
+
+
+def test_encoder_honours_read_size():
+    async def main():
+        encoder = blutunnel._CodecEncoder(blutunnel.CODEC_ZLIB, blutunnel.PortStats(), 0)
+        return await encoder.read(feed(b"x" * 10000), 100)
+
+    frame = asyncio.run(main())
+    assert blutunnel.CODEC_FRAME.unpack_from(frame)[0] == 100
+
+
+def test_oversized_frame_is_rejected():
+    header = blutunnel.CODEC_FRAME.pack(blutunnel.CODEC_FRAME_MAX + 1)
+    with pytest.raises(ValueError):
+        asyncio.run(decode(header + b"\0" * 16))
+
+
+def test_decompression_bomb_is_rejected():
+    compressor = zlib.compressobj(9)
+    bomb = compressor.compress(b"\0" * (64 * blutunnel.BUFFER_SIZE)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert len(bomb) <= blutunnel.CODEC_FRAME_MAX
+    wire = blutunnel.CODEC_FRAME.pack(blutunnel.CODEC_COMPRESSED | len(bomb)) + bomb
+    with pytest.raises(ValueError):
+        asyncio.run(decode(wire))
+
+
+def test_truncated_frame_raises():
+    wire = asyncio.run(encode([b"payload" * 100]))
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(decode(wire[:-3]))
+
+
+def test_zstd_round_trip_and_bomb():
+    zstandard = pytest.importorskip("zstandard")
+    data = b"zstd " * 50000 + os.urandom(100000)
+    wire = asyncio.run(encode([data], blutunnel.CODEC_ZSTD))
+    assert asyncio.run(decode(wire, blutunnel.CODEC_ZSTD)) == data
+    compressor = zstandard.ZstdCompressor(level=19).compressobj()
+    bomb = compressor.compress(b"\0" * (64 * blutunnel.BUFFER_SIZE)) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    wire = blutunnel.CODEC_FRAME.pack(blutunnel.CODEC_COMPRESSED | len(bomb)) + bomb
+    with pytest.raises(ValueError):
+        asyncio.run(decode(wire, blutunnel.CODEC_ZSTD))
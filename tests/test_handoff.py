@@ -0,0 +1,100 @@
+import asyncio
+import os
+import socket
+import sys
+
+import pytest
+
+import blutunnel
+
+READY = "import os; os.write(int(os.environ[{env!r}]), b'1')".format(env=blutunnel.HANDOFF_READY_ENV)
+FAIL = "raise SystemExit(3)"
+
+
+@pytest.fixture
+def notify_socket(tmp_path, monkeypatch):
+    path = str(tmp_path / "notify")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(5)
+    monkeypatch.setenv("NOTIFY_SOCKET", path)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def successor(monkeypatch, tmp_path):
+    """Point start_successor at a ``python -c`` script instead of this program."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blutunnel, "handed_over", False)
+    monkeypatch.setattr(blutunnel, "cli_args", None)
+
+    def use(script):
+        monkeypatch.setattr(sys, "argv", ["-c", script])
+
+    return use
+
+
+def test_adopted_listeners_are_keyed_by_port_and_udp_key(monkeypatch):
+    tcp = socket.create_server(("127.0.0.1", 0))
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(("127.0.0.1", 0))
+    tcp_port = tcp.getsockname()[1]
+    udp_port = udp.getsockname()[1]
+    monkeypatch.setenv(blutunnel.HANDOFF_ENV, f"{os.dup(tcp.fileno())},{os.dup(udp.fileno())}")
+    tcp.close()
+    udp.close()
+    try:
+        adopted = blutunnel.adopt_listeners()
+        assert set(adopted) == {tcp_port, blutunnel.udp_key(udp_port)}
+        assert blutunnel.HANDOFF_ENV not in os.environ
+
+        async def main():
+            server = await blutunnel.listen(lambda r, w: w.close(), "127.0.0.1", tcp_port)
+            _, writer = await asyncio.open_connection("127.0.0.1", tcp_port)
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(main())
+        assert list(blutunnel.inherited_listeners) == [blutunnel.udp_key(udp_port)]
+        udp_sock = blutunnel.inherited_listeners[blutunnel.udp_key(udp_port)]
+        blutunnel.release_listeners()
+        assert udp_sock.fileno() == -1 and not blutunnel.inherited_listeners
+    finally:
+        blutunnel.release_listeners()
+
+
+def test_ready_successor_takes_over_as_main_pid(successor, notify_socket):
+    successor(READY)
+    assert asyncio.run(blutunnel.handoff("iran", ()))
+    assert blutunnel.handed_over
+    message = notify_socket.recv(4096).decode()
+    assert message.startswith("MAINPID=") and int(message[8:]) != os.getpid()
+
+
+def test_failed_successor_aborts_and_keeps_the_pid_file(successor, notify_socket):
+    successor(FAIL)
+    assert not asyncio.run(blutunnel.handoff("iran", ()))
+    assert not blutunnel.handed_over
+    with open(blutunnel.PID_FILE) as f:
+        assert int(f.read()) == os.getpid()
+    notify_socket.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        notify_socket.recv(4096)
+
+
+def test_handoff_ready_notifies_systemd_and_the_parent(notify_socket, monkeypatch):
+    ready_r, ready_w = os.pipe()
+    monkeypatch.setattr(blutunnel, "handoff_ready_fd", ready_w)
+    blutunnel.handoff_ready()
+    assert os.read(ready_r, 1) == b"1"
+    assert os.read(ready_r, 1) == b""
+    os.close(ready_r)
+    assert blutunnel.handoff_ready_fd is None
+    assert notify_socket.recv(4096) == b"READY=1"
+
+
+def test_sd_notify_without_a_socket_is_a_no_op(monkeypatch):
+    monkeypatch.delenv("NOTIFY_SOCKET", raising=False)
+    blutunnel.sd_notify("READY=1")
@@ -0,0 +1,115 @@
+import logging
+import os
+import queue
+import time
+
+import pytest
+
+import blutunnel
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def record(msg):
+    return blutunnel.logger.makeRecord("BluTunnel", logging.INFO, __file__, 0, msg, None, None)
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    handlers = []
+
+    def make(max_bytes=0, backups=2, period=None):
+        handler = blutunnel.LogFile(str(tmp_path / "blutunnel.log"))
+        handler.maxBytes = max_bytes
+        handler.backupCount = backups
+        handler.period = period
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(handler)
+        return handler
+
+    yield make
+    for handler in handlers:
+        handler.close()
+
+
+def read(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+def test_size_rotation_keeps_the_configured_backups(log_file, tmp_path):
+    handler = log_file(max_bytes=30)
+    for i in range(10):
+        handler.handle(record(f"line-{i:02d}-padding"))
+    base = tmp_path / "blutunnel.log"
+    assert read(base) == ["line-09-padding"]
+    assert read(f"{base}.1") == ["line-08-padding"]
+    assert read(f"{base}.2") == ["line-07-padding"]
+    assert not os.path.exists(f"{base}.3")
+
+
+def test_period_rotation_starts_a_new_file(log_file, tmp_path):
+    handler = log_file(period="%Y-%m-%d")
+    handler.handle(record("yesterday"))
+    handler.opened_at -= 86400
+    handler.handle(record("today"))
+    handler.handle(record("later"))
+    base = tmp_path / "blutunnel.log"
+    assert read(f"{base}.1") == ["yesterday"]
+    assert read(base) == ["today", "later"]
+
+
+def test_file_from_an_earlier_period_is_rotated_at_startup(log_file, tmp_path):
+    base = tmp_path / "blutunnel.log"
+    base.write_text("old run\n")
+    old = time.time() - 3 * 86400
+    os.utime(base, (old, old))
+    handler = log_file(period="%Y-%m-%d")
+    handler.handle(record("new"))
+    assert read(f"{base}.1") == ["old", "run"]
+    assert read(base) == ["new"]
+
+
+def test_rotation_by_another_process_is_followed(log_file, tmp_path):
+    base = tmp_path / "blutunnel.log"
+    writer, other = log_file(max_bytes=30), log_file(max_bytes=30)
+    writer.handle(record("first"))
+    other.handle(record("second-line-padding"))
+    other.handle(record("rotates-the-file-now"))
+    writer.handle(record("after"))
+    assert read(f"{base}.1") == ["first", "second-line-padding"]
+    assert read(base) == ["rotates-the-file-now", "after"]
+
+
+def test_full_queue_drops_records_and_the_writer_reports_them(monkeypatch):
+    source = blutunnel.LogQueue()
+    source.queue = queue.Queue(2)
+    for i in range(5):
+        source.enqueue(record(f"r{i}"))
+    assert source.dropped == 3
+    sink = ListHandler()
+    writer = blutunnel.LogWriter(source, sink)
+    writer.start()
+    writer.stop()
+    assert sink.messages == ["Log writer fell behind: 3 records dropped", "r0", "r1"]
+    source.enqueue(record("r5"))
+    writer.start()
+    writer.stop()
+    # Drops already reported are not reported again.
+    assert sink.messages[-1] == "r5" and len(sink.messages) == 4
+
+
+def test_queue_defers_formatting_to_the_writer():
+    source = blutunnel.LogQueue()
+    item = record("value %s")
+    item.args = ({"lazy": 1},)
+    source.enqueue(source.prepare(item))
+    queued = source.queue.get_nowait()
+    assert queued is item and queued.args == ({"lazy": 1},)
@@ -0,0 +1,51 @@
+import asyncio
+import sys
+
+import pytest
+
+import blutunnel
+
+
+@pytest.fixture(autouse=True)
+def restore_engine():
+    # Start from the stock policy even if the runner installed uvloop's.
+    policy = asyncio.get_event_loop_policy()
+    asyncio.set_event_loop_policy(None)
+    yield
+    blutunnel.select_loop_engine("asyncio")
+    asyncio.set_event_loop_policy(policy)
+
+
+async def loop_module():
+    return type(asyncio.get_running_loop()).__module__
+
+
+def test_asyncio_engine_runs_the_default_loop():
+    assert blutunnel.select_loop_engine("asyncio") == "asyncio"
+    assert blutunnel.run_async(loop_module()).startswith("asyncio")
+
+
+def test_auto_engine_uses_uvloop_when_installed():
+    pytest.importorskip("uvloop")
+    assert blutunnel.select_loop_engine("auto") == "uvloop"
+    assert blutunnel.loop_engine_name == "uvloop"
+    assert blutunnel.run_async(loop_module()).startswith("uvloop")
+
+
+@pytest.mark.parametrize("name", ["auto", "uvloop"])
+def test_missing_uvloop_falls_back_to_asyncio(name, monkeypatch):
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    assert blutunnel.select_loop_engine(name) == "asyncio"
+    assert blutunnel.run_async(loop_module()).startswith("asyncio")
+
+
+def test_unknown_engine_falls_back_to_asyncio():
+    assert blutunnel.select_loop_engine("trio") == "asyncio"
+    assert blutunnel._loop_factory is None
+
+
+def test_loop_flag_is_limited_to_known_engines(capsys):
+    assert blutunnel.parse_args(["--loop", "uvloop"]).loop == "uvloop"
+    assert blutunnel.parse_args([]).loop is None
+    with pytest.raises(SystemExit):
+        blutunnel.parse_args(["--loop", "trio"])
@@ -0,0 +1,72 @@
+import asyncio
+import socket
+
+import blutunnel
+
+
+class FakeWriter:
+    def __init__(self):
+        self.sock = socket.socket()
+
+    def get_extra_info(self, name):
+        return self.sock if name == "socket" else None
+
+
+def test_leases_are_sampled_in_bounded_slices(monkeypatch):
+    sampled = []
+    monkeypatch.setattr(blutunnel, "MEM_SLICE", 10)
+    monkeypatch.setattr(blutunnel, "tcp_moved", lambda writer: sampled.append(writer) or 0)
+
+    async def main():
+        budget = blutunnel.MemoryBudget(budget=1 << 40)
+        writers = [FakeWriter() for _ in range(25)]
+        leases = [budget.lease(w) for w in writers]
+        budget.timer.cancel()
+        sampled.clear()
+        budget.release(leases[12])
+        slices = []
+        for _ in range(3):
+            budget._tick()
+            budget.timer.cancel()
+            slices.append(len(budget.pass_queue))
+        delay = budget.pass_delay
+        for w in writers:
+            w.sock.close()
+        return slices, delay, set(sampled) == set(writers) - {writers[12]}
+
+    slices, delay, covered = asyncio.run(main())
+    # 24 live leases in slices of 10: three callbacks, a third of a tick apart.
+    assert slices == [14, 4, 0]
+    assert delay == blutunnel.MEM_TICK / 3
+    assert covered
+
+
+def test_busy_lease_grows_and_quiet_one_shrinks(monkeypatch):
+    moved = {}
+    monkeypatch.setattr(blutunnel, "tcp_moved", lambda writer: moved.get(writer, 0))
+
+    async def main():
+        budget = blutunnel.MemoryBudget(budget=1 << 40)
+        busy, quiet = FakeWriter(), FakeWriter()
+        busy_lease = budget.lease(busy)
+        quiet_lease = budget.lease(quiet)
+        budget.timer.cancel()
+        budget._resize(quiet_lease, 4 * blutunnel.MEM_SOCK_MIN)
+        for lease in (busy_lease, quiet_lease):
+            lease.sampled -= 1
+        moved[busy] = 10 * blutunnel.MEM_SOCK_MIN
+        budget._tick()
+        budget.timer.cancel()
+        grown = busy_lease.size
+        for _ in range(blutunnel.MEM_IDLE_TICKS - 1):
+            quiet_lease.sampled -= 1
+            budget._tick()
+            budget.timer.cancel()
+        for w in (busy, quiet):
+            w.sock.close()
+        return grown, quiet_lease.size, budget.leased
+
+    grown, quiet_size, leased = asyncio.run(main())
+    assert grown == 2 * blutunnel.MEM_SOCK_MIN
+    assert quiet_size == blutunnel.MEM_SOCK_MIN
+    assert leased == 2 * (grown + quiet_size)
@@ -0,0 +1,35 @@
+import blutunnel
+
+
+def test_udp_ports_render_apart_from_tcp():
+    metrics = blutunnel.Metrics()
+    metrics.port(443).total = 2
+    metrics.port(blutunnel.udp_key(443)).total = 5
+    text = metrics.render()
+    assert 'blutunnel_port_streams_total{port="443"} 2' in text
+    assert 'blutunnel_port_streams_total{port="443/udp"} 5' in text
+
+
+def test_rates_follow_moved_bytes():
+    metrics = blutunnel.Metrics()
+    stats = metrics.port(80)
+    metrics.sampled_at -= 1
+    stats.bytes[0] += 1000
+    metrics.sample_rates()
+    assert 0 < stats.rate[0] <= blutunnel.SHAPE_RATE_EWMA * 1000
+    assert stats.rate[1] == 0
+
+
+def test_stats_line_is_logged_plainly_without_a_terminal(capsys, monkeypatch):
+    logged = []
+    monkeypatch.setattr(blutunnel.logger, "info", lambda msg, *args: logged.append(msg % args))
+    line = blutunnel.StatsLine(0)
+    assert not line.live
+    fields = [(blutunnel.Colors.PING, "Connections", 3), (blutunnel.Colors.INFO, "Loop", "asyncio")]
+    line.show(fields)
+    assert not logged
+    line.logged -= blutunnel.STATS_LOG_INTERVAL
+    line.show(fields)
+    assert capsys.readouterr().out == ""
+    assert len(logged) == 1 and logged[0].endswith("connections 3, loop asyncio")
+    assert "\x1b" not in logged[0] and "\r" not in logged[0]
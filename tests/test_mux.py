@@ -0,0 +1,164 @@
+import asyncio
+import os
+import struct
+
+import blutunnel
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def linked_sessions(tcp_pair):
+    """An Iran and a Europe MuxSession over one loopback bridge, Europe dialing an echo server."""
+    target = await asyncio.start_server(echo, "127.0.0.1", 0)
+    target_port = target.sockets[0].getsockname()[1]
+
+    async def connector(port, udp):
+        return await asyncio.open_connection("127.0.0.1", port)
+
+    (iran_r, iran_w), (eu_r, eu_w) = await tcp_pair()
+    iran = blutunnel.MuxSession(iran_r, iran_w, label="europe")
+    europe = blutunnel.MuxSession(eu_r, eu_w, connector=connector, label="iran")
+    tasks = [asyncio.create_task(iran.run()), asyncio.create_task(europe.run())]
+    return iran, europe, target_port, tasks, target
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def frames(data):
+    out = []
+    while data:
+        ftype, sid, length = blutunnel.MUX_HEADER.unpack_from(data)
+        end = blutunnel.MUX_HEADER.size + length
+        out.append((ftype, sid, bytes(data[blutunnel.MUX_HEADER.size:end])))
+        data = data[end:]
+    return out
+
+
+def test_stream_round_trip_beyond_the_window(tcp_pair):
+    payload = os.urandom(3 * blutunnel.MUX_WINDOW + 12345)
+
+    async def main():
+        iran, europe, port, tasks, target = await linked_sessions(tcp_pair)
+        (user_r, user_w), (local_r, local_w) = await tcp_pair()
+        opened = asyncio.create_task(iran.open_stream(port, local_r, local_w))
+
+        async def send():
+            user_w.write(payload)
+            await user_w.drain()
+
+        sender = asyncio.create_task(send())
+        received = await asyncio.wait_for(user_r.readexactly(len(payload)), 10)
+        await sender
+        stats = blutunnel.metrics.port(port)
+        user_w.close()
+        await asyncio.wait_for(opened, 5)
+        iran.close()
+        europe.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        target.close()
+        return received, stats
+
+    received, stats = asyncio.run(main())
+    assert received == payload
+    assert stats.bytes[0] >= len(payload) and stats.bytes[1] >= len(payload)
+
+
+def test_frames_coalesce_into_one_write():
+    async def main():
+        writer = FakeWriter()
+        session = blutunnel.MuxSession(None, writer)
+        session.send_frame(blutunnel.MUX_PING, 0, b"abc")
+        session.send_frame(blutunnel.MUX_DATA, 7, b"x" * 10)
+        assert not writer.data
+        await asyncio.sleep(0)
+        return frames(writer.data)
+
+    assert asyncio.run(main()) == [(blutunnel.MUX_PING, 0, b"abc"), (blutunnel.MUX_DATA, 7, b"x" * 10)]
+
+
+def test_data_past_the_window_closes_the_stream():
+    async def main():
+        writer = FakeWriter()
+        session = blutunnel.MuxSession(None, writer, connector=lambda port, udp: None)
+        stream = blutunnel.MuxStream(5, blutunnel.PortStats())
+        session.streams[5] = stream
+        session._on_data(5, b"x" * blutunnel.MUX_WINDOW)
+        assert not stream.closed and stream.pending
+        session._on_data(5, b"x")
+        await asyncio.sleep(0)
+        return stream, frames(writer.data)
+
+    stream, sent = asyncio.run(main())
+    assert stream.closed
+    assert sent == [(blutunnel.MUX_CLOSE, 5, b"")]
+
+
+def test_window_update_refills_send_credit(tcp_pair):
+    async def main():
+        writer = FakeWriter()
+        session = blutunnel.MuxSession(None, writer)
+        (user_r, user_w), (local_r, local_w) = await tcp_pair()
+        opened = asyncio.create_task(session.open_stream(80, local_r, local_w))
+        user_w.write(b"y" * (blutunnel.MUX_WINDOW + 1000))
+        await asyncio.sleep(0.2)
+        stream = session.streams[1]
+        sent = sum(len(p) for t, s, p in frames(writer.data) if t == blutunnel.MUX_DATA)
+        assert sent == blutunnel.MUX_WINDOW and stream.send_window == 0
+        stream.send_window += 1000
+        stream.window_event.set()
+        await asyncio.sleep(0.2)
+        sent = sum(len(p) for t, s, p in frames(writer.data) if t == blutunnel.MUX_DATA)
+        user_w.close()
+        session.close()
+        await asyncio.gather(opened, return_exceptions=True)
+        return sent
+
+    assert asyncio.run(main()) == blutunnel.MUX_WINDOW + 1000
+
+
+def test_open_frames_carry_port_and_udp_flag():
+    async def main():
+        writer = FakeWriter()
+        session = blutunnel.MuxSession(None, writer)
+        stream = blutunnel.DatagramStream(lambda datagram: None)
+        opened = asyncio.create_task(session.open_stream(443, stream, stream, udp=True))
+        await asyncio.sleep(0)
+        stream.close()
+        await asyncio.gather(opened, return_exceptions=True)
+        await asyncio.sleep(0)
+        return frames(writer.data)[0]
+
+    ftype, sid, payload = asyncio.run(main())
+    assert ftype == blutunnel.MUX_OPEN
+    assert payload == struct.pack("!HB", 443, blutunnel.BRIDGE_UDP)
+
+
+def test_stream_ids_skip_live_streams_after_wrapping():
+    async def main():
+        session = blutunnel.MuxSession(None, FakeWriter())
+        session.next_sid = 0xFFFFFFFF
+        session.streams[1] = object()
+        session.streams[2] = object()
+        return session._new_sid(), session._new_sid()
+
+    assert asyncio.run(main()) == (0xFFFFFFFF, 3)
@@ -0,0 +1,95 @@
+import asyncio
+
+import blutunnel
+
+
+async def park(worker_id):
+    await asyncio.Event().wait()
+
+
+def new_pool(min_workers=4, max_workers=40, group=None):
+    return blutunnel.ElasticPool(park, min_workers=min_workers, max_workers=max_workers, group=group)
+
+
+def test_start_covers_the_idle_headroom():
+    async def main():
+        pool = new_pool()
+        pool.start()
+        started = len(pool.workers)
+        pool.stop()
+        return started
+
+    assert asyncio.run(main()) == blutunnel.POOL_MIN_IDLE
+
+
+def test_status_with_waiting_users_grows_by_the_deficit():
+    async def main():
+        pool = new_pool()
+        pool.start()
+        # 40 picks in 1 s, averaged with the earlier 0/s: 20/s, so 40 idle bridges wanted.
+        pool.on_status(idle=2, waiting=5, picks=40, elapsed_ms=1000)
+        grown = len(pool.workers)
+        pool.stop()
+        return grown, pool.pick_rate, pool.target_idle
+
+    grown, rate, target = asyncio.run(main())
+    assert rate == 20
+    assert target == 20 * blutunnel.POOL_HEADROOM_SEC
+    # 8 running plus a deficit of 40 + 5 - 2, capped at max_workers.
+    assert grown == 40
+
+
+def test_surplus_shrinks_only_after_several_reports():
+    async def main():
+        pool = new_pool(min_workers=2)
+        pool.grow(30)
+        await asyncio.sleep(0)
+        for worker_id in pool.workers:
+            pool.mark_idle(worker_id)
+        sizes = []
+        for _ in range(blutunnel.POOL_SHRINK_ROUNDS):
+            pool.on_status(idle=30, waiting=0, picks=0, elapsed_ms=1000)
+            await asyncio.sleep(0.01)
+            sizes.append(len(pool.workers))
+        pool.stop()
+        return sizes
+
+    # Target 8 idle: the third surplus report retires half of the 22 extra.
+    assert asyncio.run(main()) == [30, 30, 19]
+
+
+def test_pools_in_a_group_share_max_workers():
+    async def main():
+        group = []
+        first = new_pool(max_workers=10, group=group)
+        second = new_pool(max_workers=10, group=group)
+        group += [first, second]
+        first.grow(7)
+        second.grow(7)
+        sizes = len(first.workers), len(second.workers)
+        first.stop()
+        second.stop()
+        return sizes
+
+    assert asyncio.run(main()) == (7, 3)
+
+
+def test_taking_a_bridge_replaces_it_and_release_retires_surplus():
+    async def main():
+        pool = new_pool(min_workers=1)
+        pool.start()
+        await asyncio.sleep(0)
+        for worker_id in list(pool.workers):
+            pool.mark_idle(worker_id)
+        pool.mark_busy(0)
+        replaced = len(pool.workers)
+        keep = pool.release(0)
+        pool.grow(20)
+        retire = pool.release(1)
+        pool.stop()
+        return replaced, keep, retire
+
+    replaced, keep, retire = asyncio.run(main())
+    assert replaced == blutunnel.POOL_MIN_IDLE + 1
+    assert keep is False
+    assert retire is True
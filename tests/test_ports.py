@@ -0,0 +1,91 @@
+import asyncio
+import socket
+
+import pytest
+
+import blutunnel
+
+
+class FakeServer:
+    def __init__(self, port):
+        self.port = port
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_bind_all_returns_results_and_errors_in_port_order():
+    async def bind(port):
+        await asyncio.sleep(0.001 * (5 - port))
+        if port == 3:
+            raise OSError("address in use")
+        return FakeServer(port)
+
+    results = asyncio.run(blutunnel.bind_all([1, 2, 3, 4], bind))
+    assert [r.port for r in results if isinstance(r, FakeServer)] == [1, 2, 4]
+    assert isinstance(results[2], OSError)
+
+
+def test_bind_all_limits_concurrent_binds():
+    in_flight = peak = 0
+
+    async def bind(port):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        return FakeServer(port)
+
+    results = asyncio.run(blutunnel.bind_all(range(20), bind, limit=3))
+    assert len(results) == 20 and peak == 3
+
+
+def test_cancelled_apply_rolls_back_finished_binds():
+    bound = []
+
+    async def main():
+        hang = asyncio.Event()
+
+        async def bind(port):
+            if port == 3:
+                await hang.wait()
+            server = FakeServer(port)
+            bound.append(server)
+            return server
+
+        task = asyncio.ensure_future(blutunnel.bind_all([1, 2, 3], bind))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert [s.port for s in bound] == [1, 2]
+    assert all(s.closed for s in bound)
+
+
+def test_bind_all_with_real_listeners_reports_a_taken_port():
+    taken = socket.create_server(("127.0.0.1", 0))
+    busy = taken.getsockname()[1]
+
+    async def main():
+        async def bind(port):
+            return await blutunnel.listen(lambda r, w: w.close(), "127.0.0.1", port)
+
+        results = await blutunnel.bind_all([0, busy], bind)
+        ports = []
+        for r in results:
+            if not isinstance(r, BaseException):
+                ports.append(r.sockets[0].getsockname()[1])
+                r.close()
+                await r.wait_closed()
+        return ports, results[1]
+
+    try:
+        ports, failed = asyncio.run(main())
+    finally:
+        taken.close()
+    assert len(ports) == 1 and ports[0] != busy
+    assert isinstance(failed, OSError)
@@ -0,0 +1,81 @@
+import blutunnel
+
+
+class FakeSession:
+    def __init__(self):
+        self.gone = False
+
+    def go_away(self):
+        self.gone = True
+
+
+def relay(host, links=0, pick_rate=0.0):
+    r = blutunnel.IranRelay(host)
+    r.links = links
+    r.pick_rate = pick_rate
+    r.sessions = {FakeSession() for _ in range(links)}
+    return r
+
+
+def test_failures_back_off_exponentially_up_to_the_cap(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(blutunnel.time, "time", lambda: clock[0])
+    r = blutunnel.IranRelay("10.0.0.1")
+    assert r.fail() and not r.up and not r.healthy
+    delays = [r.down_until - clock[0]]
+    # Workers failing while the relay is already down do not extend it.
+    assert not r.fail() and r.down_until - clock[0] == delays[0]
+    for _ in range(5):
+        clock[0] = r.down_until
+        assert r.up
+        assert not r.fail()
+        delays.append(r.down_until - clock[0])
+    assert delays == [1, 2, 4, 8, 10, 10]
+
+
+def test_recover_reports_only_a_relay_that_was_down(monkeypatch):
+    monkeypatch.setattr(blutunnel.time, "time", lambda: 1000.0)
+    r = blutunnel.IranRelay("10.0.0.1")
+    assert not r.recover()
+    r.fail()
+    r.fail()
+    assert r.recover() and r.up and r.healthy
+    r.fail()
+    assert r.down_until == 1000.0 + blutunnel.RELAY_BACKOFF_MIN
+
+
+def test_pick_relay_skips_down_relays_and_weighs_demand(monkeypatch):
+    monkeypatch.setattr(blutunnel.time, "time", lambda: 1000.0)
+    quiet, busy, down = relay("a", links=2), relay("b", links=3, pick_rate=2.0), relay("c")
+    down.fail()
+    # b carries more links, but three times the demand per link.
+    assert blutunnel.pick_relay([quiet, busy, down]) is busy
+    busy.fail()
+    assert blutunnel.pick_relay([quiet, busy, down]) is quiet
+    quiet.fail()
+    assert blutunnel.pick_relay([quiet, busy, down]) is None
+
+
+def test_rebalance_moves_links_to_a_recovered_relay():
+    loaded, back = relay("a", links=6), relay("b")
+    sessions = list(loaded.sessions)
+    blutunnel.rebalance_relays([loaded, back], back)
+    assert sum(s.gone for s in sessions) == 3 and len(loaded.sessions) == 3
+
+
+def test_rebalance_respects_the_limit_and_an_even_split():
+    loaded, back = relay("a", links=6), relay("b")
+    blutunnel.rebalance_relays([loaded, back], back, limit=1)
+    assert len(loaded.sessions) == 5
+    even, other = relay("a", links=2), relay("b", links=2)
+    blutunnel.rebalance_relays([even, other], other)
+    assert len(even.sessions) == 2
+
+
+def test_links_split_across_worker_processes_and_relays():
+    assert blutunnel.split_workers(16, 1) == 16
+    assert blutunnel.split_workers(16, 4) == 4
+    assert blutunnel.split_workers(16, 3) == 6
+    assert blutunnel.split_workers(16, 4, 3) == 2
+    # Every process keeps at least one link to every relay.
+    assert blutunnel.split_workers(2, 4, 3) == 1
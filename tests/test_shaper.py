@@ -0,0 +1,161 @@
+import asyncio
+
+import blutunnel
+
+QUANTUM = blutunnel.SHAPE_QUANTUM
+
+
+class Timer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """A clock the test moves by hand; timers fire from ``advance``."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        timer = Timer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+        due = [t for t in self.timers if t.when <= self.now and not t.cancelled]
+        self.timers = [t for t in self.timers if t not in due]
+        for timer in due:
+            timer.callback()
+
+
+class Lane:
+    def __init__(self, quantum=QUANTUM):
+        self.quantum = quantum
+        self.grants = 0
+
+    def granted(self):
+        self.grants += 1
+
+
+def test_bucket_starts_with_a_burst_and_runs_one_grant_into_debt():
+    loop = FakeLoop()
+    bucket = blutunnel.TokenBucket(loop, "k", 10 * QUANTUM)
+    assert bucket.tokens == bucket.burst == QUANTUM
+    assert bucket.request(Lane())
+    assert bucket.tokens == 0
+    assert bucket.request(Lane())
+    assert bucket.tokens == -QUANTUM
+    lane = Lane()
+    assert not bucket.request(lane)
+    assert list(bucket.waiters) == [lane]
+
+
+def test_waiters_are_granted_in_order_as_tokens_refill():
+    loop = FakeLoop()
+    rate = 10 * QUANTUM
+    bucket = blutunnel.TokenBucket(loop, "k", rate)
+    bucket.request(Lane())
+    bucket.request(Lane())
+    first, second = Lane(), Lane()
+    bucket.request(first)
+    bucket.request(second)
+    # Paying back one grant of debt takes QUANTUM / rate seconds.
+    assert bucket.timer.when == QUANTUM / rate
+    loop.advance(QUANTUM / rate)
+    assert (first.grants, second.grants) == (1, 0)
+    loop.advance(QUANTUM / rate)
+    assert (first.grants, second.grants) == (1, 1)
+    assert not bucket.waiters and bucket.timer is None
+
+
+def test_refill_is_capped_at_the_burst():
+    loop = FakeLoop()
+    rate = 100 * QUANTUM
+    bucket = blutunnel.TokenBucket(loop, "k", rate)
+    assert bucket.burst == rate * blutunnel.SHAPE_BURST
+    bucket.request(Lane())
+    loop.advance(60)
+    bucket._refill()
+    assert bucket.tokens == bucket.burst
+
+
+def test_cancel_and_refund():
+    loop = FakeLoop()
+    bucket = blutunnel.TokenBucket(loop, "k", QUANTUM)
+    bucket.request(Lane())
+    bucket.request(Lane())
+    lane = Lane()
+    bucket.request(lane)
+    bucket.cancel(lane)
+    bucket.cancel(lane)
+    assert not bucket.waiters
+    bucket.refund(10 * QUANTUM)
+    assert bucket.tokens == bucket.burst
+
+
+def test_unlimited_bucket_grants_at_once():
+    bucket = blutunnel.TokenBucket(FakeLoop(), "k", 0)
+    assert all(bucket.request(Lane()) for _ in range(100))
+
+
+def test_lane_takes_credit_from_every_bucket():
+    async def main():
+        shaper = blutunnel.Shaper()
+        shaper.configure({80: 10 * QUANTUM}, 20 * QUANTUM, 0, {80: 2})
+        stats = blutunnel.PortStats()
+        lane_in, lane_out = shaper.flow(80, "10.0.0.1", stats)
+        buckets = [b.key for b in lane_in.buckets]
+        assert buckets == [("port", 80, 0), ("client", "10.0.0.1", 0)]
+        assert lane_in.ready(None)
+        assert lane_in.credit == 2 * QUANTUM
+        assert [b.tokens for b in lane_in.buckets] == [bucket.burst - 2 * QUANTUM for bucket in lane_in.buckets]
+        lane_in.consume(QUANTUM)
+        lane_in.close()
+        lane_out.close()
+        return shaper.buckets
+
+    assert asyncio.run(main()) == {}
+
+
+def test_unshaped_ports_get_no_lanes():
+    async def main():
+        shaper = blutunnel.Shaper()
+        assert shaper.flow(80, "c", blutunnel.PortStats()) is None
+        shaper.configure({443: QUANTUM}, 0, 0, {})
+        return shaper.flow(80, "c", blutunnel.PortStats())
+
+    assert asyncio.run(main()) is None
+
+
+def test_lane_wait_resumes_once_the_bucket_refills():
+    async def main():
+        shaper = blutunnel.Shaper()
+        rate = 50 * QUANTUM
+        shaper.configure({}, 0, rate, {})
+        stats = blutunnel.PortStats()
+        lane = shaper.flow(80, "c", stats)[0]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        moved = 0
+        while moved < 10 * QUANTUM:
+            await lane.wait()
+            lane.consume(QUANTUM)
+            moved += QUANTUM
+        elapsed = loop.time() - start
+        lane.close()
+        return elapsed, stats.throttled[0]
+
+    elapsed, throttled = asyncio.run(main())
+    # The burst (plus one grant of debt) covers six grants; four more take 4 / 50 s.
+    assert 0.07 < elapsed < 0.5
+    assert throttled > 0
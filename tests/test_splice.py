@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+import blutunnel
+
+pytestmark = pytest.mark.skipif(not blutunnel.SPLICE_ENABLED, reason="splice(2) not available")
+
+
+def test_half_close_drains_other_direction(tcp_pair):
+    payload = bytes(range(256)) * 16384  # 4 MiB, more than one pipe holds
+
+    async def main():
+        (user_r, user_w), (relay_ur, relay_uw) = await tcp_pair()
+        (relay_br, relay_bw), (back_r, back_w) = await tcp_pair()
+        relay = asyncio.create_task(blutunnel.splice_relay(relay_ur, relay_uw, relay_br, relay_bw))
+        user_w.write(b"GET")
+        user_w.write_eof()
+        assert await back_r.read() == b"GET"
+        back_w.write(payload)
+        back_w.write_eof()
+        received = await asyncio.wait_for(user_r.read(), 10)
+        await asyncio.wait_for(relay, 10)
+        user_w.close()
+        back_w.close()
+        return received
+
+    assert asyncio.run(main()) == payload
+
+
+def test_both_directions_relay_in_full(tcp_pair):
+    up = b"u" * 1000000
+    down = b"d" * 3000000
+
+    async def main():
+        (user_r, user_w), (relay_ur, relay_uw) = await tcp_pair()
+        (relay_br, relay_bw), (back_r, back_w) = await tcp_pair()
+        stats = blutunnel.PortStats()
+        relay = asyncio.create_task(blutunnel.splice_relay(relay_ur, relay_uw, relay_br, relay_bw, stats=stats))
+
+        async def backend():
+            back_w.write(down)
+            back_w.write_eof()
+            return await back_r.read()
+
+        async def user():
+            user_w.write(up)
+            user_w.write_eof()
+            return await user_r.read()
+
+        got_up, got_down = await asyncio.wait_for(asyncio.gather(backend(), user()), 10)
+        await asyncio.wait_for(relay, 10)
+        user_w.close()
+        back_w.close()
+        return got_up, got_down, stats.bytes
+
+    got_up, got_down, moved = asyncio.run(main())
+    assert got_up == up
+    assert got_down == down
+    assert moved == [len(up), len(down)]
+
+
+def test_aborted_transport_ends_the_relay(tcp_pair):
+    async def main():
+        (user_r, user_w), (relay_ur, relay_uw) = await tcp_pair()
+        (relay_br, relay_bw), (back_r, back_w) = await tcp_pair()
+        relay = asyncio.create_task(blutunnel.splice_relay(relay_ur, relay_uw, relay_br, relay_bw))
+        user_w.write(b"ping")
+        assert await back_r.readexactly(4) == b"ping"
+        # What drain() and shutdown do to live users.
+        relay_uw.transport.abort()
+        await asyncio.wait_for(relay, 5)
+        assert await asyncio.wait_for(back_r.read(), 5) == b""
+        user_w.close()
+        back_w.close()
+
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import blutunnel
+
+
+def udp_stream(client, received=0, sent=0, idle=0.0):
+    stream = blutunnel.DatagramStream(lambda data: None, peername=(client, 5000))
+    stream.received = received
+    stream.sent = sent
+    stream.last_active = time.monotonic() - idle
+    return stream
+
+
+def test_add_and_remove_track_live_streams():
+    registry = blutunnel.StreamRegistry()
+    first = registry.add(443, udp_stream("10.0.0.1"), "node-a")
+    second = registry.add(blutunnel.udp_key(53), udp_stream("10.0.0.2"), "node-b")
+    assert (first.sid, second.sid) == (1, 2)
+    assert first.client == "10.0.0.1" and second.bridge == "node-b"
+    registry.remove(first)
+    registry.remove(first)
+    registry.remove(None)
+    assert list(registry.records) == [2]
+    # Ids are never reused.
+    assert registry.add(443, udp_stream("10.0.0.3"), "node-a").sid == 3
+
+
+def test_top_orders_by_bytes_age_and_idle():
+    async def main():
+        registry = blutunnel.StreamRegistry()
+        small = registry.add(443, udp_stream("10.0.0.1", 10, 10, idle=30), "a")
+        big = registry.add(443, udp_stream("10.0.0.2", 500, 100, idle=1), "a")
+        mid = registry.add(blutunnel.udp_key(53), udp_stream("10.0.0.3", 50, 200, idle=5), "a")
+        small.started -= 100
+        mid.started -= 50
+        by = {}
+        for sort in ("bytes", "age", "idle"):
+            by[sort] = [row["client"] for row in await registry.top(10, sort)]
+        top = await registry.top(1, "bytes")
+        return by, top
+
+    by, top = asyncio.run(main())
+    assert by["bytes"] == ["10.0.0.2", "10.0.0.3", "10.0.0.1"]
+    assert by["age"] == ["10.0.0.1", "10.0.0.3", "10.0.0.2"]
+    assert by["idle"] == ["10.0.0.1", "10.0.0.3", "10.0.0.2"]
+    [row] = top
+    assert row["in"] == 500 and row["out"] == 100 and row["port"] == "443" and row["rate"] == 0
+
+
+def test_top_by_rate_measures_over_the_window(monkeypatch):
+    monkeypatch.setattr(blutunnel, "STREAMS_RATE_WINDOW", 0.1)
+
+    async def main():
+        registry = blutunnel.StreamRegistry()
+        heavy_past = udp_stream("10.0.0.1", received=10**6)
+        busy_now = udp_stream("10.0.0.2")
+        leaving = udp_stream("10.0.0.3")
+        registry.add(443, heavy_past, "a")
+        registry.add(443, busy_now, "a")
+        gone = registry.add(443, leaving, "a")
+
+        async def traffic():
+            await asyncio.sleep(0.02)
+            busy_now.received += 5000
+            registry.remove(gone)
+
+        task = asyncio.ensure_future(traffic())
+        rows = await registry.top(10, "rate")
+        await task
+        return rows
+
+    rows = asyncio.run(main())
+    assert [row["client"] for row in rows] == ["10.0.0.2", "10.0.0.1"]
+    assert rows[0]["rate"] > 0 and rows[1]["rate"] == 0
+
+
+def test_worker_ids_are_prefixed():
+    async def main():
+        registry = blutunnel.StreamRegistry()
+        registry.worker = 2
+        registry.add(443, udp_stream("10.0.0.1"), "a")
+        return await registry.top(10, "age")
+
+    assert asyncio.run(main())[0]["id"] == "2.1"
+
+
+def test_tcp_counters_follow_the_client_direction(tcp_pair):
+    async def main():
+        (user_r, user_w), (local_r, local_w) = await tcp_pair()
+        registry = blutunnel.StreamRegistry()
+        record = registry.add(443, local_w, "a")
+        user_w.write(b"x" * 3000)
+        await user_w.drain()
+        await local_r.readexactly(3000)
+        local_w.write(b"y" * 700)
+        await local_w.drain()
+        await user_r.readexactly(700)
+        await asyncio.sleep(0.05)
+        rows = await registry.top(10, "bytes")
+        local_w.close()
+        user_w.close()
+        await asyncio.sleep(0.01)
+        closed = await registry.top(10, "bytes")
+        return record, rows, closed
+
+    record, rows, closed = asyncio.run(main())
+    assert record.client == "127.0.0.1"
+    assert (rows[0]["in"], rows[0]["out"]) == (3000, 700)
+    # A stream whose socket is gone drops out instead of failing the listing.
+    assert closed == []
@@ -0,0 +1,53 @@
+import asyncio
+
+import blutunnel
+
+
+def round_trip(frame, timeout=1):
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(frame)
+        reader.feed_eof()
+        return await blutunnel.read_sync(reader, timeout)
+
+    return asyncio.run(main())
+
+
+def test_full_sync_round_trip_merges_ranges():
+    ports = {80, 443, 444, 445, 8080, blutunnel.udp_key(443), blutunnel.udp_key(444)}
+    frame = blutunnel.encode_sync(blutunnel.SYNC_FULL, 7, added=ports)
+    # 80, 443-445, 8080 and udp 443-444 collapse into four ranges.
+    assert len(frame) == blutunnel.SYNC_HEADER.size + 4 * blutunnel.SYNC_RANGE.size
+    assert round_trip(frame) == (blutunnel.SYNC_FULL, 7, ports, set())
+
+
+def test_delta_sync_round_trip_keeps_added_and_removed_apart():
+    added = {2000, 2001, blutunnel.udp_key(53)}
+    removed = {3000, blutunnel.udp_key(3000)}
+    frame = blutunnel.encode_sync(blutunnel.SYNC_DELTA, 0xFFFFFFFF, added, removed)
+    assert round_trip(frame) == (blutunnel.SYNC_DELTA, 0xFFFFFFFF, added, removed)
+
+
+def test_empty_frame_is_header_only():
+    frame = blutunnel.encode_sync(blutunnel.SYNC_POLL, 3)
+    assert len(frame) == blutunnel.SYNC_HEADER.size
+    assert round_trip(frame) == (blutunnel.SYNC_POLL, 3, set(), set())
+
+
+def test_invalid_ranges_are_skipped():
+    frame = blutunnel.SYNC_HEADER.pack(blutunnel.SYNC_FULL, 1, 3, 0) + b"".join((
+        blutunnel.SYNC_RANGE.pack(2, 80, 80),
+        blutunnel.SYNC_RANGE.pack(0, 90, 85),
+        blutunnel.SYNC_RANGE.pack(0, 22, 23),
+    ))
+    assert round_trip(frame) == (blutunnel.SYNC_FULL, 1, {22, 23}, set())
+
+
+def test_truncated_body_raises():
+    frame = blutunnel.encode_sync(blutunnel.SYNC_FULL, 1, added={80, 90})
+    try:
+        round_trip(frame[:-1])
+    except asyncio.IncompleteReadError:
+        pass
+    else:
+        raise AssertionError("truncated sync frame was accepted")
@@ -0,0 +1,73 @@
+import asyncio
+import socket
+import time
+
+import blutunnel
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((addr, data))
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def close(self):
+        pass
+
+
+def test_reply_traffic_keeps_a_session_from_expiring(monkeypatch):
+    monkeypatch.setattr(blutunnel, "UDP_IDLE_TIMEOUT", 10)
+
+    async def main():
+        streams = {}
+
+        async def serve(stream):
+            streams[stream.peername] = stream
+            await asyncio.Event().wait()
+
+        listener = blutunnel.UdpListener(serve)
+        listener.connection_made(FakeTransport())
+        listener.datagram_received(b"a", ("10.0.0.1", 1000))
+        listener.datagram_received(b"b", ("10.0.0.2", 2000))
+        await asyncio.sleep(0)
+        talker, quiet = streams[("10.0.0.1", 1000)], streams[("10.0.0.2", 2000)]
+        stale = time.monotonic() - 60
+        talker.last_active = quiet.last_active = stale
+        # Only the tunnel answers on the front session; the one behind it is idle.
+        talker.write(blutunnel.UDP_FRAME.pack(2) + b"hi")
+        listener._sweep()
+        alive = list(listener.sessions)
+        listener.close()
+        await asyncio.sleep(0)
+        return alive, listener.transport.sent
+
+    alive, sent = asyncio.run(main())
+    assert alive == [("10.0.0.1", 1000)]
+    assert sent == [(("10.0.0.1", 1000), b"hi")]
+
+
+def test_ephemeral_udp_ports_sync_only_when_reserved(tmp_path, monkeypatch):
+    udp = tmp_path / "udp"
+    udp.write_text(
+        "   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+        "  1: 00000000:9C40 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1001 2 0 0\n"
+        "  2: 00000000:9C41 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1002 2 0 0\n"
+        "  3: 00000000:01BB 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1003 2 0 0\n"
+        "  4: 00000000:9C42 0100007F:0035 01 00000000:00000000 00:00000000 00000000     0        0 1004 2 0 0\n"
+    )
+    reserved = tmp_path / "reserved"
+    reserved.write_text("8080,40000\n")
+    scanner = blutunnel.XrayPortScanner()
+    scanner.ephemeral = range(32768, 61000)
+    monkeypatch.setattr(scanner, "TABLES", ((str(udp), socket.AF_INET, "07", blutunnel.UDP_PORT_KEY),))
+    monkeypatch.setattr(scanner, "RESERVED", str(reserved))
+    key = blutunnel.udp_key
+    assert scanner._listeners() == {1001: ("0.0.0.0", key(40000)), 1003: ("0.0.0.0", key(443))}
+    assert scanner.skipped == {40001}
+    reserved.write_text("40000-40001\n")
+    assert set(scanner._listeners()) == {1001, 1002, 1003}
+    assert scanner.skipped == set()
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import socket
+
+import pytest
+
+import blutunnel
+
+
+class FakeProc:
+    def __init__(self, alive=True, exitcode=None):
+        self.alive = alive
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.alive
+
+
+@pytest.fixture
+def supervisor():
+    sup = blutunnel.WorkerSupervisor("iran", "key", {}, 3)
+    ends = []
+    for index in range(3):
+        parent, child = multiprocessing.Pipe()
+        ends.append(child)
+        sup.children[index] = {
+            "proc": FakeProc(), "conn": parent, "stats": {}, "started": 0.0,
+            "restart_at": None, "backoff": 1, "restarts": 0,
+        }
+    yield sup, ends
+    for index, end in enumerate(ends):
+        end.close()
+        if sup.children[index]["conn"] is not None:
+            sup.children[index]["conn"].close()
+
+
+def test_workers_share_a_port_with_reuse_port():
+    async def main():
+        first = await blutunnel.listen(lambda r, w: w.close(), "127.0.0.1", 0, reuse_port=True)
+        port = first.sockets[0].getsockname()[1]
+        second = await blutunnel.listen(lambda r, w: w.close(), "127.0.0.1", port, reuse_port=True)
+        bound = [s.getsockname()[1] for s in second.sockets]
+        for server in (first, second):
+            server.close()
+            await server.wait_closed()
+        return port, bound
+
+    port, bound = asyncio.run(main())
+    assert bound == [port]
+
+
+def test_leader_port_set_reaches_the_other_workers(supervisor):
+    sup, ends = supervisor
+    ends[0].send(("ports", {443: 1}))
+    sup._receive(sup.children[0]["conn"])
+    assert sup.ports == {443: 1}
+    assert not ends[0].poll()
+    assert ends[1].recv() == ("ports", {443: 1})
+    assert ends[2].recv() == ("ports", {443: 1})
+
+
+def test_stats_are_summed_across_workers(supervisor):
+    sup, ends = supervisor
+    for index, end in enumerate(ends):
+        end.send(("stats", {"connections": index + 1, "pool": 10}))
+        sup._receive(sup.children[index]["conn"])
+    assert sup._total("connections") == 6
+    assert sup._total("pool") == 30
+    assert sup._total("missing") == 0
+
+
+def test_crashed_worker_restarts_with_doubling_backoff(supervisor, monkeypatch):
+    sup, ends = supervisor
+    spawned = []
+    monkeypatch.setattr(sup, "spawn", spawned.append)
+    clock = [100.0]
+    monkeypatch.setattr(blutunnel.time, "time", lambda: clock[0])
+    child = sup.children[1]
+    child.update(proc=FakeProc(alive=False, exitcode=1), started=clock[0])
+    delays = []
+    for _ in range(5):
+        sup._reap()
+        delays.append(child["restart_at"] - clock[0])
+        clock[0] = child["restart_at"]
+        sup._reap()
+        child.update(restart_at=None, started=clock[0])
+    assert delays == [1, 2, 4, 8, 10]
+    assert spawned == [1] * 5 and child["restarts"] == 5
+    assert child["conn"] is None and child["stats"] == {}
+
+
+def test_long_lived_worker_resets_its_backoff(supervisor, monkeypatch):
+    sup, ends = supervisor
+    monkeypatch.setattr(blutunnel.time, "time", lambda: 1000.0)
+    child = sup.children[2]
+    child.update(proc=FakeProc(alive=False, exitcode=-9), backoff=8, started=900.0)
+    sup._reap()
+    assert child["restart_at"] == 1001.0 and child["backoff"] == 2
+
+
+def test_draining_supervisor_does_not_restart(supervisor, monkeypatch):
+    sup, ends = supervisor
+    sup.draining = True
+    sup.children[0]["proc"] = FakeProc(alive=False, exitcode=0)
+    sup._reap()
+    assert sup.children[0]["restart_at"] is None
+
+
+def test_launch_mode_uses_the_supervisor_only_for_several_workers(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    runs = []
+
+    class Supervisor:
+        def __init__(self, mode, key, profile, count):
+            runs.append(("supervisor", mode, count))
+
+        def run(self):
+            pass
+
+    async def runner(key, profile):
+        runs.append(("single", key))
+
+    monkeypatch.setattr(blutunnel, "WorkerSupervisor", Supervisor)
+    monkeypatch.setattr(blutunnel, "run_iran", runner)
+    monkeypatch.setattr(blutunnel, "handed_over", False)
+    blutunnel.launch_mode("iran", "key", {}, workers=4)
+    blutunnel.launch_mode("iran", "key", {})
+    assert runs == [("supervisor", "iran", 4), ("single", "key")]
+
+
+def test_workers_flag_defaults_to_one_process():
+    assert blutunnel.parse_args([]).workers == 1
+    assert blutunnel.parse_args(["--workers", "8"]).workers == 8
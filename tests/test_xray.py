@@ -0,0 +1,53 @@
+import socket
+
+import blutunnel
+
+
+def own_scanner():
+    with open("/proc/self/comm") as f:
+        return blutunnel.XrayPortScanner(process_name=f.read().strip())
+
+
+def test_scan_finds_this_process_listening_and_not_its_connections():
+    scanner = own_scanner()
+    server = socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    client = socket.create_connection(("127.0.0.1", port))
+    peer, _ = server.accept()
+    try:
+        found = scanner.scan()
+        assert ("127.0.0.1", port) in found
+        assert ("127.0.0.1", client.getsockname()[1]) not in found
+        assert scanner.inode_pid
+    finally:
+        for sock in (client, peer, server):
+            sock.close()
+    assert ("127.0.0.1", port) not in scanner.scan()
+
+
+def test_other_processes_listeners_are_skipped():
+    scanner = blutunnel.XrayPortScanner(process_name="no-such-process")
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        assert scanner.scan() == set()
+        # Remembered as someone else's, so the fd walk does not run again.
+        assert 0 in scanner.inode_pid.values()
+
+
+def test_table_lines_parse_addresses_and_state(tmp_path, monkeypatch):
+    tcp = tmp_path / "tcp"
+    tcp.write_text(
+        "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+        "   0: 0100007F:01BB 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1111 1 0 100 0 0 10 0\n"
+        "   1: 0100007F:01BB 0100007F:D431 01 00000000:00000000 00:00000000 00000000     0        0 2222 1 0 20 4 30 10 -1\n"
+    )
+    tcp6 = tmp_path / "tcp6"
+    tcp6.write_text(
+        "  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+        "   0: 00000000000000000000000001000000:0050 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 3333 1 0 100 0 0 10 0\n"
+    )
+    scanner = blutunnel.XrayPortScanner()
+    monkeypatch.setattr(scanner, "TABLES", (
+        (str(tcp), socket.AF_INET, "0A", 0),
+        (str(tcp6), socket.AF_INET6, "0A", 0),
+    ))
+    assert scanner._listeners() == {1111: ("127.0.0.1", 443), 3333: ("::1", 80)}